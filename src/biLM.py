@@ -11,7 +11,9 @@ import random
 import logging
 import json
 import torch
+import torch.distributed
 import collections
+import copy
 import shutil
 from bilm.elmo import ElmobiLm
 from bilm.lstm import LstmbiLm
@@ -19,12 +21,18 @@ from bilm.bengio03 import Bengio03HighwayBiLm, Bengio03ResNetBiLm
 from bilm.lbl import LBLHighwayBiLm, LBLResNetBiLm
 from bilm.self_attn import SelfAttentiveLBLBiLM
 from bilm.token_embedder import ConvTokenEmbedder, LstmTokenEmbedder
-from bilm.batch import Batcher, create_one_batch
+from bilm.batch import Batcher, StreamBatcher, create_one_batch
 from modules.embedding_layer import EmbeddingLayer
 from modules.softmax_layer import SoftmaxLayer
 from modules.sampled_softmax_layer import SampledSoftmaxLayer
 from modules.window_sampled_softmax_layer import WindowSampledSoftmaxLayer
+from modules.adaptive_softmax_layer import AdaptiveSoftmaxLayer
 from modules.window_sampled_cnn_softmax_layer import WindowSampledCNNSoftmaxLayer
+from modules.multiple_optimizer import MultipleOptimizer, get_sparse_parameters
+from modules.util import clip_grad_norm_, autocast
+from modules.checkpoint import snapshot, AsyncCheckpointWriter
+from modules.stage_timer import StageTimer, timed
+from modules.step_profiler import StepProfiler, parse_steps
 from dataloader import load_embedding
 from collections import Counter
 import numpy as np
@@ -36,8 +44,11 @@ def dict2namedtuple(dic):
   return collections.namedtuple('Namespace', dic.keys())(**dic)
 
 
-def split_train_and_valid(data, valid_size):
+def split_train_and_valid(data, valid_size, shuffle=True):
   valid_size = min(valid_size, len(data) // 10)
+  if not shuffle:
+    # keep the order of the corpus and take the valid data from the end.
+    return data[:len(data) - valid_size], data[len(data) - valid_size:]
   random.shuffle(data)
   return data[valid_size:], data[:valid_size]
 
@@ -67,15 +78,18 @@ def break_sentence(sentence, max_sent_len):
   return ret
 
 
-def read_corpus(path, max_chars=None, max_sent_len=20):
+def read_corpus(path, max_chars=None, max_sent_len=20, keep_sentences=False):
   """
   read raw text file
   :param path: str
   :param max_chars: int
   :param max_sent_len: int
+  :param keep_sentences: bool, cut every line on its own into pieces of at most max_sent_len
+    tokens, instead of breaking the whole text, e.g. to pack the sentences.
   :return:
   """
   data = []
+  dataset = []
   with codecs.open(path, 'r', encoding='utf-8') as fin:
     for line in fin:
       data.append('<bos>')
@@ -84,16 +98,40 @@ def read_corpus(path, max_chars=None, max_sent_len=20):
           token = token[:max_chars - 2]
         data.append(token)
       data.append('<eos>')
-  dataset = break_sentence(data, max_sent_len)
+      if keep_sentences:
+        dataset.extend(data[cur: cur + max_sent_len] for cur in range(0, len(data), max_sent_len))
+        data = []
+  if not keep_sentences:
+    dataset = break_sentence(data, max_sent_len)
   return dataset
 
 
 class Model(torch.nn.Module):
-  def __init__(self, config, word_emb_layer, char_emb_layer, n_class, use_cuda=False):
+  def __init__(self, config, word_emb_layer, char_emb_layer, n_class, use_cuda=False, classifier_map=None,
+               sparse_grad=False):
+    """
+
+    :param config:
+    :param word_emb_layer:
+    :param char_emb_layer:
+    :param n_class:
+    :param use_cuda:
+    :param classifier_map: LongTensor, the classifier id of every word id, None if they are the same.
+    :param sparse_grad: bool, gather the classifier weights with sparse gradients.
+    """
     super(Model, self).__init__() 
     self.use_cuda = use_cuda
     self.config = config
     self.dropout = torch.nn.Dropout(p=config['dropout'])
+    # StageTimer, set by `train` to time the update of the sampled classifiers.
+    self.timer = None
+
+    if classifier_map is not None and config['classifier']['name'].lower() == 'cnn_softmax':
+      raise ValueError('cnn_softmax embeds the targets with the token embedder and cannot remap them.')
+    if classifier_map is not None:
+      self.register_buffer('classifier_map', classifier_map)
+    else:
+      self.classifier_map = None
 
     token_embedder_name = config['token_embedder']['name'].lower()
     if token_embedder_name == 'cnn':
@@ -123,21 +161,61 @@ class Model(torch.nn.Module):
 
     self.output_dim = config['encoder']['projection_dim']
     classify_layer_name = config['classifier']['name'].lower()
+
+    # share the word embeddings with the classifier, projecting the encoder outputs to
+    # word_dim if they differ.
+    self.tie_embeddings = config['classifier'].get('tie_embeddings', False)
+    self.tie_projection = None
+    classifier_dim = self.output_dim
+    if self.tie_embeddings:
+      if classify_layer_name not in ('softmax', 'sampled_softmax', 'window_sampled_softmax'):
+        raise ValueError('tie_embeddings is not supported by {}.'.format(classify_layer_name))
+      if word_emb_layer is None:
+        raise ValueError('tie_embeddings requires word_dim > 0.')
+      if classifier_map is not None:
+        raise ValueError('tie_embeddings requires the classifier ids to be the word ids.')
+      if sparse_grad and classify_layer_name == 'softmax':
+        raise ValueError('the full softmax gives dense gradients to the tied embeddings, use it without sparse_grad.')
+      classifier_dim = word_emb_layer.n_d
+      if classifier_dim != self.output_dim:
+        self.tie_projection = torch.nn.Linear(self.output_dim, classifier_dim, bias=False)
+
     if classify_layer_name == 'softmax':
-      self.classify_layer = SoftmaxLayer(self.output_dim, n_class)
+      self.classify_layer = SoftmaxLayer(classifier_dim, n_class, config['classifier'].get('eval_chunk_size', 8192))
     elif classify_layer_name == 'cnn_softmax':
       self.classify_layer = WindowSampledCNNSoftmaxLayer(self.token_embedder, self.output_dim, n_class,
                                                          config['classifier']['n_samples'], config['classifier']['corr_dim'],
-                                                         use_cuda)
+                                                         use_cuda, config['classifier'].get('refresh_steps', 0),
+                                                         config['classifier'].get('eval_chunk_size', 8192), sparse_grad)
     elif classify_layer_name == 'sampled_softmax':
-      self.classify_layer = SampledSoftmaxLayer(self.output_dim, n_class, config['classifier']['n_samples'],
-                                                use_cuda, unk_id=0)
+      self.classify_layer = SampledSoftmaxLayer(classifier_dim, n_class, config['classifier']['n_samples'],
+                                                use_cuda, unk_id=0,
+                                                sample_queue_size=config['classifier'].get('sample_queue_size', 0),
+                                                eval_chunk_size=config['classifier'].get('eval_chunk_size', 8192),
+                                                sparse=sparse_grad)
     elif classify_layer_name == 'window_sampled_softmax':
-      self.classify_layer = WindowSampledSoftmaxLayer(self.output_dim, n_class, config['classifier']['n_samples'],
-                                                      use_cuda)
+      self.classify_layer = WindowSampledSoftmaxLayer(classifier_dim, n_class, config['classifier']['n_samples'],
+                                                      use_cuda, config['classifier'].get('eval_chunk_size', 8192),
+                                                      sparse_grad)
+    elif classify_layer_name == 'adaptive_softmax':
+      self.classify_layer = AdaptiveSoftmaxLayer(self.output_dim, n_class, config['classifier']['cutoffs'],
+                                                 config['classifier'].get('div_value', 4.0))
     else:
       raise ValueError('Unknown classify_layer: {}'.format(classify_layer_name))
 
+    self.tied_classifier_keys = []
+    if self.tie_embeddings:
+      weight = word_emb_layer.embedding.weight
+      if classify_layer_name == 'softmax':
+        self.classify_layer.hidden2tag.weight = weight
+        self.tied_classifier_keys.append('hidden2tag.weight')
+      elif classify_layer_name == 'sampled_softmax':
+        self.classify_layer.softmax_w = weight
+        self.tied_classifier_keys.append('softmax_w')
+      elif classify_layer_name == 'window_sampled_softmax':
+        self.classify_layer.softmax_w.weight = weight
+        self.tied_classifier_keys.append('softmax_w.weight')
+
   def forward(self, word_inp, chars_inp, mask_package):
     """
 
@@ -149,24 +227,36 @@ class Model(torch.nn.Module):
     classifier_name = self.config['classifier']['name'].lower()
 
     if self.training and classifier_name in ('cnn_softmax', 'window_sampled_softmax'):
-      self.classify_layer.update_negative_samples(word_inp, chars_inp, mask_package[0])
-      self.classify_layer.update_embedding_matrix()
+      # the window holds classifier ids.
+      window_inp = word_inp if self.classifier_map is None else self.classifier_map.cpu()[word_inp]
+      # the re-embedding of the window goes through the token embedder, it is only counted
+      # in the classifier time.
+      with timed(self.timer, 'classifier', hooks=False):
+        self.classify_layer.update_negative_samples(window_inp, chars_inp, mask_package[0])
+        self.classify_layer.update_embedding_matrix()
 
     token_embedding = self.token_embedder(word_inp, chars_inp, (mask_package[0].size(0), mask_package[0].size(1)))
     token_embedding = self.dropout(token_embedding)
 
+    # the packed batches carry the first step of every segment.
+    segment_starts = mask_package[3] if len(mask_package) > 3 else None
+    if segment_starts is not None and self.use_cuda:
+      segment_starts = segment_starts.cuda()
+
     encoder_name = self.config['encoder']['name'].lower()
     if encoder_name == 'elmo':
       mask = torch.autograd.Variable(mask_package[0]).cuda() if self.use_cuda else \
         torch.autograd.Variable(mask_package[0])
-      encoder_output = self.encoder(token_embedding, mask)
+      encoder_output = self.encoder(token_embedding, mask, segment_starts)
       n_layers = encoder_output.size()[0]
       encoder_output = encoder_output[n_layers - 1]
       # [batch_size, len, hidden_size]
     elif encoder_name == 'lstm':
+      if segment_starts is not None:
+        raise ValueError('The lstm encoder doesn\'t support packed batches.')
       encoder_output = self.encoder(token_embedding)
     elif encoder_name in ('bengio03highway', 'bengio03resnet', 'lblhighway', 'lblresnet', 'selfattn'):
-      encoder_output = self.encoder(token_embedding)
+      encoder_output = self.encoder(token_embedding, segment_starts)
       n_layers = encoder_output.size()[0]
       encoder_output = encoder_output[n_layers - 1]
     else:
@@ -190,42 +280,137 @@ class Model(torch.nn.Module):
     backward_x = backward.contiguous().view(-1, self.output_dim).index_select(0, mask2)
     backward_y = word_inp.contiguous().view(-1).index_select(0, mask1)
 
+    if self.classifier_map is not None:
+      forward_y = self.classifier_map[forward_y]
+      backward_y = self.classifier_map[backward_y]
+
+    if self.tie_projection is not None:
+      forward_x = self.tie_projection(forward_x)
+      backward_x = self.tie_projection(backward_x)
+
+    if self.config['classifier'].get('combine_directions', False):
+      # one classifier pass (and one set of negative samples) for both directions.
+      losses = self.classify_layer(torch.cat([forward_x, backward_x], dim=0),
+                                   torch.cat([forward_y, backward_y], dim=0), reduction='none')
+      forward_loss, backward_loss = losses.split([forward_x.size(0), backward_x.size(0)], dim=0)
+      return forward_loss.sum(), backward_loss.sum()
+
     return self.classify_layer(forward_x, forward_y), self.classify_layer(backward_x, backward_y)
 
+  def training_state_dict(self):
+    """
+    The training states that are not parameters: the negative sample window of the
+    classifier and the states carried over by a stateful encoder.
+
+    :return: dict
+    """
+    state = {}
+    if hasattr(self.classify_layer, 'sampler_state_dict'):
+      state['classifier'] = self.classify_layer.sampler_state_dict()
+    if getattr(self.encoder, '_states', None) is not None:
+      state['encoder'] = self.encoder._states
+    return state
+
+  def load_training_state_dict(self, state):
+    if 'classifier' in state:
+      self.classify_layer.load_sampler_state_dict(state['classifier'])
+    if 'encoder' in state:
+      device = next(self.encoder.parameters()).device
+      self.encoder._states = tuple(s.to(device) for s in state['encoder'])
+
   def save_model(self, path, save_classify_layer):
     torch.save(self.token_embedder.state_dict(), os.path.join(path, 'token_embedder.pkl'))    
     torch.save(self.encoder.state_dict(), os.path.join(path, 'encoder.pkl'))
     if save_classify_layer:
-      torch.save(self.classify_layer.state_dict(), os.path.join(path, 'classifier.pkl'))
+      # the tied weights are already saved with the token embedder.
+      state_dict = self.classify_layer.state_dict()
+      for key in self.tied_classifier_keys:
+        del state_dict[key]
+      torch.save(state_dict, os.path.join(path, 'classifier.pkl'))
+      if self.tie_projection is not None:
+        torch.save(self.tie_projection.state_dict(), os.path.join(path, 'tie_projection.pkl'))
 
   def load_model(self, path):
     self.token_embedder.load_state_dict(torch.load(os.path.join(path, 'token_embedder.pkl')))
     self.encoder.load_state_dict(torch.load(os.path.join(path, 'encoder.pkl')))
-    self.classify_layer.load_state_dict(torch.load(os.path.join(path, 'classifier.pkl')))
+    state_dict = torch.load(os.path.join(path, 'classifier.pkl'))
+    current_state_dict = self.classify_layer.state_dict()
+    for key in self.tied_classifier_keys:
+      state_dict[key] = current_state_dict[key]
+    self.classify_layer.load_state_dict(state_dict)
+    if self.tie_projection is not None:
+      self.tie_projection.load_state_dict(torch.load(os.path.join(path, 'tie_projection.pkl')))
 
 
-def eval_model(model, valid_batch):
+def eval_model(model, valid_batch, stream=False, precision='fp32'):
+  """
+
+  :param model:
+  :param valid_batch: Batcher, or StreamBatcher when `stream` is set.
+  :param stream: bool, carry the forward states from one chunk to the next, starting from
+    zero states. The training states are restored afterwards.
+  :param precision: str, 'fp32' or 'bf16' to run the forward pass under bfloat16 autocast.
+  :return:
+  """
   model.eval()
-  if model.config['classifier']['name'].lower() in ('window_sampled_cnn_softmax', 'window_sampled_softmax'):
+  if model.config['classifier']['name'].lower() in ('cnn_softmax', 'window_sampled_softmax'):
     model.classify_layer.update_embedding_matrix()
+  if stream:
+    training_states = model.encoder._states
+    model.encoder.reset_states()
   total_loss, total_tag = 0.0, 0
-  for w, c, lens, masks in valid_batch.get():
-    loss_forward, loss_backward = model.forward(w, c, masks)
-    total_loss += loss_forward.item()
-    n_tags = sum(lens)
-    total_tag += n_tags
+  with torch.no_grad(), autocast(precision, model.use_cuda):
+    for w, c, lens, masks in valid_batch.get():
+      loss_forward, loss_backward = model.forward(w, c, masks)
+      if stream:
+        model.encoder.reset_backward_states()
+      total_loss += loss_forward.item()
+      n_tags = sum(lens)
+      total_tag += n_tags
+  if stream:
+    model.encoder._states = training_states
   model.train()
   return np.exp(total_loss / total_tag)
 
 
+def get_rng_state():
+  state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'random': random.getstate()}
+  if torch.cuda.is_available():
+    state['cuda'] = torch.cuda.get_rng_state_all()
+  return state
+
+
+def set_rng_state(state):
+  torch.set_rng_state(state['torch'])
+  np.random.set_state(state['numpy'])
+  random.setstate(state['random'])
+  if 'cuda' in state and torch.cuda.is_available():
+    torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def get_checkpoint(epoch, cnt, total_loss, total_tag, best_train, best_valid, test_result,
+                   model, optimizer, train_batch):
+  """
+  Take a CPU snapshot of everything needed to continue the training at this step.
+
+  :return: dict
+  """
+  return snapshot({
+    'epoch': epoch, 'cnt': cnt, 'total_loss': total_loss, 'total_tag': total_tag,
+    'best_train': best_train, 'best_valid': best_valid, 'test_result': test_result,
+    'model': model.state_dict(), 'training_state': model.training_state_dict(),
+    'optimizer': optimizer.state_dict(), 'batcher': train_batch.state_dict(), 'rng': get_rng_state()})
+
+
 def train_model(epoch, opt, model, optimizer,
-                train_batch, valid_batch, test_batch, best_train, best_valid, test_result):
+                train_batch, valid_batch, test_batch, best_train, best_valid, test_result, is_master=True,
+                checkpointer=None, resume_state=None, timer=None, profiler=None):
   """
   Training model for one epoch
 
   :param epoch:
   :param opt:
-  :param model:
+  :param model: Model, or Model wrapped in DistributedDataParallel.
   :param optimizer:
   :param train_batch:
   :param best_train:
@@ -233,27 +418,55 @@ def train_model(epoch, opt, model, optimizer,
   :param best_valid:
   :param test_batch:
   :param test_result:
+  :param is_master: bool, only the master process evaluates and saves the model.
+  :param checkpointer: AsyncCheckpointWriter, write a checkpoint every `opt.checkpoint_steps` batches.
+  :param resume_state: dict, the checkpoint to continue the epoch from.
+  :param timer: StageTimer, report the time of every stage every `opt.timing_steps` batches.
+  :param profiler: StepProfiler
   :return:
   """
   model.train()
+  module = model.module if isinstance(model, torch.nn.parallel.DistributedDataParallel) else model
 
   total_loss, total_tag = 0.0, 0
   cnt = 0
+  if resume_state is not None:
+    cnt, total_loss, total_tag = resume_state['cnt'], resume_state['total_loss'], resume_state['total_tag']
+  elif opt.stream_training:
+    # the streams start over.
+    module.encoder.reset_states()
   start_time = time.time()
 
-  for w, c, lens, masks in train_batch.get():
+  batches = train_batch.get() if timer is None else timer.iterate('batch', train_batch.get())
+  for w, c, lens, masks in batches:
     cnt += 1
     model.zero_grad()
-    loss_forward, loss_backward = model.forward(w, c, masks)
+    with timed(timer, 'forward'), autocast(opt.precision, module.use_cuda):
+      loss_forward, loss_backward = model.forward(w, c, masks)
+    if opt.stream_training:
+      module.encoder.reset_backward_states()
 
     loss = (loss_forward + loss_backward) / 2.0
     total_loss += loss_forward.item()
     n_tags = sum(lens)
     total_tag += n_tags
-    loss.backward()
+    with timed(timer, 'backward'):
+      loss.backward()
+
+    with timed(timer, 'optimizer'):
+      if opt.sparse_grad:
+        clip_grad_norm_(model.parameters(), opt.clip_grad)
+      else:
+        torch.nn.utils.clip_grad_norm_(model.parameters(), opt.clip_grad)
+      optimizer.step()
+
+    if timer is not None:
+      timer.step(n_tags)
+      if cnt % opt.timing_steps == 0:
+        timer.report(epoch=epoch, iter=cnt)
+    if profiler is not None:
+      profiler.step()
 
-    torch.nn.utils.clip_grad_norm_(model.parameters(), opt.clip_grad)
-    optimizer.step()
     if cnt * opt.batch_size % 1024 == 0:
       logging.info("Epoch={} iter={} lr={:.6f} train_ppl={:.6f} time={:.2f}s".format(
         epoch, cnt, optimizer.param_groups[0]['lr'],
@@ -261,6 +474,9 @@ def train_model(epoch, opt, model, optimizer,
       ))
       start_time = time.time()
 
+    if not is_master:
+      continue
+
     if cnt % opt.eval_steps == 0 or cnt % train_batch.num_batches() == 0:
       train_ppl = np.exp(total_loss / total_tag)
       logging.info("Epoch={} iter={} lr={:.6f} train_ppl={:.6f}".format(
@@ -270,24 +486,65 @@ def train_model(epoch, opt, model, optimizer,
         if train_ppl < best_train:
           best_train = train_ppl
           logging.info("New record achieved on training dataset!")
-          model.save_model(opt.model, opt.save_classify_layer)      
+          module.save_model(opt.model, opt.save_classify_layer)      
       else:
-        valid_ppl = eval_model(model, valid_batch)
+        with timed(timer, 'eval', hooks=False):
+          valid_ppl = eval_model(module, valid_batch, opt.stream_training, opt.precision)
         logging.info("Epoch={} iter={} lr={:.6f} valid_ppl={:.6f}".format(
           epoch, cnt, optimizer.param_groups[0]['lr'], valid_ppl))
 
         if valid_ppl < best_valid:
-          model.save_model(opt.model, opt.save_classify_layer)
+          module.save_model(opt.model, opt.save_classify_layer)
           best_valid = valid_ppl
           logging.info("New record achieved!")
 
           if test is not None:
-            test_result = eval_model(model, test_batch)
+            with timed(timer, 'eval', hooks=False):
+              test_result = eval_model(module, test_batch, opt.stream_training, opt.precision)
             logging.info("Epoch={} iter={} lr={:.6f} test_ppl={:.6f}".format(
               epoch, cnt, optimizer.param_groups[0]['lr'], test_result))
+
+    if checkpointer is not None and cnt % opt.checkpoint_steps == 0:
+      checkpointer.save(get_checkpoint(epoch, cnt, total_loss, total_tag, best_train, best_valid, test_result,
+                                       module, optimizer, train_batch))
+
+  if module.config['classifier']['name'].lower() == 'sampled_softmax':
+    # stop the sample producer, the next epoch starts a new one.
+    module.classify_layer.close()
   return best_train, best_valid, test_result
 
 
+def get_classifier_lexicon(dataset, word_lexicon):
+  """
+  Re-index the words of the lexicon by their frequency in the dataset, so that the
+  classifier ids follow the Zipf order that the log-uniform sampler and the adaptive
+  softmax assume. The words that don't occur come last.
+
+  :param dataset:
+  :param word_lexicon: dict, word -> input id.
+  :return: dict, word -> classifier id.
+  """
+  word_count = Counter()
+  for sentence in dataset:
+    word_count.update(sentence)
+
+  words = sorted(word_lexicon.keys(), key=lambda word: (-word_count.get(word, 0), word_lexicon[word]))
+  return {word: i for i, word in enumerate(words)}
+
+
+def get_classifier_map(word_lexicon, classifier_lexicon):
+  """
+
+  :param word_lexicon: dict, word -> input id.
+  :param classifier_lexicon: dict, word -> classifier id.
+  :return: LongTensor, the classifier id of every input id.
+  """
+  classifier_map = torch.LongTensor(len(word_lexicon))
+  for word, i in word_lexicon.items():
+    classifier_map[i] = classifier_lexicon[word]
+  return classifier_map
+
+
 def get_truncated_vocab(dataset, min_count):
   """
 
@@ -344,26 +601,89 @@ def train():
   cmd.add_argument('--save_classify_layer', default=False, action='store_true',
                    help="whether to save the classify layer")
 
+  cmd.add_argument('--sort_classifier_vocab', default=False, action='store_true',
+                   help='index the classifier by word frequency, independently of the input lexicon.')
   cmd.add_argument('--valid_size', type=int, default=0, help="size of validation dataset when there's no valid.")
   cmd.add_argument('--eval_steps', required=False, type=int, help='report every xx batches.')
 
+  cmd.add_argument('--distributed', default=False, action='store_true',
+                   help='data-parallel training over gloo, launched with torchrun.')
+  cmd.add_argument('--precision', default='fp32', choices=('fp32', 'bf16'),
+                   help='bf16 to run the forward pass under bfloat16 autocast, the weights stay in fp32.')
+  cmd.add_argument('--sparse_grad', default=False, action='store_true',
+                   help='sparse gradients for the word embeddings and the sampled classifier weights, '
+                        'updated with SparseAdam when the optimizer is adam.')
+  cmd.add_argument('--checkpoint_steps', type=int, default=0,
+                   help='write a full training checkpoint every xx batches, 0 to disable.')
+  cmd.add_argument('--resume', default=False, action='store_true',
+                   help='continue the training from the checkpoint in the model directory.')
+  cmd.add_argument('--num_threads', type=int, default=0,
+                   help='the number of intra-op threads per process, 0 to split the cores between '
+                        'the local processes.')
+  cmd.add_argument('--stream_training', default=False, action='store_true',
+                   help='train on batch_size contiguous streams of the corpus, cut into chunks of max_sent_len '
+                        'tokens, carrying the forward states of the elmo encoder from one chunk to the next.')
+  cmd.add_argument('--pack_len', type=int, default=0,
+                   help='read the corpus sentence by sentence and pack the sentences into rows of this many '
+                        'tokens, 0 to break the whole text into rows of max_sent_len.')
+  cmd.add_argument('--timing_steps', type=int, default=0,
+                   help='report the tokens/sec and the time of every training stage every xx batches, '
+                        '0 to disable.')
+  cmd.add_argument('--timing_output', help='append the timing reports to this file as JSON lines.')
+  cmd.add_argument('--profile_steps', type=parse_steps,
+                   help='run torch.profiler over the batches a:b (counted from 0) and write a Chrome trace and '
+                        'summary tables to --profile_dir.')
+  cmd.add_argument('--profile_dir', help='the directory of the profile, <model>/profile by default.')
+
   opt = cmd.parse_args(sys.argv[2:])
 
+  # The processes are started by torchrun, which sets RANK, WORLD_SIZE, MASTER_ADDR and MASTER_PORT.
+  if opt.distributed:
+    torch.distributed.init_process_group(backend='gloo', init_method='env://')
+    rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+  else:
+    rank, world_size = 0, 1
+  is_master = rank == 0
+  if not is_master:
+    logging.getLogger().setLevel(logging.WARNING)
+
+  if opt.num_threads > 0:
+    torch.set_num_threads(opt.num_threads)
+  elif opt.distributed:
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+
   with open(opt.config_path, 'r') as fin:
     config = json.load(fin)
 
+  if opt.stream_training and config['encoder']['name'].lower() != 'elmo':
+    raise ValueError('--stream_training needs the stateful elmo encoder.')
+  if opt.pack_len > 0:
+    if opt.stream_training:
+      raise ValueError('--pack_len and --stream_training can\'t be used together.')
+    if config['encoder']['name'].lower() == 'lstm':
+      raise ValueError('The lstm encoder doesn\'t support --pack_len.')
+    if opt.pack_len < opt.max_sent_len:
+      raise ValueError('--pack_len should be at least max_sent_len ({}).'.format(opt.max_sent_len))
+  # DistributedDataParallel only reduces the sparse gradients of the embedding modules, the
+  # sampled softmax gathers its weight from a plain parameter.
+  if opt.distributed and opt.sparse_grad and config['classifier']['name'].lower() == 'sampled_softmax':
+    raise ValueError('--sparse_grad and --distributed can\'t be used with sampled_softmax.')
+  keep_sentences = opt.pack_len > 0
+
   # Dump configurations
   print(opt)
   print(config)
 
-  # Set seed.
-  torch.manual_seed(opt.seed)
+  # Set seed. The data order has to agree between the processes, while the negative
+  # samples and the dropout masks differ.
+  torch.manual_seed(opt.seed + rank)
   random.seed(opt.seed)
-  np.random.seed(opt.seed)
+  np.random.seed(opt.seed + rank)
   if opt.gpu >= 0:
     torch.cuda.set_device(opt.gpu)
     if opt.seed > 0:
-      torch.cuda.manual_seed(opt.seed)
+      torch.cuda.manual_seed(opt.seed + rank)
 
   use_cuda = opt.gpu >= 0 and torch.cuda.is_available()
 
@@ -372,9 +692,9 @@ def train():
 
   # Load training data.
   if token_embedder_name == 'cnn':
-    raw_training_data = read_corpus(opt.train_path, token_embedder_max_chars, opt.max_sent_len)
+    raw_training_data = read_corpus(opt.train_path, token_embedder_max_chars, opt.max_sent_len, keep_sentences)
   elif token_embedder_name == 'lstm':
-    raw_training_data = read_corpus(opt.train_path, max_sent_len=opt.max_sent_len)
+    raw_training_data = read_corpus(opt.train_path, max_sent_len=opt.max_sent_len, keep_sentences=keep_sentences)
   else:
     raise ValueError('Unknown token embedder name: {}'.format(token_embedder_name))
   logging.info('training instance: {}, training tokens: {}.'.format(
@@ -383,14 +703,15 @@ def train():
   # Load valid data if path is provided, else use 10% of training data as valid data
   if opt.valid_path is not None:
     if token_embedder_name == 'cnn':
-      raw_valid_data = read_corpus(opt.valid_path, token_embedder_max_chars, opt.max_sent_len)
+      raw_valid_data = read_corpus(opt.valid_path, token_embedder_max_chars, opt.max_sent_len, keep_sentences)
     elif token_embedder_name == 'lstm':
-      raw_valid_data = read_corpus(opt.valid_path, max_sent_len=opt.max_sent_len)
+      raw_valid_data = read_corpus(opt.valid_path, max_sent_len=opt.max_sent_len, keep_sentences=keep_sentences)
     else:
       raise ValueError('Unknown token embedder name: {}'.format(token_embedder_name))
     logging.info('valid instance: {}, valid tokens: {}.'.format(len(raw_valid_data), count_tokens(raw_valid_data)))
   elif opt.valid_size > 0:
-    raw_training_data, raw_valid_data = split_train_and_valid(raw_training_data, opt.valid_size)
+    raw_training_data, raw_valid_data = split_train_and_valid(raw_training_data, opt.valid_size,
+                                                              shuffle=not opt.stream_training)
     logging.info('training instance: {}, training tokens after division: {}.'.format(
       len(raw_training_data), count_tokens(raw_training_data)))
     logging.info('valid instance: {}, valid tokens: {}.'.format(len(raw_valid_data), count_tokens(raw_valid_data)))
@@ -400,9 +721,9 @@ def train():
   # Load test data if path is provided.
   if opt.test_path is not None:
     if token_embedder_name == 'cnn':
-      raw_test_data = read_corpus(opt.test_path, token_embedder_max_chars, opt.max_sent_len)
+      raw_test_data = read_corpus(opt.test_path, token_embedder_max_chars, opt.max_sent_len, keep_sentences)
     elif token_embedder_name == 'lstm':
-      raw_test_data = read_corpus(opt.test_path, max_sent_len=opt.max_sent_len)
+      raw_test_data = read_corpus(opt.test_path, max_sent_len=opt.max_sent_len, keep_sentences=keep_sentences)
     else:
       raise ValueError('Unknown token embedder name: {}'.format(token_embedder_name))
     logging.info('testing instance: {}, testing tokens: {}.'.format(len(raw_test_data), count_tokens(raw_test_data)))
@@ -422,6 +743,11 @@ def train():
     if special_word not in word_lexicon:
       word_lexicon[special_word] = len(word_lexicon)
 
+  if opt.word_embedding is not None and not opt.sort_classifier_vocab and \
+          config['classifier']['name'].lower() in ('sampled_softmax', 'adaptive_softmax'):
+    logging.warning('the pre-trained words come first in the lexicon, so the word ids are not sorted by '
+                    'frequency as the classifier expects. Consider --sort_classifier_vocab.')
+
   # Maintain the vocabulary. vocabulary is used in either WordEmbeddingInput or softmax classification
   vocab = get_truncated_vocab(raw_training_data, opt.min_count)
 
@@ -431,7 +757,8 @@ def train():
 
   # Word Embedding
   if config['token_embedder']['word_dim'] > 0:
-    word_emb_layer = EmbeddingLayer(config['token_embedder']['word_dim'], word_lexicon, fix_emb=False, embs=embs)
+    word_emb_layer = EmbeddingLayer(config['token_embedder']['word_dim'], word_lexicon, fix_emb=False, embs=embs,
+                                    sparse=opt.sparse_grad)
     logging.info('Word embedding size: {0}'.format(len(word_emb_layer.word2id)))
   else:
     word_emb_layer = None
@@ -457,7 +784,12 @@ def train():
     char_emb_layer = None
 
   # Create training batch
-  training_data = Batcher(raw_training_data, opt.batch_size, word_lexicon, char_lexicon, config)
+  if opt.stream_training:
+    training_data = StreamBatcher(raw_training_data, opt.batch_size, opt.max_sent_len, word_lexicon, char_lexicon,
+                                  config, rank=rank, world_size=world_size)
+  else:
+    training_data = Batcher(raw_training_data, opt.batch_size, word_lexicon, char_lexicon, config,
+                            rank=rank, world_size=world_size, seed=opt.seed, pack_len=opt.pack_len)
 
   # Set up evaluation steps.
   if opt.eval_steps is None:
@@ -465,31 +797,66 @@ def train():
   logging.info('Evaluate every {0} batches.'.format(opt.eval_steps))
 
   # If there is valid, create valid batch.
-  if raw_valid_data is not None:
-    valid_data = Batcher(
-      raw_valid_data, opt.batch_size, word_lexicon, char_lexicon, config, sort=False, shuffle=False)
+  if raw_valid_data is not None and opt.stream_training:
+    valid_data = StreamBatcher(raw_valid_data, opt.batch_size, opt.max_sent_len, word_lexicon, char_lexicon, config)
+  elif raw_valid_data is not None:
+    valid_data = Batcher(raw_valid_data, opt.batch_size, word_lexicon, char_lexicon, config,
+                         sort=False, shuffle=False, pack_len=opt.pack_len)
   else:
     valid_data = None
 
   # If there is test, create test batch.
-  if raw_test_data is not None:
-    test_data = Batcher(
-      raw_test_data, opt.batch_size, word_lexicon, char_lexicon, config, sort=False, shuffle=False)
+  if raw_test_data is not None and opt.stream_training:
+    test_data = StreamBatcher(raw_test_data, opt.batch_size, opt.max_sent_len, word_lexicon, char_lexicon, config)
+  elif raw_test_data is not None:
+    test_data = Batcher(raw_test_data, opt.batch_size, word_lexicon, char_lexicon, config,
+                        sort=False, shuffle=False, pack_len=opt.pack_len)
   else:
     test_data = None
 
-  label_to_ix = word_lexicon
+  if opt.sort_classifier_vocab:
+    label_to_ix = get_classifier_lexicon(raw_training_data, word_lexicon)
+    classifier_map = get_classifier_map(word_lexicon, label_to_ix)
+  else:
+    label_to_ix = word_lexicon
+    classifier_map = None
   logging.info('vocab size: {0}'.format(len(label_to_ix)))
   n_classes = len(label_to_ix)
 
-  model = Model(config, word_emb_layer, char_emb_layer, n_classes, use_cuda)
+  model = Model(config, word_emb_layer, char_emb_layer, n_classes, use_cuda, classifier_map, opt.sparse_grad)
 
   logging.info(str(model))
   if use_cuda:
     model = model.cuda()
 
+  checkpoint_path = os.path.join(opt.model, 'checkpoint.pt')
+  if opt.resume:
+    checkpoint = torch.load(checkpoint_path, map_location=lambda storage, loc: storage)
+    model.load_state_dict(checkpoint['model'])
+    # the sampler window and the encoder states in the checkpoint are those of the master
+    # process, the other processes start them over.
+    if is_master:
+      model.load_training_state_dict(checkpoint['training_state'])
+    training_data.load_state_dict(checkpoint['batcher'])
+    logging.info('resume from epoch {0} iter {1}.'.format(checkpoint['epoch'], checkpoint['cnt']))
+  else:
+    checkpoint = None
+
+  if opt.distributed:
+    # find_unused_parameters: the sampled classifiers only touch some of their parameters.
+    model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[opt.gpu] if use_cuda else None,
+                                                      find_unused_parameters=True, broadcast_buffers=False)
+
   need_grad = lambda x: x.requires_grad
-  if opt.optimizer.lower() == 'adam':
+  if opt.optimizer.lower() == 'adam' and opt.sparse_grad:
+    # SGD and Adagrad handle sparse gradients themselves, Adam needs SparseAdam for them.
+    sparse_parameters = get_sparse_parameters(model)
+    sparse_ids = set(id(parameter) for parameter in sparse_parameters)
+    dense_parameters = [parameter for parameter in filter(need_grad, model.parameters())
+                        if id(parameter) not in sparse_ids]
+    optimizer = MultipleOptimizer(torch.optim.Adam(dense_parameters, lr=opt.lr),
+                                  torch.optim.SparseAdam(sparse_parameters, lr=opt.lr) if sparse_parameters else None)
+  elif opt.optimizer.lower() == 'adam':
     optimizer = torch.optim.Adam(filter(need_grad, model.parameters()), lr=opt.lr)
   elif opt.optimizer.lower() == 'sgd':
     optimizer = torch.optim.SGD(filter(need_grad, model.parameters()), lr=opt.lr)
@@ -504,30 +871,49 @@ def train():
     if exception.errno != errno.EEXIST:
       raise
 
-  if config['token_embedder']['char_dim'] > 0:
-    with codecs.open(os.path.join(opt.model, 'char.dic'), 'w', encoding='utf-8') as fpo:
-      for ch, i in char_emb_layer.word2id.items():
-        print('{0}\t{1}'.format(ch, i), file=fpo)
-
-  with codecs.open(os.path.join(opt.model, 'word.dic'), 'w', encoding='utf-8') as fpo:
-    for w, i in word_lexicon.items():
-      print('{0}\t{1}'.format(w, i), file=fpo)
-
-  new_config_path = os.path.join(opt.model, os.path.basename(opt.config_path))
-  shutil.copy(opt.config_path, new_config_path)
-  opt.config_path = new_config_path
-  json.dump(vars(opt), codecs.open(os.path.join(opt.model, 'config.json'), 'w', encoding='utf-8'))
+  if is_master:
+    save_lexicons(opt, config, word_lexicon, char_lexicon, label_to_ix)
 
   best_train = 1e+8
   best_valid = 1e+8
   test_result = 1e+8
-
-  for epoch in range(opt.max_epoch):
+  start_epoch = 0
+
+  if checkpoint is not None:
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    best_train, best_valid, test_result = checkpoint['best_train'], checkpoint['best_valid'], checkpoint['test_result']
+    start_epoch = checkpoint['epoch']
+    # the checkpoint holds the random states of the master process.
+    if is_master:
+      set_rng_state(checkpoint['rng'])
+    else:
+      random.setstate(checkpoint['rng']['random'])
+      torch.manual_seed(opt.seed + rank + checkpoint['cnt'])
+      np.random.seed(opt.seed + rank + checkpoint['cnt'])
+
+  checkpointer = AsyncCheckpointWriter(checkpoint_path) if is_master and opt.checkpoint_steps > 0 else None
+
+  timer = None
+  if is_master and opt.timing_steps > 0:
+    module = model.module if opt.distributed else model
+    timer = StageTimer(use_cuda, opt.timing_output)
+    timer.add_module('token_embedder', module.token_embedder)
+    timer.add_module('encoder', module.encoder)
+    timer.add_module('classifier', module.classify_layer)
+    module.timer = timer
+
+  profiler = None
+  if is_master and opt.profile_steps is not None:
+    profiler = StepProfiler(opt.profile_steps, opt.profile_dir or os.path.join(opt.model, 'profile'), use_cuda)
+
+  for epoch in range(start_epoch, opt.max_epoch):
     best_train, best_valid, test_result = train_model(
-      epoch, opt, model, optimizer, training_data, valid_data, test_data, best_train, best_valid, test_result)
+      epoch, opt, model, optimizer, training_data, valid_data, test_data, best_train, best_valid, test_result,
+      is_master, checkpointer, checkpoint if epoch == start_epoch else None, timer, profiler)
 
     if opt.lr_decay > 0:
-      optimizer.param_groups[0]['lr'] *= opt.lr_decay
+      for param_group in optimizer.param_groups:
+        param_group['lr'] *= opt.lr_decay
 
   if raw_valid_data is None:
     logging.info("best train ppl: {:.6f}.".format(best_train))
@@ -537,27 +923,64 @@ def train():
     logging.info("best train ppl: {:.6f}, best valid ppl: {:.6f}, test ppl: {:.6f}.".format(
       best_train, best_valid, test_result))
 
+  if checkpointer is not None:
+    checkpointer.wait()
+  if timer is not None:
+    timer.close()
+  if profiler is not None:
+    profiler.stop()
 
-def test():
-  cmd = argparse.ArgumentParser('The testing components of')
-  cmd.add_argument('--gpu', default=-1, type=int, help='use id of gpu, -1 if cpu.')
-  cmd.add_argument("--input", help="the path to the raw text file.")
-  cmd.add_argument("--model", required=True, help="path to save model")
-  cmd.add_argument("--batch_size", "--batch", type=int, default=1, help='the batch size.')
-  args = cmd.parse_args(sys.argv[2:])
+  if opt.distributed:
+    torch.distributed.destroy_process_group()
 
-  if args.gpu >= 0:
-    torch.cuda.set_device(args.gpu)
-  use_cuda = args.gpu >= 0 and torch.cuda.is_available()
-  
-  args2 = dict2namedtuple(json.load(codecs.open(os.path.join(args.model, 'config.json'), 'r', encoding='utf-8')))
+
+def save_lexicons(opt, config, word_lexicon, char_lexicon, label_to_ix):
+  """
+  Write the lexicons and the configurations to the model directory.
+
+  :param opt:
+  :param config:
+  :param word_lexicon:
+  :param char_lexicon:
+  :param label_to_ix: the classifier lexicon.
+  :return:
+  """
+  if config['token_embedder']['char_dim'] > 0:
+    with codecs.open(os.path.join(opt.model, 'char.dic'), 'w', encoding='utf-8') as fpo:
+      for ch, i in char_lexicon.items():
+        print('{0}\t{1}'.format(ch, i), file=fpo)
+
+  with codecs.open(os.path.join(opt.model, 'word.dic'), 'w', encoding='utf-8') as fpo:
+    for w, i in word_lexicon.items():
+      print('{0}\t{1}'.format(w, i), file=fpo)
+
+  if opt.sort_classifier_vocab:
+    with codecs.open(os.path.join(opt.model, 'classifier.dic'), 'w', encoding='utf-8') as fpo:
+      for w, i in label_to_ix.items():
+        print('{0}\t{1}'.format(w, i), file=fpo)
+
+  new_config_path = os.path.join(opt.model, os.path.basename(opt.config_path))
+  shutil.copy(opt.config_path, new_config_path)
+  opt.config_path = new_config_path
+  json.dump(vars(opt), codecs.open(os.path.join(opt.model, 'config.json'), 'w', encoding='utf-8'))
+
+
+def load_model(model_path, use_cuda=False):
+  """
+  Load the configurations, the lexicons and the weights of a trained model.
+
+  :param model_path: str, the path to the model directory.
+  :param use_cuda: bool
+  :return: (config, model, word_lexicon, char_lexicon)
+  """
+  args2 = dict2namedtuple(json.load(codecs.open(os.path.join(model_path, 'config.json'), 'r', encoding='utf-8')))
 
   with open(args2.config_path, 'r') as fin:
     config = json.load(fin)
 
   if config['token_embedder']['char_dim'] > 0:
     char_lexicon = {}
-    with codecs.open(os.path.join(args.model, 'char.dic'), 'r', encoding='utf-8') as fpi:
+    with codecs.open(os.path.join(model_path, 'char.dic'), 'r', encoding='utf-8') as fpi:
       for line in fpi:
         tokens = line.strip().split('\t')
         if len(tokens) == 1:
@@ -571,7 +994,7 @@ def test():
     char_emb_layer = None
 
   word_lexicon = {}
-  with codecs.open(os.path.join(args.model, 'word.dic'), 'r', encoding='utf-8') as fpi:
+  with codecs.open(os.path.join(model_path, 'word.dic'), 'r', encoding='utf-8') as fpi:
     for line in fpi:
       tokens = line.strip().split('\t')
       if len(tokens) == 1:
@@ -584,14 +1007,48 @@ def test():
     logging.info('word embedding size: ' + str(len(word_emb_layer.word2id)))
   else:
     word_emb_layer = None
+
+  # For the model trained with --sort_classifier_vocab.
+  if os.path.exists(os.path.join(model_path, 'classifier.dic')):
+    classifier_lexicon = {}
+    with codecs.open(os.path.join(model_path, 'classifier.dic'), 'r', encoding='utf-8') as fpi:
+      for line in fpi:
+        tokens = line.strip().split('\t')
+        if len(tokens) == 1:
+          tokens.insert(0, '\u3000')
+        token, i = tokens
+        classifier_lexicon[token] = int(i)
+    classifier_map = get_classifier_map(word_lexicon, classifier_lexicon)
+  else:
+    classifier_map = None
   
-  model = Model(config, word_emb_layer, char_emb_layer, len(word_lexicon), use_cuda)
+  model = Model(config, word_emb_layer, char_emb_layer, len(word_lexicon), use_cuda, classifier_map)
 
   if use_cuda:
     model.cuda()
 
   logging.info(str(model))
-  model.load_model(args.model)
+  model.load_model(model_path)
+  return config, model, word_lexicon, char_lexicon
+
+
+def test():
+  cmd = argparse.ArgumentParser('The testing components of')
+  cmd.add_argument('--gpu', default=-1, type=int, help='use id of gpu, -1 if cpu.')
+  cmd.add_argument("--input", help="the path to the raw text file.")
+  cmd.add_argument("--model", required=True, help="path to save model")
+  cmd.add_argument("--batch_size", "--batch", type=int, default=1, help='the batch size.')
+  cmd.add_argument('--precision', default='fp32', choices=('fp32', 'bf16'),
+                   help='bf16 to run the forward pass under bfloat16 autocast.')
+  cmd.add_argument('--check_precision', default=False, action='store_true',
+                   help='also evaluate in fp32 and report how far the perplexity of --precision is from it.')
+  args = cmd.parse_args(sys.argv[2:])
+
+  if args.gpu >= 0:
+    torch.cuda.set_device(args.gpu)
+  use_cuda = args.gpu >= 0 and torch.cuda.is_available()
+  
+  config, model, word_lexicon, char_lexicon = load_model(args.model, use_cuda)
   if config['token_embedder']['name'].lower() == 'cnn':
     test = read_corpus(args.input, config['token_embedder']['max_characters_per_token'], max_sent_len=10000)
   elif config['token_embedder']['name'].lower() == 'lstm':
@@ -601,9 +1058,136 @@ def test():
 
   test_batch = Batcher(test, args.batch_size, word_lexicon, char_lexicon, config, sort=False, shuffle=False)
 
-  test_result = eval_model(model, test_batch)
+  # both passes start from the same (stateful) encoder states.
+  stateful = hasattr(model.encoder, 'reset_states')
+  if stateful:
+    model.encoder.reset_states()
+  test_result = eval_model(model, test_batch, precision=args.precision)
 
   logging.info("test_ppl={:.6f}".format(test_result))
+  if args.check_precision and args.precision != 'fp32':
+    if stateful:
+      model.encoder.reset_states()
+    reference = eval_model(model, test_batch)
+    logging.info("fp32 test_ppl={0:.6f}, {1} differs by {2:.4%}".format(
+      reference, args.precision, (test_result - reference) / reference))
+
+
+def finetune_model(model, train_batch, n_steps, lr, clip_grad):
+  """
+  Train the model for a few steps with Adam, e.g. after factorizing it.
+
+  :param model: Model
+  :param train_batch: Batcher
+  :param n_steps: int
+  :param lr: float
+  :param clip_grad: float
+  :return:
+  """
+  optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, model.parameters()), lr=lr)
+  model.train()
+  cnt = 0
+  while cnt < n_steps:
+    for w, c, lens, masks in train_batch.get():
+      model.zero_grad()
+      loss_forward, loss_backward = model.forward(w, c, masks)
+      loss = (loss_forward + loss_backward) / 2.0
+      loss.backward()
+      torch.nn.utils.clip_grad_norm_(model.parameters(), clip_grad)
+      optimizer.step()
+      cnt += 1
+      if cnt % 100 == 0:
+        logging.info('finetune step {0}/{1}, loss={2:.4f}'.format(cnt, n_steps, loss.item() / sum(lens)))
+      if cnt >= n_steps:
+        break
+  if model.config['classifier']['name'].lower() == 'sampled_softmax':
+    model.classify_layer.close()
+  model.eval()
+
+
+def factorize():
+  """
+  Factorize the input and the state linearities of the elmo encoder into low-rank pairs
+  for every rank, optionally fine-tune, save the factorized models and report their
+  perplexity and evaluation time against the full-rank model.
+  """
+  cmd = argparse.ArgumentParser('Factorize the LSTM linearities of a model')
+  cmd.add_argument('--gpu', default=-1, type=int, help='use id of gpu, -1 if cpu.')
+  cmd.add_argument("--model", required=True, help="path to the trained model")
+  cmd.add_argument("--output", required=True,
+                   help="path to save the factorized model, or the directory of rank<r>/ for several ranks.")
+  cmd.add_argument('--ranks', required=True, help='the ranks, separated by comma, e.g. 128,256.')
+  cmd.add_argument("--input", required=True, help="the path to the raw text file to evaluate on.")
+  cmd.add_argument("--batch_size", "--batch", type=int, default=1, help='the batch size.')
+  cmd.add_argument('--finetune_path', help='fine-tune every factorized model on this raw text file.')
+  cmd.add_argument('--finetune_steps', type=int, default=0, help='the number of fine-tuning batches.')
+  cmd.add_argument('--finetune_batch_size', type=int, default=32, help='the batch size of fine-tuning.')
+  cmd.add_argument('--max_sent_len', type=int, default=20, help='maximum sentence length of fine-tuning.')
+  cmd.add_argument('--lr', type=float, default=0.0001, help='the learning rate of fine-tuning.')
+  cmd.add_argument("--clip_grad", type=float, default=5, help='the tense of clipped grad.')
+  args = cmd.parse_args(sys.argv[2:])
+
+  if args.gpu >= 0:
+    torch.cuda.set_device(args.gpu)
+  use_cuda = args.gpu >= 0 and torch.cuda.is_available()
+  ranks = [int(rank) for rank in args.ranks.split(',')]
+  if os.path.abspath(args.output) == os.path.abspath(args.model):
+    raise ValueError('--output should differ from --model.')
+
+  config, model, word_lexicon, char_lexicon = load_model(args.model, use_cuda)
+  if config['encoder']['name'].lower() != 'elmo':
+    raise ValueError('Only the elmo encoder can be factorized.')
+  max_chars = config['token_embedder'].get('max_characters_per_token', None)
+  test = read_corpus(args.input, max_chars, max_sent_len=10000)
+  test_batch = Batcher(test, args.batch_size, word_lexicon, char_lexicon, config, sort=False, shuffle=False)
+  if args.finetune_path is not None and args.finetune_steps > 0:
+    finetune_data = read_corpus(args.finetune_path, max_chars, max_sent_len=args.max_sent_len)
+    finetune_batch = Batcher(finetune_data, args.finetune_batch_size, word_lexicon, char_lexicon, config)
+  else:
+    finetune_batch = None
+
+  def evaluate(model):
+    # every model starts from the same encoder states.
+    model.encoder.reset_states()
+    start_time = time.time()
+    ppl = eval_model(model, test_batch)
+    return ppl, time.time() - start_time
+
+  def count_parameters(module):
+    return sum(p.numel() for p in module.parameters())
+
+  ppl, elapsed = evaluate(model)
+  results = [('full', count_parameters(model.encoder), ppl, elapsed)]
+  with codecs.open(os.path.join(args.model, 'config.json'), 'r', encoding='utf-8') as fin:
+    model_config = json.load(fin)
+
+  for rank in ranks:
+    # the copy leaves out the sample producer of the sampled softmax, fine-tuning starts its own.
+    factorized = copy.deepcopy(model)
+    factorized.encoder.factorize(rank)
+    if finetune_batch is not None:
+      finetune_model(factorized, finetune_batch, args.finetune_steps, args.lr, args.clip_grad)
+    ppl, elapsed = evaluate(factorized)
+    results.append((rank, count_parameters(factorized.encoder), ppl, elapsed))
+
+    # the factorized model directory has its own copy of the configuration with `factorized_rank`.
+    output = args.output if len(ranks) == 1 else os.path.join(args.output, 'rank{}'.format(rank))
+    os.makedirs(output, exist_ok=True)
+    for filename in ('word.dic', 'char.dic', 'classifier.dic'):
+      if os.path.exists(os.path.join(args.model, filename)):
+        shutil.copy(os.path.join(args.model, filename), os.path.join(output, filename))
+    new_config_path = os.path.join(output, os.path.basename(model_config['config_path']))
+    with open(new_config_path, 'w') as fout:
+      json.dump(factorized.config, fout, indent=2)
+    json.dump(dict(model_config, config_path=new_config_path),
+              codecs.open(os.path.join(output, 'config.json'), 'w', encoding='utf-8'))
+    factorized.save_model(output, True)
+    logging.info('rank {0}: ppl={1:.4f}, saved to {2}.'.format(rank, ppl, output))
+
+  full_time = results[0][3]
+  for rank, n_params, ppl, elapsed in results:
+    logging.info('rank={0} encoder_params={1} ppl={2:.4f} time={3:.2f}s speedup={4:.2f}x'.format(
+      rank, n_params, ppl, elapsed, full_time / elapsed if elapsed > 0 else 0.0))
 
 
 if __name__ == "__main__":
@@ -611,5 +1195,7 @@ if __name__ == "__main__":
     train()
   elif len(sys.argv) > 1 and sys.argv[1] == 'test':
     test()
+  elif len(sys.argv) > 1 and sys.argv[1] == 'factorize':
+    factorize()
   else:
-    print('Usage: {0} [train|test] [options]'.format(sys.argv[0]), file=sys.stderr)
+    print('Usage: {0} [train|test|factorize] [options]'.format(sys.argv[0]), file=sys.stderr)
@@ -10,7 +10,8 @@ def create_one_batch(x: List,
                      config: Dict,
                      oov: str = '<oov>',
                      pad: str ='<pad>',
-                     sort: bool = True):
+                     sort: bool = True,
+                     packed: bool = False):
   """
 
   :param x:
@@ -20,15 +21,25 @@ def create_one_batch(x: List,
   :param oov:
   :param pad:
   :param sort:
+  :param packed: bool, every row of ``x`` is a list of segments. The segments are joined, no
+    target crosses their boundaries, and ``masks[3]`` is 1 at the first token of every segment
+    and at the first padding position.
   :return:
   """
   batch_size = len(x)
+  if packed:
+    segment_lens = [[len(segment) for segment in x_i] for x_i in x]
+    x = [[token for segment in x_i for token in segment] for x_i in x]
+  else:
+    segment_lens = [[len(x_i)] for x_i in x]
+
   lst = list(range(batch_size))
   if sort:
     lst.sort(key=lambda l: -len(x[l]))
 
   x = [x[i] for i in lst]
-  lens = [len(x[i]) for i in lst]
+  segment_lens = [segment_lens[i] for i in lst]
+  lens = [len(x_i) for x_i in x]
   max_len = max(lens)
 
   if word2id is not None:
@@ -68,13 +79,24 @@ def create_one_batch(x: List,
     batch_c = None
 
   masks = [torch.LongTensor(batch_size, max_len).fill_(0), [], []]
+  segment_starts = torch.LongTensor(batch_size, max_len).fill_(0)
 
   for i, x_i in enumerate(x):
+    starts = set()
+    start = 0
+    for segment_len in segment_lens[i]:
+      starts.add(start)
+      start += segment_len
+    for start in starts:
+      segment_starts[i][start] = 1
+    if len(x_i) < max_len:
+      segment_starts[i][len(x_i)] = 1
+
     for j in range(len(x_i)):
       masks[0][i][j] = 1
-      if j + 1 < len(x_i):
+      if j + 1 < len(x_i) and j + 1 not in starts:
         masks[1].append(i * max_len + j)
-      if j > 0:
+      if j > 0 and j not in starts:
         masks[2].append(i * max_len + j)
 
   assert len(masks[1]) <= batch_size * max_len
@@ -82,10 +104,39 @@ def create_one_batch(x: List,
 
   masks[1] = torch.LongTensor(masks[1])
   masks[2] = torch.LongTensor(masks[2])
+  if packed:
+    masks.append(segment_starts)
 
   return batch_w, batch_c, lens, masks
 
 
+def pack_sentences(data: List, pack_len: int) -> List:
+  """
+  Pack the sentences into rows of at most ``pack_len`` tokens with best-fit decreasing: the
+  longest sentences are placed first, each of them into the fullest row that still has room.
+
+  :param data: the sentences, none of them longer than ``pack_len``.
+  :param pack_len: int
+  :return: the rows, each of them a list of sentences.
+  """
+  rows = []
+  # the ids of the rows by the number of tokens they still have room for.
+  rows_by_room = [[] for _ in range(pack_len + 1)]
+  for sentence in sorted(data, key=lambda x: -len(x)):
+    length = len(sentence)
+    if length > pack_len:
+      raise ValueError('a sentence of {0} tokens doesn\'t fit in a row of {1}.'.format(length, pack_len))
+    room = next((room for room in range(length, pack_len + 1) if len(rows_by_room[room]) > 0), None)
+    if room is None:
+      row_id, room = len(rows), pack_len
+      rows.append([])
+    else:
+      row_id = rows_by_room[room].pop()
+    rows[row_id].append(sentence)
+    rows_by_room[room - length].append(row_id)
+  return rows
+
+
 class Batcher(object):
   def __init__(self,
                data: List,
@@ -95,7 +146,28 @@ class Batcher(object):
                config: Dict,
                perm: bool = None,
                shuffle: bool = True,
-               sort: bool = True):
+               sort: bool = True,
+               rank: int = 0,
+               world_size: int = 1,
+               seed: int = 1,
+               pack_len: int = 0):
+    """
+
+    :param data:
+    :param batch_size:
+    :param word2id:
+    :param char2id:
+    :param config:
+    :param perm:
+    :param shuffle:
+    :param sort:
+    :param rank: int, the rank of this process in distributed training.
+    :param world_size: int, the number of processes. Every process gets the same number of
+      batches, so the last ``nbatch % world_size`` batches of an epoch are dropped.
+    :param seed: int, the seed of the batch order, which has to agree between the processes.
+    :param pack_len: int, pack several sentences into every row of this many tokens, see
+      ``pack_sentences``. 0 for one sentence per row.
+    """
     self.batch_size = batch_size
     self.word2id = word2id
     self.char2id = char2id
@@ -103,27 +175,159 @@ class Batcher(object):
     self.perm = perm
     self.shuffle = shuffle
     self.sort = sort
+    self.rank = rank
+    self.world_size = world_size
+    # the batch order doesn't consume the global random state, so all the processes
+    # shuffle in the same way.
+    self.random = random.Random(seed) if world_size > 1 else random
+    # the batch order of the current epoch and the number of batches already yielded.
+    self.epoch_ids = None
+    self.batch_ids = None
+    self.position = 0
+    self.resumed = False
+    self.packed = pack_len > 0
 
+    if self.packed:
+      data = pack_sentences(data, pack_len)
     lst = perm or list(range(len(data)))
     if shuffle:
       random.shuffle(lst)
 
-    if sort:
+    # the packed rows are all about as long.
+    if sort and not self.packed:
       lst.sort(key=lambda l: -len(data[l]))
 
     self.sorted_data = [data[i] for i in lst]
     self.nbatch = (len(data) - 1) // batch_size + 1
 
   def get(self):
-    batch_ids = list(range(self.nbatch))
-    if self.shuffle:
-      random.shuffle(batch_ids)
+    if self.resumed:
+      # continue the epoch restored by `load_state_dict`.
+      self.resumed = False
+    else:
+      epoch_ids = list(range(self.nbatch))
+      if self.shuffle:
+        self.random.shuffle(epoch_ids)
+      self.epoch_ids = epoch_ids
+      self.batch_ids = self.slice_batch_ids(epoch_ids)
+      self.position = 0
 
-    for i in batch_ids:
+    while self.position < len(self.batch_ids):
+      i = self.batch_ids[self.position]
+      self.position += 1
       start_id, end_id = i * self.batch_size, (i + 1) * self.batch_size
       bw, bc, blens, bmasks = create_one_batch(self.sorted_data[start_id: end_id], self.word2id, self.char2id,
-                                               self.config, sort=self.sort)
+                                               self.config, sort=self.sort, packed=self.packed)
       yield bw, bc, blens, bmasks
 
+  def slice_batch_ids(self, epoch_ids):
+    """
+    The batches of this process out of the batch order of the epoch, which all the processes share.
+
+    :param epoch_ids: list[int]
+    :return: list[int]
+    """
+    if self.world_size > 1:
+      return epoch_ids[self.rank: self.num_batches() * self.world_size: self.world_size]
+    return epoch_ids
+
+  def state_dict(self):
+    """
+    The batch order of the current epoch, shared by all the processes, and the position in
+    it. The sentences are sorted deterministically in the constructor, so they are not saved.
+
+    :return: dict
+    """
+    state = {'epoch_ids': self.epoch_ids, 'position': self.position}
+    if isinstance(self.random, random.Random):
+      state['random'] = self.random.getstate()
+    return state
+
+  def load_state_dict(self, state):
+    """
+    Make the next `get` continue the saved epoch.
+
+    :param state: dict, from `state_dict` of any process, the batches of this process are
+      sliced out of the saved order.
+    :return:
+    """
+    self.epoch_ids = state['epoch_ids']
+    self.batch_ids = None if self.epoch_ids is None else self.slice_batch_ids(self.epoch_ids)
+    self.position = state['position']
+    self.resumed = self.batch_ids is not None
+    if 'random' in state and isinstance(self.random, random.Random):
+      self.random.setstate(state['random'])
+
+  def num_batches(self):
+    return self.nbatch // self.world_size if self.world_size > 1 else self.nbatch
+
+
+class StreamBatcher(object):
+  def __init__(self,
+               data: List,
+               batch_size: int,
+               chunk_len: int,
+               word2id: Dict,
+               char2id: Dict,
+               config: Dict,
+               rank: int = 0,
+               world_size: int = 1):
+    """
+    Cut the corpus into ``batch_size`` contiguous streams and yield their consecutive
+    chunks, so that row i of batch k + 1 continues row i of batch k. The batch order is
+    fixed, and a stateful encoder carries its state from one chunk to the next. As in
+    truncated BPTT, a chunk ends with the first token of the next one, so that the last
+    token of every chunk gets its forward target.
+
+    :param data: the pieces of the corpus in order, they are joined back into one stream.
+    :param batch_size: int, the number of streams.
+    :param chunk_len: int, the number of forward targets of a chunk, which holds one token
+      more. The last chunk of an epoch also takes the remaining tokens.
+    :param word2id:
+    :param char2id:
+    :param config:
+    :param rank: int, the rank of this process in distributed training.
+    :param world_size: int, the number of processes, each of them gets its own streams.
+    """
+    self.batch_size = batch_size
+    self.chunk_len = chunk_len
+    self.word2id = word2id
+    self.char2id = char2id
+    self.config = config
+    self.position = 0
+    self.resumed = False
+
+    tokens = [token for sentence in data for token in sentence]
+    n_streams = batch_size * world_size
+    # the tokens that don't fill the last row are dropped.
+    self.stream_len = len(tokens) // n_streams
+    if self.stream_len == 0:
+      raise ValueError('{0} tokens are not enough for {1} streams.'.format(len(tokens), n_streams))
+    self.streams = [tokens[i * self.stream_len: (i + 1) * self.stream_len]
+                    for i in range(rank * batch_size, (rank + 1) * batch_size)]
+    # the chunks overlap by one token.
+    self.nbatch = max((self.stream_len - 1) // chunk_len, 1)
+
+  def get(self):
+    if self.resumed:
+      self.resumed = False
+    else:
+      self.position = 0
+
+    while self.position < self.nbatch:
+      start_id = self.position * self.chunk_len
+      end_id = self.stream_len if self.position == self.nbatch - 1 else start_id + self.chunk_len + 1
+      self.position += 1
+      bw, bc, blens, bmasks = create_one_batch([stream[start_id: end_id] for stream in self.streams],
+                                               self.word2id, self.char2id, self.config, sort=False)
+      yield bw, bc, blens, bmasks
+
+  def state_dict(self):
+    return {'position': self.position}
+
+  def load_state_dict(self, state):
+    self.position = state['position']
+    self.resumed = True
+
   def num_batches(self):
     return self.nbatch
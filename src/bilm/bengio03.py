@@ -6,6 +6,49 @@ from modules.highway import Highway
 from modules.positional_encoding import PositionalEncoding
 from modules.positionwise_feedforward import PositionwiseFeedForward
 from modules.sublayer_connection import SublayerConnection
+from modules.util import checkpoint_layer
+from bilm.lbl import segment_bounds, gather_windows
+
+
+def window_projection(inputs: torch.Tensor, linear: torch.nn.Linear, width: int) -> torch.Tensor:
+  """
+  Apply ``linear`` to the flattened window of ``width + 1`` consecutive positions starting at
+  every step, as a single conv1d. The ``(width + 1) * dim`` input features of ``linear`` are
+  laid out step by step, so its weight is just reshaped into the conv1d kernel and existing
+  checkpoints keep working.
+
+  :param inputs: [batch_size, seq_len + width, dim]
+  :param linear: torch.nn.Linear((width + 1) * dim, hidden_size)
+  :param width: int
+  :return: [batch_size, seq_len, hidden_size]
+  """
+  dim = inputs.size(-1)
+  if not isinstance(linear, torch.nn.Linear):
+    # e.g. a quantized linear, whose weight can't be reshaped: apply it to the unfolded windows.
+    batch_size, padded_len, _ = inputs.size()
+    windows = inputs.unfold(1, width + 1, 1).transpose(2, 3)
+    return linear(windows.reshape(batch_size, padded_len - width, (width + 1) * dim))
+  weight = linear.weight.view(linear.out_features, width + 1, dim).transpose(1, 2)
+  outputs = torch.nn.functional.conv1d(inputs.transpose(1, 2), weight, linear.bias)
+  return outputs.transpose(1, 2)
+
+
+def packed_window_projection(inputs: torch.Tensor, paddings: torch.Tensor, linear: torch.nn.Linear,
+                             starts: torch.Tensor, ends: torch.Tensor, left_to_right: bool = True) -> torch.Tensor:
+  """
+  ``window_projection`` over the windows of ``gather_windows``.
+
+  :param inputs: [batch_size, seq_len, dim]
+  :param paddings: [width, dim]
+  :param linear: torch.nn.Linear((width + 1) * dim, hidden_size)
+  :param starts: [batch_size, seq_len]
+  :param ends: [batch_size, seq_len]
+  :param left_to_right: bool
+  :return: [batch_size, seq_len, hidden_size]
+  """
+  batch_size, seq_len, dim = inputs.size()
+  windows = gather_windows(inputs, paddings, paddings.size(0), starts, ends, left_to_right)
+  return linear(windows.view(batch_size, seq_len, -1))
 
 
 class Bengio03HighwayBiLm(torch.nn.Module):
@@ -14,6 +57,7 @@ class Bengio03HighwayBiLm(torch.nn.Module):
     self.config = config
     self.use_cuda = use_cuda
     self.use_position = config['encoder'].get('position', False)
+    self.checkpoint_layers = config['encoder'].get('checkpoint_layers', False)
     self.n_layers = n_layers = config['encoder']['n_layers']
     self.n_highway = n_highway = config['encoder']['n_highway']
 
@@ -47,45 +91,69 @@ class Bengio03HighwayBiLm(torch.nn.Module):
     if self.use_position:
       self.position = PositionalEncoding(hidden_size, self.config['dropout'])
 
-  def forward(self, inputs):
+  def layer_forward(self, i, last_forward_inputs, last_backward_inputs, starts=None, ends=None, positions=None):
     """
-
-    :param inputs:
-    :return:
+    The i-th layer of both directions.
+
+    :param i: int
+    :param last_forward_inputs: [batch_size, seq_len, dim]
+    :param last_backward_inputs: [batch_size, seq_len, dim]
+    :param starts: [batch_size, seq_len], from ``segment_bounds`` when the segments are packed.
+    :param ends: [batch_size, seq_len], from ``segment_bounds`` when the segments are packed.
+    :param positions: [batch_size, seq_len], the position of every step in its segment.
+    :return: ([batch_size, seq_len, hidden_size], [batch_size, seq_len, hidden_size])
     """
-    batch_size, sequence_len, dim = inputs.size()
-    all_layers_along_steps = []
-
-    last_forward_inputs = inputs
-    last_backward_inputs = inputs
-    for i in range(self.n_layers):
-      if self.use_position:
-        last_forward_inputs = self.position(last_forward_inputs)
-        last_backward_inputs = self.position(last_backward_inputs)
+    batch_size, sequence_len, _ = last_forward_inputs.size()
+    if self.use_position:
+      last_forward_inputs = self.position(last_forward_inputs, positions)
+      last_backward_inputs = self.position(last_backward_inputs, positions)
 
+    if starts is None:
+      # The forward window of step t covers [t - width, t], the backward one [t, t + width],
+      # so each direction only needs the padding on its own side.
       padded_last_forward_inputs = torch.cat([self.forward_paddings[i].expand(batch_size, -1, -1),
-                                              last_forward_inputs,
-                                              self.backward_paddings[i].expand(batch_size, -1, -1)], dim=1)
-      padded_last_backward_inputs = torch.cat([self.forward_paddings[i].expand(batch_size, -1, -1),
-                                               last_backward_inputs,
+                                              last_forward_inputs], dim=1)
+      padded_last_backward_inputs = torch.cat([last_backward_inputs,
                                                self.backward_paddings[i].expand(batch_size, -1, -1)], dim=1)
+      forward_output = window_projection(padded_last_forward_inputs, self.forward_projects[i], self.width)
+      backward_output = window_projection(padded_last_backward_inputs, self.backward_projects[i], self.width)
+    else:
+      forward_output = packed_window_projection(last_forward_inputs, self.forward_paddings[i],
+                                                self.forward_projects[i], starts, ends)
+      backward_output = packed_window_projection(last_backward_inputs, self.backward_paddings[i],
+                                                 self.backward_projects[i], starts, ends, left_to_right=False)
 
-      forward_steps, backward_steps = [], []
-      for start in range(sequence_len):
-        end = start + self.width
-        forward_input = padded_last_forward_inputs.narrow(1, start, self.width + 1).contiguous().view(batch_size, -1)
-        forward_output = self.activation(self.dropout(self.forward_projects[i](forward_input)))
-        forward_output = self.forward_blocks[i](forward_output)
+    forward_output = self.activation(self.dropout(forward_output))
+    forward_output = self.forward_blocks[i](forward_output.contiguous().view(-1, self.hidden_size))
 
-        backward_input = padded_last_backward_inputs.narrow(1, end, self.width + 1).contiguous().view(batch_size, -1)
-        backward_output = self.activation(self.dropout(self.backward_projects[i](backward_input)))
-        backward_output = self.backward_blocks[i](backward_output)
+    backward_output = self.activation(self.dropout(backward_output))
+    backward_output = self.backward_blocks[i](backward_output.contiguous().view(-1, self.hidden_size))
 
-        forward_steps.append(forward_output)
-        backward_steps.append(backward_output)
+    last_forward_inputs = forward_output.view(batch_size, sequence_len, self.hidden_size)
+    last_backward_inputs = backward_output.view(batch_size, sequence_len, self.hidden_size)
+    return last_forward_inputs, last_backward_inputs
 
-      last_forward_inputs = torch.stack(forward_steps, dim=1)
-      last_backward_inputs = torch.stack(backward_steps, dim=1)
+  def forward(self, inputs, segment_starts=None):
+    """
+
+    :param inputs: [batch_size, seq_len, dim]
+    :param segment_starts: [batch_size, seq_len], 1 at the first step of every segment when several
+      sentences are packed into a row, so that the windows don't cross the segments.
+    :return: [n_layers, batch_size, seq_len, 2 * hidden_size]
+    """
+    batch_size, sequence_len, dim = inputs.size()
+    all_layers_along_steps = []
+    starts, ends, positions = None, None, None
+    if segment_starts is not None:
+      starts, ends = segment_bounds(segment_starts)
+      positions = torch.arange(sequence_len, device=inputs.device).unsqueeze(0) - starts
+
+    last_forward_inputs = inputs
+    last_backward_inputs = inputs
+    for i in range(self.n_layers):
+      last_forward_inputs, last_backward_inputs = checkpoint_layer(
+        self.layer_forward, i, last_forward_inputs, last_backward_inputs, starts, ends, positions,
+        enabled=self.checkpoint_layers)
 
       all_layers_along_steps.append(torch.cat([last_forward_inputs, last_backward_inputs], dim=-1))
 
@@ -98,6 +166,7 @@ class Bengio03ResNetBiLm(torch.nn.Module):
     self.config = config
     self.use_cuda = use_cuda
     self.use_position = config['encoder'].get('position', False)
+    self.checkpoint_layers = config['encoder'].get('checkpoint_layers', False)
     self.n_layers = n_layers = config['encoder']['n_layers']
 
     self.dropout = torch.nn.Dropout(self.config['dropout'])
@@ -132,45 +201,67 @@ class Bengio03ResNetBiLm(torch.nn.Module):
     self.right_blocks = torch.nn.ModuleList(
       [SublayerConnection(hidden_size, self.config['dropout']) for _ in range(n_layers)])
 
-  def forward(self, inputs):
+    if self.use_position:
+      self.position = PositionalEncoding(hidden_size, self.config['dropout'])
+
+  def layer_forward(self, i, last_forward_inputs, last_backward_inputs, starts=None, ends=None, positions=None):
+    """
+    The i-th layer of both directions.
+
+    :param i: int
+    :param last_forward_inputs: [batch_size, seq_len, dim]
+    :param last_backward_inputs: [batch_size, seq_len, dim]
+    :param starts: [batch_size, seq_len], from ``segment_bounds`` when the segments are packed.
+    :param ends: [batch_size, seq_len], from ``segment_bounds`` when the segments are packed.
+    :param positions: [batch_size, seq_len], the position of every step in its segment.
+    :return: ([batch_size, seq_len, hidden_size], [batch_size, seq_len, hidden_size])
+    """
+    batch_size, sequence_len, _ = last_forward_inputs.size()
+    if self.use_position:
+      last_forward_inputs = self.position(last_forward_inputs, positions)
+      last_backward_inputs = self.position(last_backward_inputs, positions)
+
+    if starts is None:
+      padded_last_forward_inputs = torch.cat([self.forward_paddings[i].expand(batch_size, -1, -1),
+                                              last_forward_inputs], dim=1)
+      padded_last_backward_inputs = torch.cat([last_backward_inputs,
+                                               self.backward_paddings[i].expand(batch_size, -1, -1)], dim=1)
+      forward_output = window_projection(padded_last_forward_inputs, self.forward_projects[i], self.width)
+      backward_output = window_projection(padded_last_backward_inputs, self.backward_projects[i], self.width)
+    else:
+      forward_output = packed_window_projection(last_forward_inputs, self.forward_paddings[i],
+                                                self.forward_projects[i], starts, ends)
+      backward_output = packed_window_projection(last_backward_inputs, self.backward_paddings[i],
+                                                 self.backward_projects[i], starts, ends, left_to_right=False)
+
+    forward_output = self.activation(self.dropout(forward_output))
+    last_forward_inputs = self.left_blocks[i](forward_output, self.left_linears[i])
+
+    backward_output = self.activation(self.dropout(backward_output))
+    last_backward_inputs = self.right_blocks[i](backward_output, self.right_linears[i])
+    return last_forward_inputs, last_backward_inputs
+
+  def forward(self, inputs, segment_starts=None):
     """
 
-    :param inputs:
-    :return:
+    :param inputs: [batch_size, seq_len, dim]
+    :param segment_starts: [batch_size, seq_len], 1 at the first step of every segment when several
+      sentences are packed into a row, so that the windows don't cross the segments.
+    :return: [n_layers, batch_size, seq_len, 2 * hidden_size]
     """
     batch_size, sequence_len, dim = inputs.size()
     all_layers_along_steps = []
+    starts, ends, positions = None, None, None
+    if segment_starts is not None:
+      starts, ends = segment_bounds(segment_starts)
+      positions = torch.arange(sequence_len, device=inputs.device).unsqueeze(0) - starts
 
     last_forward_inputs = inputs
     last_backward_inputs = inputs
     for i in range(self.n_layers):
-      if self.use_position:
-        last_forward_inputs = self.position(last_forward_inputs)
-        last_backward_inputs = self.position(last_backward_inputs)
-
-      padded_last_forward_inputs = torch.cat([self.forward_paddings[i].expand(batch_size, -1, -1),
-                                              last_forward_inputs,
-                                              self.backward_paddings[i].expand(batch_size, -1, -1)], dim=1)
-      padded_last_backward_inputs = torch.cat([self.forward_paddings[i].expand(batch_size, -1, -1),
-                                               last_backward_inputs,
-                                               self.backward_paddings[i].expand(batch_size, -1, -1)], dim=1)
-
-      forward_steps, backward_steps = [], []
-      for start in range(sequence_len):
-        end = start + self.width
-        forward_input = padded_last_forward_inputs.narrow(1, start, self.width + 1).contiguous().view(batch_size, -1)
-        forward_output = self.activation(self.dropout(self.forward_projects[i](forward_input)))
-        forward_output = self.forward_blocks[i](forward_output, self.forward_linears[i])
-
-        backward_input = padded_last_backward_inputs.narrow(1, end, self.width + 1).contiguous().view(batch_size, -1)
-        backward_output = self.activation(self.dropout(self.backward_projects[i](backward_input)))
-        backward_output = self.backward_blocks[i](backward_output, self.backwarrd_linears[i])
-
-        forward_steps.append(forward_output)
-        backward_steps.append(backward_output)
-
-      last_forward_inputs = torch.stack(forward_steps, dim=1)
-      last_backward_inputs = torch.stack(backward_steps, dim=1)
+      last_forward_inputs, last_backward_inputs = checkpoint_layer(
+        self.layer_forward, i, last_forward_inputs, last_backward_inputs, starts, ends, positions,
+        enabled=self.checkpoint_layers)
 
       all_layers_along_steps.append(torch.cat([last_forward_inputs, last_backward_inputs], dim=-1))
 
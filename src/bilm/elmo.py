@@ -1,16 +1,35 @@
 from typing import Optional, Tuple, List, Union
 
 import torch
-from torch.nn.utils.rnn import PackedSequence, pad_packed_sequence
+from torch.nn.utils.rnn import PackedSequence, pack_padded_sequence, pad_packed_sequence
 from torch.autograd import Variable
 
 from bilm.encoder_base import _EncoderBase
 from modules.lstm_cell_with_projection import LstmCellWithProjection
+from modules.util import checkpoint_layer
+from modules.low_rank_linear import LowRankLinear
 
 RnnState = Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]  # pylint: disable=invalid-name
 RnnStateStorage = Tuple[torch.Tensor, ...]  # pylint: disable=invalid-name
 
 
+def reverse_padded_sequence(inputs: torch.Tensor, lengths: torch.Tensor) -> torch.Tensor:
+  """
+  Reverse every row of a batch-first padded tensor within its own length, the padding
+  positions stay where they are. Applying it twice gives back the input.
+
+  :param inputs: [batch_size, total_timesteps, dim]
+  :param lengths: [batch_size]
+  :return: [batch_size, total_timesteps, dim]
+  """
+  total_timesteps = inputs.size(1)
+  timesteps = torch.arange(total_timesteps).unsqueeze(0)
+  lengths = torch.as_tensor(lengths).long().unsqueeze(1)
+  indices = torch.where(timesteps < lengths, lengths - 1 - timesteps, timesteps)
+  indices = indices.to(inputs.device).unsqueeze(2).expand_as(inputs)
+  return inputs.gather(1, indices)
+
+
 class ElmobiLm(_EncoderBase):
   def __init__(self, config, use_cuda=False):
     super(ElmobiLm, self).__init__(stateful=True)
@@ -23,11 +42,14 @@ class ElmobiLm(_EncoderBase):
     memory_cell_clip_value = config['encoder']['cell_clip']
     state_projection_clip_value = config['encoder']['proj_clip']
     recurrent_dropout_probability = config['dropout']
+    factorized_rank = config['encoder'].get('factorized_rank', 0)
 
     self.input_size = input_size
     self.hidden_size = hidden_size
     self.num_layers = num_layers
     self.cell_size = cell_size
+    # recompute the timesteps of every layer in the backward pass instead of keeping them.
+    self.checkpoint_layers = config['encoder'].get('checkpoint_layers', False)
     
     forward_layers = []
     backward_layers = []
@@ -41,14 +63,16 @@ class ElmobiLm(_EncoderBase):
                                              go_forward,
                                              recurrent_dropout_probability,
                                              memory_cell_clip_value,
-                                             state_projection_clip_value)
+                                             state_projection_clip_value,
+                                             factorized_rank)
       backward_layer = LstmCellWithProjection(lstm_input_size,
                                               hidden_size,
                                               cell_size,
                                               not go_forward,
                                               recurrent_dropout_probability,
                                               memory_cell_clip_value,
-                                              state_projection_clip_value)
+                                              state_projection_clip_value,
+                                              factorized_rank)
       lstm_input_size = hidden_size
 
       self.add_module('forward_layer_{}'.format(layer_index), forward_layer)
@@ -58,10 +82,87 @@ class ElmobiLm(_EncoderBase):
     self.forward_layers = forward_layers
     self.backward_layers = backward_layers
 
-  def forward(self, inputs, mask):
+    # Pairs of (forward, backward) ``torch.nn.LSTM``, filled by ``build_native_lstm``.
+    self.native_layers = None
+
+  def build_native_lstm(self):
+    """
+    Copy the weights of every ``LstmCellWithProjection`` into a ``torch.nn.LSTM`` with
+    ``proj_size``, which is then used instead of the python loop over timesteps when the
+    encoder is in evaluation mode. The native LSTM applies neither ``cell_clip`` nor
+    ``proj_clip``, so it only reproduces the reference outputs when the activations stay
+    inside the clip range (``gen_elmo.py validate_native`` reports the deviation).
+
+    The native layers are a snapshot: they are not registered as sub-modules (so
+    ``encoder.pkl`` is unchanged) and have to be rebuilt after the weights change.
+    """
+    native_layers = []
+    for layer_index in range(self.num_layers):
+      pair = []
+      for layer in (self.forward_layers[layer_index], self.backward_layers[layer_index]):
+        # the weights of the quantized linearities are not tensors.
+        if not isinstance(getattr(layer.input_linearity, 'weight', None), torch.Tensor):
+          raise ValueError('The native LSTM can\'t be built from a quantized encoder.')
+        lstm = torch.nn.LSTM(layer.input_size, layer.cell_size, batch_first=True, proj_size=layer.hidden_size)
+        lstm = lstm.to(layer.state_linearity.weight.device)
+        with torch.no_grad():
+          # Both implementations order the gates as (input, forget, memory, output).
+          lstm.weight_ih_l0.copy_(layer.input_linearity.weight)
+          lstm.bias_ih_l0.fill_(0.0)
+          lstm.weight_hh_l0.copy_(layer.state_linearity.weight)
+          lstm.bias_hh_l0.copy_(layer.state_linearity.bias)
+          lstm.weight_hr_l0.copy_(layer.state_projection.weight)
+        lstm.eval()
+        pair.append(lstm)
+      native_layers.append(tuple(pair))
+    self.native_layers = native_layers
+
+  def factorize(self, rank):
+    """
+    Replace the input and the state linearities of every cell with the truncated SVD of
+    their weights, see ``LowRankLinear``. ``factorized_rank`` is set in the encoder
+    configuration, so that the saved encoder is loaded in the factorized form.
+
+    :param rank: int
+    """
+    for layer in self.forward_layers + self.backward_layers:
+      layer.input_linearity = LowRankLinear.from_linear(layer.input_linearity, rank)
+      layer.state_linearity = LowRankLinear.from_linear(layer.state_linearity, rank)
+    self.config['encoder']['factorized_rank'] = rank
+    self.native_layers = None
+
+  def reset_backward_states(self):
+    """
+    Zero the states of the backward layers and keep those of the forward layers. The
+    backward layers run from right to left, so their final states belong to the start of
+    a chunk and can't be carried over to the next chunk of a stream.
+    """
+    if self._states is None:
+      return
+    hidden_state, memory_state = self._states
+    hidden_state = torch.cat([hidden_state[:, :, :self.hidden_size],
+                              hidden_state.new_zeros(hidden_state.size(0), hidden_state.size(1), self.hidden_size)], -1)
+    memory_state = torch.cat([memory_state[:, :, :self.cell_size],
+                              memory_state.new_zeros(memory_state.size(0), memory_state.size(1), self.cell_size)], -1)
+    self._states = (hidden_state, memory_state)
+
+  @torch.profiler.record_function('ElmobiLm')
+  def forward(self, inputs, mask, segment_starts=None):
+    """
+
+    :param inputs: [batch_size, seq_len, input_size]
+    :param mask: [batch_size, seq_len]
+    :param segment_starts: [batch_size, seq_len], 1 at the first token of every segment when
+      several sentences are packed into a row. The states are reset at the segment boundaries.
+    :return: [num_layers, batch_size, seq_len, 2 * hidden_size]
+    """
     batch_size, total_sequence_length = mask.size()
+    if self.native_layers is not None and not self.training and segment_starts is None:
+      module = self._native_lstm_forward
+    else:
+      module = self._lstm_forward
     stacked_sequence_output, final_states, restoration_indices = \
-      self.sort_and_run_forward(self._lstm_forward, inputs, mask)
+      self.sort_and_run_forward(module, inputs, mask, segment_starts=segment_starts)
 
     num_layers, num_valid, returned_timesteps, encoder_dim = stacked_sequence_output.size()
     # Add back invalid rows which were removed in the call to sort_and_run_forward.
@@ -103,7 +204,8 @@ class ElmobiLm(_EncoderBase):
 
   def _lstm_forward(self, 
                     inputs: PackedSequence,
-                    initial_state: Optional[Tuple[torch.Tensor, torch.Tensor]] = None) -> \
+                    initial_state: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+                    segment_starts: Optional[torch.Tensor] = None) -> \
       Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
     """
     Parameters
@@ -114,6 +216,8 @@ class ElmobiLm(_EncoderBase):
       A tuple (state, memory) representing the initial hidden state and memory
       of the LSTM, with shape (num_layers, batch_size, 2 * hidden_size) and
       (num_layers, batch_size, 2 * cell_size) respectively.
+    segment_starts : ``torch.Tensor``, optional, (default = None)
+      A tensor of shape (batch_size, sequence_length), 1 at the first token of every segment.
     Returns
     -------
     output_sequence : ``torch.FloatTensor``
@@ -138,6 +242,17 @@ class ElmobiLm(_EncoderBase):
     forward_output_sequence = inputs
     backward_output_sequence = inputs
 
+    if segment_starts is None:
+      forward_resets, backward_resets = None, None
+    else:
+      # The forward layers reset at the first token of every segment, the backward
+      # layers at the last one, so the rows never carry a state into their segments.
+      batch_size, total_timesteps = inputs.size(0), inputs.size(1)
+      forward_resets = segment_starts[:, :total_timesteps].to(inputs.dtype)
+      forward_resets[:, 0] = 1.0
+      backward_resets = torch.cat([forward_resets[:, 1:], forward_resets.new_ones(batch_size, 1)], dim=1)
+      backward_resets[torch.arange(batch_size), batch_lengths.long() - 1] = 1.0
+
     final_states = []
     sequence_outputs = []
     for layer_index, state in enumerate(hidden_states):
@@ -156,12 +271,18 @@ class ElmobiLm(_EncoderBase):
         forward_state = None
         backward_state = None
 
-      forward_output_sequence, forward_state = forward_layer(forward_output_sequence,
-                                                             batch_lengths,
-                                                             forward_state)
-      backward_output_sequence, backward_state = backward_layer(backward_output_sequence,
+      forward_output_sequence, forward_state = checkpoint_layer(forward_layer,
+                                                                forward_output_sequence,
                                                                 batch_lengths,
-                                                                backward_state)
+                                                                forward_state,
+                                                                forward_resets,
+                                                                enabled=self.checkpoint_layers)
+      backward_output_sequence, backward_state = checkpoint_layer(backward_layer,
+                                                                  backward_output_sequence,
+                                                                  batch_lengths,
+                                                                  backward_state,
+                                                                  backward_resets,
+                                                                  enabled=self.checkpoint_layers)
       # Skip connections, just adding the input to the output.
       if layer_index != 0:
         forward_output_sequence += forward_cache
@@ -183,3 +304,79 @@ class ElmobiLm(_EncoderBase):
                              torch.FloatTensor] = (torch.cat(final_hidden_states, 0),
                                                    torch.cat(final_memory_states, 0))
     return stacked_sequence_outputs, final_state_tuple
+
+  def _native_lstm_forward(self,
+                           inputs: PackedSequence,
+                           initial_state: Optional[Tuple[torch.Tensor, torch.Tensor]] = None) -> \
+      Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
+    """
+    The same computation as ``_lstm_forward`` (without clipping), run with the native
+    LSTMs built by ``build_native_lstm``. The backward LSTM runs over the sequences
+    reversed within their lengths.
+    """
+    if initial_state is None:
+      hidden_states: List[Optional[Tuple[torch.Tensor,
+                                   torch.Tensor]]] = [None] * len(self.native_layers)
+    elif initial_state[0].size()[0] != len(self.native_layers):
+      raise Exception("Initial states were passed to forward() but the number of "
+                      "initial states does not match the number of layers.")
+    else:
+      hidden_states = list(zip(initial_state[0].split(1, 0), initial_state[1].split(1, 0)))
+
+    inputs, batch_lengths = pad_packed_sequence(inputs, batch_first=True)
+    forward_output_sequence = inputs
+    backward_output_sequence = inputs
+
+    final_states = []
+    sequence_outputs = []
+    for layer_index, state in enumerate(hidden_states):
+      forward_lstm, backward_lstm = self.native_layers[layer_index]
+
+      forward_cache = forward_output_sequence
+      backward_cache = backward_output_sequence
+
+      if state is not None:
+        forward_hidden_state, backward_hidden_state = state[0].split(self.hidden_size, 2)
+        forward_memory_state, backward_memory_state = state[1].split(self.cell_size, 2)
+        forward_state = (forward_hidden_state.contiguous(), forward_memory_state.contiguous())
+        backward_state = (backward_hidden_state.contiguous(), backward_memory_state.contiguous())
+      else:
+        forward_state = None
+        backward_state = None
+
+      forward_output_sequence, forward_state = self._run_native_lstm(forward_lstm,
+                                                                     forward_output_sequence,
+                                                                     batch_lengths,
+                                                                     forward_state)
+      backward_output_sequence, backward_state = self._run_native_lstm(
+        backward_lstm, reverse_padded_sequence(backward_output_sequence, batch_lengths),
+        batch_lengths, backward_state)
+      backward_output_sequence = reverse_padded_sequence(backward_output_sequence, batch_lengths)
+
+      # Skip connections, just adding the input to the output.
+      if layer_index != 0:
+        forward_output_sequence = forward_output_sequence + forward_cache
+        backward_output_sequence = backward_output_sequence + backward_cache
+
+      sequence_outputs.append(torch.cat([forward_output_sequence,
+                                         backward_output_sequence], -1))
+      final_states.append((torch.cat([forward_state[0], backward_state[0]], -1),
+                           torch.cat([forward_state[1], backward_state[1]], -1)))
+
+    stacked_sequence_outputs: torch.FloatTensor = torch.stack(sequence_outputs)
+    final_hidden_states, final_memory_states = zip(*final_states)
+    final_state_tuple: Tuple[torch.FloatTensor,
+                             torch.FloatTensor] = (torch.cat(final_hidden_states, 0),
+                                                   torch.cat(final_memory_states, 0))
+    return stacked_sequence_outputs, final_state_tuple
+
+  @staticmethod
+  def _run_native_lstm(lstm: torch.nn.LSTM,
+                       inputs: torch.Tensor,
+                       batch_lengths: torch.Tensor,
+                       initial_state: Optional[Tuple[torch.Tensor, torch.Tensor]]) -> \
+      Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
+    packed_inputs = pack_padded_sequence(inputs, batch_lengths, batch_first=True)
+    packed_outputs, final_state = lstm(packed_inputs, initial_state)
+    outputs, _ = pad_packed_sequence(packed_outputs, batch_first=True, total_length=inputs.size(1))
+    return outputs, final_state
@@ -34,7 +34,8 @@ class _EncoderBase(torch.nn.Module):
                                               Tuple[Union[PackedSequence, torch.Tensor], RnnState]],
                              inputs: torch.Tensor,
                              mask: torch.Tensor,
-                             hidden_state: Optional[RnnState] = None):
+                             hidden_state: Optional[RnnState] = None,
+                             segment_starts: Optional[torch.Tensor] = None):
         """
         This function exists because Pytorch RNNs require that their inputs be sorted
         before being passed as input. As all of our Seq2xxxEncoders use this functionality,
@@ -65,6 +66,10 @@ class _EncoderBase(torch.nn.Module):
             tensors of shapes (num_layers, batch_size, hidden_size) and
             (num_layers, batch_size, memory_size), representing the hidden state and memory
             state of an LSTM-like RNN.
+        segment_starts : ``Optional[torch.Tensor]``, (default = None).
+            A tensor of shape ``(batch_size, sequence_length)``, 1 where a segment starts when
+            several segments are packed into a row. It is sorted with the inputs and passed to
+            the module as its third argument.
         Returns
         -------
         module_output : ``Union[torch.Tensor, PackedSequence]``.
@@ -110,7 +115,11 @@ class _EncoderBase(torch.nn.Module):
             initial_states = self._get_initial_states(batch_size, num_valid, sorting_indices)
 
         # Actually call the module on the sorted PackedSequence.
-        module_output, final_states = module(packed_sequence_input, initial_states)
+        if segment_starts is None:
+            module_output, final_states = module(packed_sequence_input, initial_states)
+        else:
+            sorted_segment_starts = segment_starts.index_select(0, sorting_indices)[:num_valid]
+            module_output, final_states = module(packed_sequence_input, initial_states, sorted_segment_starts)
 
         return module_output, final_states, restoration_indices
 
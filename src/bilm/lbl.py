@@ -6,6 +6,93 @@ from modules.highway import Highway
 from modules.positional_encoding import PositionalEncoding
 from modules.sublayer_connection import SublayerConnection
 from modules.positionwise_feedforward import PositionwiseFeedForward
+from modules.util import checkpoint_layer
+
+
+def weighted_window_sum(inputs: torch.Tensor, weights: torch.Tensor) -> torch.Tensor:
+  """
+  For every step t, compute ``sum_k weights[k] * inputs[t + k]`` over the ``len(weights)``
+  steps starting at t. The taps are shared by all the channels, so this is a single
+  conv1d over the ``(batch_size * dim)`` channels.
+
+  :param inputs: [batch_size, seq_len + width, dim]
+  :param weights: [width + 1]
+  :return: [batch_size, seq_len, dim]
+  """
+  batch_size, padded_len, dim = inputs.size()
+  channels = inputs.transpose(1, 2).contiguous().view(batch_size * dim, 1, padded_len)
+  outputs = torch.nn.functional.conv1d(channels, weights.view(1, 1, -1))
+  return outputs.view(batch_size, dim, -1).transpose(1, 2)
+
+
+def segment_bounds(segment_starts: torch.Tensor):
+  """
+  The first step of the segment of every step and the step after its last one.
+
+  :param segment_starts: [batch_size, seq_len], 1 at the first step of every segment.
+  :return: ([batch_size, seq_len], [batch_size, seq_len])
+  """
+  batch_size, seq_len = segment_starts.size()
+  steps = torch.arange(seq_len, device=segment_starts.device).unsqueeze(0).expand(batch_size, -1)
+  is_start = segment_starts != 0
+  starts = torch.where(is_start, steps, torch.zeros_like(steps)).cummax(dim=1)[0]
+  next_starts = torch.where(is_start, steps, torch.full_like(steps, seq_len))
+  next_starts = torch.cat([next_starts[:, 1:], next_starts.new_full((batch_size, 1), seq_len)], dim=1)
+  ends = next_starts.flip(1).cummin(dim=1)[0].flip(1)
+  return starts, ends
+
+
+def gather_windows(inputs: torch.Tensor, paddings: torch.Tensor, width: int,
+                   starts: torch.Tensor, ends: torch.Tensor, left_to_right: bool = True) -> torch.Tensor:
+  """
+  The window of ``width + 1`` steps of every step, [t - width, t] when ``left_to_right``,
+  otherwise [t, t + width], when several segments are packed into a row. The steps out of the
+  segment read the padding rows, as if every segment were a sequence of its own.
+
+  :param inputs: [batch_size, seq_len, dim]
+  :param paddings: [width, dim] or [batch_size, width, dim]
+  :param width: int
+  :param starts: [batch_size, seq_len], from ``segment_bounds``.
+  :param ends: [batch_size, seq_len], from ``segment_bounds``.
+  :param left_to_right: bool
+  :return: [batch_size, seq_len, width + 1, dim]
+  """
+  batch_size, seq_len, dim = inputs.size()
+  steps = torch.arange(seq_len, device=inputs.device).view(1, -1, 1)
+  offsets = torch.arange(width + 1, device=inputs.device).view(1, 1, -1)
+  paddings = paddings.expand(batch_size, -1, -1)
+  if left_to_right:
+    # the table is [paddings, inputs], the steps before the segment read the paddings
+    # the same way the steps before a sequence do.
+    sources = steps + offsets - width
+    starts = starts.unsqueeze(2)
+    indices = torch.where(sources >= starts, sources + width, sources - starts + width)
+    table = torch.cat([paddings, inputs], dim=1)
+  else:
+    # the table is [inputs, paddings].
+    sources = steps + offsets
+    ends = ends.unsqueeze(2)
+    indices = torch.where(sources < ends, sources, sources - ends + seq_len)
+    table = torch.cat([inputs, paddings], dim=1)
+  indices = indices.view(batch_size, -1, 1).expand(-1, -1, dim)
+  return table.gather(1, indices).view(batch_size, seq_len, width + 1, dim)
+
+
+def packed_weighted_window_sum(inputs: torch.Tensor, paddings: torch.Tensor, weights: torch.Tensor,
+                               starts: torch.Tensor, ends: torch.Tensor, left_to_right: bool = True) -> torch.Tensor:
+  """
+  ``weighted_window_sum`` over the windows of ``gather_windows``.
+
+  :param inputs: [batch_size, seq_len, dim]
+  :param paddings: [width, dim] or [batch_size, width, dim]
+  :param weights: [width + 1]
+  :param starts: [batch_size, seq_len]
+  :param ends: [batch_size, seq_len]
+  :param left_to_right: bool
+  :return: [batch_size, seq_len, dim]
+  """
+  windows = gather_windows(inputs, paddings, weights.size(0) - 1, starts, ends, left_to_right)
+  return windows.transpose(2, 3).matmul(weights)
 
 
 class LBLHighwayBiLm(torch.nn.Module):
@@ -14,6 +101,7 @@ class LBLHighwayBiLm(torch.nn.Module):
     self.config = config
     self.use_cuda = use_cuda
     self.use_position = config['encoder'].get('position', False)
+    self.checkpoint_layers = config['encoder'].get('checkpoint_layers', False)
     self.n_layers = n_layers = config['encoder']['n_layers']
     self.n_highway = n_highway = config['encoder']['n_highway']
 
@@ -48,40 +136,66 @@ class LBLHighwayBiLm(torch.nn.Module):
     if self.use_position:
       self.position = PositionalEncoding(hidden_size, self.config['dropout'])
 
-  def forward(self, inputs):
+  def layer_forward(self, i, last_forward_inputs, last_backward_inputs, starts=None, ends=None, positions=None):
+    """
+    The i-th layer of both directions.
+
+    :param i: int
+    :param last_forward_inputs: [batch_size, seq_len, dim]
+    :param last_backward_inputs: [batch_size, seq_len, dim]
+    :param starts: [batch_size, seq_len], from ``segment_bounds`` when the segments are packed.
+    :param ends: [batch_size, seq_len], from ``segment_bounds`` when the segments are packed.
+    :param positions: [batch_size, seq_len], the position of every step in its segment.
+    :return: ([batch_size, seq_len, hidden_size], [batch_size, seq_len, hidden_size])
+    """
+    batch_size, sequence_len, _ = last_forward_inputs.size()
+    if self.use_position:
+      last_forward_inputs = self.position(last_forward_inputs, positions)
+      last_backward_inputs = self.position(last_backward_inputs, positions)
+
+    if starts is None:
+      # The forward window of step t covers [t - width, t], the backward one [t, t + width],
+      # so each direction only needs the padding on its own side.
+      padded_last_forward_inputs = torch.cat([self.forward_paddings[i].expand(batch_size, -1, -1),
+                                              last_forward_inputs], dim=1)
+      padded_last_backward_inputs = torch.cat([last_backward_inputs,
+                                               self.backward_paddings[i].expand(batch_size, -1, -1)], dim=1)
+      forward_output = weighted_window_sum(padded_last_forward_inputs, self.forward_weights[i])
+      backward_output = weighted_window_sum(padded_last_backward_inputs, self.backward_weights[i])
+    else:
+      forward_output = packed_weighted_window_sum(last_forward_inputs, self.forward_paddings[i],
+                                                  self.forward_weights[i], starts, ends)
+      backward_output = packed_weighted_window_sum(last_backward_inputs, self.backward_paddings[i],
+                                                   self.backward_weights[i], starts, ends, left_to_right=False)
+
+    forward_output = self.forward_blocks[i](forward_output.contiguous().view(-1, self.hidden_size))
+    backward_output = self.backward_blocks[i](backward_output.contiguous().view(-1, self.hidden_size))
+
+    last_forward_inputs = forward_output.view(batch_size, sequence_len, self.hidden_size)
+    last_backward_inputs = backward_output.view(batch_size, sequence_len, self.hidden_size)
+    return last_forward_inputs, last_backward_inputs
+
+  def forward(self, inputs, segment_starts=None):
+    """
+
+    :param inputs: [batch_size, seq_len, dim]
+    :param segment_starts: [batch_size, seq_len], 1 at the first step of every segment when several
+      sentences are packed into a row, so that the windows don't cross the segments.
+    :return: [n_layers, batch_size, seq_len, 2 * hidden_size]
+    """
     batch_size, sequence_len, dim = inputs.size()
     all_layers_along_steps = []
+    starts, ends, positions = None, None, None
+    if segment_starts is not None:
+      starts, ends = segment_bounds(segment_starts)
+      positions = torch.arange(sequence_len, device=inputs.device).unsqueeze(0) - starts
 
     last_forward_inputs = inputs
     last_backward_inputs = inputs
     for i in range(self.n_layers):
-      if self.use_position:
-        last_forward_inputs = self.position(last_forward_inputs)
-        last_backward_inputs = self.position(last_backward_inputs)
-
-      padded_last_forward_inputs = torch.cat([self.forward_paddings[i].expand(batch_size, -1, -1),
-                                              last_forward_inputs,
-                                              self.backward_paddings[i].expand(batch_size, -1, -1)], dim=1)
-      padded_last_backward_inputs = torch.cat([self.forward_paddings[i].expand(batch_size, -1, -1),
-                                               last_backward_inputs,
-                                               self.backward_paddings[i].expand(batch_size, -1, -1)], dim=1)
-
-      forward_steps, backward_steps = [], []
-      for start in range(sequence_len):
-        end = start + self.width
-        forward_input = padded_last_forward_inputs.narrow(1, start, self.width + 1)
-        forward_output = forward_input.transpose(-2, -1).matmul(self.forward_weights[i])
-        forward_output = self.forward_blocks[i](forward_output)
-
-        backward_input = padded_last_backward_inputs.narrow(1, end, self.width + 1)
-        backward_output = backward_input.transpose(-2, -1).matmul(self.backward_weights[i])
-        backward_output = self.backward_blocks[i](backward_output)
-
-        forward_steps.append(forward_output)
-        backward_steps.append(backward_output)
-
-      last_forward_inputs = torch.stack(forward_steps, dim=1)
-      last_backward_inputs = torch.stack(backward_steps, dim=1)
+      last_forward_inputs, last_backward_inputs = checkpoint_layer(
+        self.layer_forward, i, last_forward_inputs, last_backward_inputs, starts, ends, positions,
+        enabled=self.checkpoint_layers)
 
       all_layers_along_steps.append(torch.cat([last_forward_inputs, last_backward_inputs], dim=-1))
 
@@ -94,6 +208,7 @@ class LBLResNetBiLm(torch.nn.Module):
     self.config = config
     self.use_cuda = use_cuda
     self.use_position = config['encoder'].get('position', False)
+    self.checkpoint_layers = config['encoder'].get('checkpoint_layers', False)
 
     self.dropout = torch.nn.Dropout(self.config['dropout'])
     self.activation = torch.nn.ReLU()
@@ -113,8 +228,8 @@ class LBLResNetBiLm(torch.nn.Module):
 
     self.forward_paddings = torch.nn.ParameterList(forward_paddings)
     self.backward_paddings = torch.nn.ParameterList(backward_paddings)
-    self.forward_weights = torch.nn.Parameter(forward_weights)
-    self.backward_weights = torch.nn.Parameter(backward_weights)
+    self.forward_weights = torch.nn.ParameterList(forward_weights)
+    self.backward_weights = torch.nn.ParameterList(backward_weights)
 
     if self.use_position:
       self.position = PositionalEncoding(hidden_size, self.config['dropout'])
@@ -131,40 +246,61 @@ class LBLResNetBiLm(torch.nn.Module):
     self.backward_blocks = torch.nn.ModuleList(
       [SublayerConnection(hidden_size, self.config['dropout']) for _ in range(n_layers)])
 
-  def forward(self, inputs):
+  def layer_forward(self, i, last_forward_inputs, last_backward_inputs, starts=None, ends=None, positions=None):
+    """
+    The i-th layer of both directions.
+
+    :param i: int
+    :param last_forward_inputs: [batch_size, seq_len, dim]
+    :param last_backward_inputs: [batch_size, seq_len, dim]
+    :param starts: [batch_size, seq_len], from ``segment_bounds`` when the segments are packed.
+    :param ends: [batch_size, seq_len], from ``segment_bounds`` when the segments are packed.
+    :param positions: [batch_size, seq_len], the position of every step in its segment.
+    :return: ([batch_size, seq_len, hidden_size], [batch_size, seq_len, hidden_size])
+    """
+    batch_size, sequence_len, _ = last_forward_inputs.size()
+    if self.use_position:
+      last_forward_inputs = self.position(last_forward_inputs, positions)
+      last_backward_inputs = self.position(last_backward_inputs, positions)
+
+    if starts is None:
+      padded_last_forward_inputs = torch.cat([self.forward_paddings[i].expand(batch_size, -1, -1),
+                                              last_forward_inputs], dim=1)
+      padded_last_backward_inputs = torch.cat([last_backward_inputs,
+                                               self.backward_paddings[i].expand(batch_size, -1, -1)], dim=1)
+      forward_output = weighted_window_sum(padded_last_forward_inputs, self.forward_weights[i])
+      backward_output = weighted_window_sum(padded_last_backward_inputs, self.backward_weights[i])
+    else:
+      forward_output = packed_weighted_window_sum(last_forward_inputs, self.forward_paddings[i],
+                                                  self.forward_weights[i], starts, ends)
+      backward_output = packed_weighted_window_sum(last_backward_inputs, self.backward_paddings[i],
+                                                   self.backward_weights[i], starts, ends, left_to_right=False)
+
+    last_forward_inputs = self.forward_blocks[i](forward_output, self.forward_linears[i])
+    last_backward_inputs = self.backward_blocks[i](backward_output, self.backward_linears[i])
+    return last_forward_inputs, last_backward_inputs
+
+  def forward(self, inputs, segment_starts=None):
+    """
+
+    :param inputs: [batch_size, seq_len, dim]
+    :param segment_starts: [batch_size, seq_len], 1 at the first step of every segment when several
+      sentences are packed into a row, so that the windows don't cross the segments.
+    :return: [n_layers, batch_size, seq_len, 2 * hidden_size]
+    """
     batch_size, sequence_len, dim = inputs.size()
     all_layers_along_steps = []
+    starts, ends, positions = None, None, None
+    if segment_starts is not None:
+      starts, ends = segment_bounds(segment_starts)
+      positions = torch.arange(sequence_len, device=inputs.device).unsqueeze(0) - starts
 
     last_forward_inputs = inputs
     last_backward_inputs = inputs
     for i in range(self.n_layers):
-      if self.use_position:
-        last_forward_inputs = self.position(last_forward_inputs)
-        last_backward_inputs = self.position(last_backward_inputs)
-
-      padded_last_forward_inputs = torch.cat([self.forward_paddings[i].expand(batch_size, -1, -1),
-                                              last_forward_inputs,
-                                              self.backward_paddings[i].expand(batch_size, -1, -1)], dim=1)
-      padded_last_backward_inputs = torch.cat([self.forward_paddings[i].expand(batch_size, -1, -1),
-                                               last_backward_inputs,
-                                               self.backward_paddings[i].expand(batch_size, -1, -1)], dim=1)
-
-      forward_steps, backward_steps = [], []
-      for start in range(sequence_len):
-        end = start + self.width
-        forward_input = padded_last_forward_inputs.narrow(1, start, self.width + 1)
-        forward_output = forward_input.transpose(-2, -1).matmul(self.forward_weights[i])
-        forward_output = self.forward_blocks[i](forward_output, self.forward_linears[i])
-
-        backward_input = padded_last_backward_inputs.narrow(1, end, self.width + 1)
-        backward_output = backward_input.transpose(-2, -1).matmul(self.backward_weights[i])
-        backward_output = self.backward_blocks[i](backward_output, self.backward_linears[i])
-
-        forward_steps.append(forward_output)
-        backward_steps.append(backward_output)
-
-      last_forward_inputs = torch.stack(forward_steps, dim=1)
-      last_backward_inputs = torch.stack(backward_steps, dim=1)
+      last_forward_inputs, last_backward_inputs = checkpoint_layer(
+        self.layer_forward, i, last_forward_inputs, last_backward_inputs, starts, ends, positions,
+        enabled=self.checkpoint_layers)
 
       all_layers_along_steps.append(torch.cat([last_forward_inputs, last_backward_inputs], dim=-1))
 
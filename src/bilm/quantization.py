@@ -0,0 +1,95 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import torch
+import torch.ao.quantization
+
+
+class WeightOnlyInt8Conv1d(torch.nn.Module):
+  """
+  A ``torch.nn.Conv1d`` whose weight is kept in int8, with a scale per output channel, and
+  dequantized on the fly. The character filters see the embeddings of a few characters, so
+  only their weight is quantized and the convolution itself stays in float.
+  """
+  def __init__(self, in_channels: int, out_channels: int, kernel_size: int, stride: int = 1,
+               padding: int = 0, dilation: int = 1, groups: int = 1, bias: bool = True):
+    super(WeightOnlyInt8Conv1d, self).__init__()
+    self.in_channels = in_channels
+    self.out_channels = out_channels
+    self.kernel_size = kernel_size
+    self.stride = stride
+    self.padding = padding
+    self.dilation = dilation
+    self.groups = groups
+    self.register_buffer('weight_int8', torch.zeros(out_channels, in_channels // groups, kernel_size,
+                                                    dtype=torch.int8))
+    self.register_buffer('scale', torch.ones(out_channels, 1, 1))
+    self.register_buffer('bias', torch.zeros(out_channels) if bias else None)
+
+  @classmethod
+  def from_float(cls, conv: torch.nn.Conv1d):
+    """
+    Quantize the weight of ``conv`` symmetrically into [-127, 127].
+
+    :param conv: torch.nn.Conv1d
+    :return: WeightOnlyInt8Conv1d
+    """
+    if not isinstance(conv.padding, tuple):
+      raise ValueError('Only the numeric padding of Conv1d can be quantized, got {}.'.format(conv.padding))
+    module = cls(conv.in_channels, conv.out_channels, conv.kernel_size[0], conv.stride[0], conv.padding[0],
+                 conv.dilation[0], conv.groups, conv.bias is not None)
+    with torch.no_grad():
+      weight = conv.weight.detach().float().cpu()
+      scale = weight.abs().amax(dim=(1, 2), keepdim=True).clamp(min=1e-8) / 127.0
+      module.weight_int8.copy_(torch.round(weight / scale).clamp(-127, 127).to(torch.int8))
+      module.scale.copy_(scale)
+      if conv.bias is not None:
+        module.bias.copy_(conv.bias.detach().float().cpu())
+    return module
+
+  def forward(self, inputs):
+    weight = self.weight_int8.to(inputs.dtype) * self.scale.to(inputs.dtype)
+    bias = None if self.bias is None else self.bias.to(inputs.dtype)
+    return torch.nn.functional.conv1d(inputs, weight, bias, self.stride, self.padding, self.dilation, self.groups)
+
+  def extra_repr(self):
+    return '{0}, {1}, kernel_size={2}, stride={3}'.format(self.in_channels, self.out_channels, self.kernel_size,
+                                                          self.stride)
+
+
+def quantize_model(model: torch.nn.Module) -> torch.nn.Module:
+  """
+  Quantize the model in place for CPU inference. Every ``torch.nn.Linear`` and ``torch.nn.LSTM``
+  is replaced with its dynamic int8 version, whose weight is stored in int8 and whose inputs
+  are quantized batch by batch, and every ``torch.nn.Conv1d`` with ``WeightOnlyInt8Conv1d``.
+  This covers the LSTM cells, the token embedder projection, the highways, the window
+  encoders and the attention.
+
+  The quantized model only runs on CPU. Its ``state_dict`` can only be loaded into a model
+  which is quantized in the same way.
+
+  :param model: torch.nn.Module, on CPU.
+  :return: the same model.
+  """
+  for module in list(model.modules()):
+    for name, child in list(module.named_children()):
+      if type(child) is torch.nn.Conv1d:
+        setattr(module, name, WeightOnlyInt8Conv1d.from_float(child))
+  torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear, torch.nn.LSTM}, dtype=torch.qint8, inplace=True)
+  return model
+
+
+def cosine_drift(reference: torch.Tensor, quantized: torch.Tensor, mask: torch.Tensor):
+  """
+  The cosine similarity between the embeddings of the reference model and the quantized one.
+
+  :param reference: [n_layers, batch_size, seq_len, dim] or [batch_size, seq_len, dim]
+  :param quantized: the same shape as ``reference``.
+  :param mask: [batch_size, seq_len], 1 for the tokens.
+  :return: [n_layers, n_tokens], the similarity of every token in every layer.
+  """
+  if reference.dim() == 3:
+    reference, quantized = reference.unsqueeze(0), quantized.unsqueeze(0)
+  similarity = torch.nn.functional.cosine_similarity(reference.float(), quantized.float(), dim=-1)
+  mask = mask.to(similarity.device).view(1, -1) != 0
+  n_layers = similarity.size(0)
+  return similarity.view(n_layers, -1).masked_select(mask).view(n_layers, -1)
@@ -4,6 +4,8 @@ import copy
 import numpy as np
 from modules.highway import Highway
 from modules.positional_encoding import PositionalEncoding
+from modules.util import checkpoint_layer
+from bilm.lbl import weighted_window_sum, segment_bounds, packed_weighted_window_sum
 
 
 def clones(module, N):
@@ -33,6 +35,49 @@ def attention(query: torch.Tensor, key: torch.Tensor, value: torch.Tensor,
   return torch.matmul(p_attn, value), p_attn
 
 
+def local_attention(query: torch.Tensor, key: torch.Tensor, value: torch.Tensor,
+                    width: int, band_mask: torch.Tensor, left_to_right=True, dropout=None,
+                    key_indices=None):
+  """
+  Compute 'Scaled Dot Product Attention' inside a band of ``width + 2`` keys: position i
+  attends to [i - width - 1, i] when ``left_to_right``, otherwise to [i, i + width + 1].
+  It gives the same result as ``attention`` with ``local_mask``, but the keys and values
+  are gathered with a sliding window, so the cost is O(seq_len * width) instead of
+  O(seq_len ^ 2).
+
+  :param query: [batch, h, seq_len, d_k]
+  :param key: [batch, h, seq_len, d_k]
+  :param value: [batch, h, seq_len, d_k]
+  :param width: int
+  :param band_mask: [seq_len, width + 2], 0 for the keys that fall outside the sequence,
+    or [batch, 1, seq_len, width + 2] along with ``key_indices``.
+  :param left_to_right: bool
+  :param dropout:
+  :param key_indices: [batch, seq_len, width + 2], gather the keys of every query from these
+    steps instead of the sliding window, e.g. for packed segments.
+  :return: [batch, h, seq_len, d_k], [batch, h, seq_len, width + 2]
+  """
+  band = width + 2
+  d_k = query.size(-1)
+  if key_indices is None:
+    padding = (0, 0, band - 1, 0) if left_to_right else (0, 0, 0, band - 1)
+    # [batch, h, seq_len, d_k, band]
+    key_windows = torch.nn.functional.pad(key, padding).unfold(2, band, 1)
+    value_windows = torch.nn.functional.pad(value, padding).unfold(2, band, 1)
+  else:
+    batch_size, h, seq_len, _ = key.size()
+    indices = key_indices.view(batch_size, 1, -1, 1).expand(-1, h, -1, d_k)
+    key_windows = key.gather(2, indices).view(batch_size, h, seq_len, band, d_k).transpose(3, 4)
+    value_windows = value.gather(2, indices).view(batch_size, h, seq_len, band, d_k).transpose(3, 4)
+
+  scores = torch.matmul(query.unsqueeze(-2), key_windows).squeeze(-2) / math.sqrt(d_k)
+  scores = scores.masked_fill(band_mask == 0, -1e9)
+  p_attn = torch.nn.functional.softmax(scores, dim=-1)
+  if dropout is not None:
+    p_attn = dropout(p_attn)
+  return torch.matmul(value_windows, p_attn.unsqueeze(-1)).squeeze(-1), p_attn
+
+
 def subsequent_mask(size):
   """Mask out subsequent positions."""
   attn_shape = (1, size, size)
@@ -63,16 +108,19 @@ class MultiHeadedAttention(torch.nn.Module):
     self.dropout = torch.nn.Dropout(p=dropout)
 
   def forward(self, query: torch.Tensor, key: torch.Tensor, value: torch.Tensor,
-              mask=None) -> torch.Tensor:
+              mask=None, width=None, left_to_right=True, key_indices=None) -> torch.Tensor:
     """
 
     :param query: [batch, seq_len, d_model]
     :param key: [batch, seq_len, d_model]
     :param value: [batch, seq_len, d_model]
-    :param mask: [1, seq_len, seq_len]
+    :param mask: [1, seq_len, seq_len], or the [seq_len, width + 2] band mask when ``width`` is given.
+    :param width: int, use ``local_attention`` with this width instead of the full attention.
+    :param left_to_right: bool, the direction of the band.
+    :param key_indices: [batch, seq_len, width + 2], see ``local_attention``.
     :return:
     """
-    if mask is not None:
+    if mask is not None and width is None:
       # Same mask applied to all h heads.
       mask = mask.unsqueeze(1)
     nbatches = query.size(0)
@@ -82,8 +130,13 @@ class MultiHeadedAttention(torch.nn.Module):
                          for l, x in zip(self.linears, (query, key, value))]
 
     # 2) Apply attention on all the projected vectors in batch.
-    x, self.attn = attention(query, key, value, mask=mask,
-                             dropout=self.dropout)
+    if width is None:
+      x, self.attn = attention(query, key, value, mask=mask,
+                               dropout=self.dropout)
+    else:
+      x, self.attn = local_attention(query, key, value, width, mask,
+                                     left_to_right=left_to_right, dropout=self.dropout,
+                                     key_indices=key_indices)
 
     # 3) "Concat" using a view and apply a final linear.
     x = x.transpose(1, 2).contiguous().view(nbatches, -1, self.h * self.d_k)
@@ -97,6 +150,7 @@ class SelfAttentiveLBLBiLM(torch.nn.Module):
     self.use_cuda = use_cuda
     self.use_position = config['encoder'].get('position', False)
     self.use_relative_position_weights = config['encoder'].get('relative_position_weights', False)
+    self.checkpoint_layers = config['encoder'].get('checkpoint_layers', False)
     self.n_layers = n_layers = config['encoder']['n_layers']
     self.n_highway = n_highway = config['encoder']['n_highway']
     self.n_heads = n_heads = config['encoder']['n_heads']
@@ -142,56 +196,157 @@ class SelfAttentiveLBLBiLM(torch.nn.Module):
     if self.use_position:
       self.position = PositionalEncoding(config['encoder']['projection_dim'], self.config['dropout'])
 
-  def forward(self, inputs):
+    # The band masks only depend on the padded length and the direction.
+    self._band_masks = {}
+
+  def get_band_mask(self, length, left_to_right, device):
+    """
+    The [length, width + 2] mask of the keys ``local_attention`` can see, cached per length.
+
+    :param length: int, the padded sequence length.
+    :param left_to_right: bool
+    :param device:
+    :return:
+    """
+    key = (length, left_to_right, device)
+    if key not in self._band_masks:
+      # the k-th key of query i is i + k - width - 1 (left to right) or i + k.
+      positions = torch.arange(length).unsqueeze(1) + torch.arange(self.width + 2).unsqueeze(0)
+      if left_to_right:
+        band_mask = positions >= self.width + 1
+      else:
+        band_mask = positions < length
+      self._band_masks[key] = band_mask.to(device)
+    return self._band_masks[key]
+
+  def get_packed_band(self, starts, ends, left_to_right):
+    """
+    The key indices and the mask of ``local_attention`` when several segments are packed into
+    a row. The steps of every segment see the paddings at its boundaries, as if the segment
+    were a sequence of its own, and the padding rows keep the band of the whole row.
+
+    :param starts: [batch_size, seq_len], from ``segment_bounds``.
+    :param ends: [batch_size, seq_len], from ``segment_bounds``.
+    :param left_to_right: bool
+    :return: [batch_size, seq_len + 2 * width, width + 2], [batch_size, 1, seq_len + 2 * width, width + 2]
+    """
+    batch_size, seq_len = starts.size()
+    width = self.width
+    length = seq_len + width * 2
+    offsets = torch.arange(width + 2, device=starts.device).view(1, 1, -1)
+
+    positions = torch.arange(length, device=starts.device).view(1, -1, 1) + offsets
+    if left_to_right:
+      positions = positions - width - 1
+    band_mask = ((positions >= 0) & (positions < length)).expand(batch_size, -1, -1).clone()
+    indices = positions.expand(batch_size, -1, -1).clone()
+
+    # the k-th key of step t is the step t + k - width - 1 (left to right) or t + k, which
+    # reads the padding row of the same offset when it falls out of the segment.
+    steps = torch.arange(seq_len, device=starts.device).view(1, -1, 1)
+    if left_to_right:
+      sources = steps + offsets - width - 1
+      starts = starts.unsqueeze(2)
+      indices[:, width: width + seq_len] = torch.where(sources >= starts, sources + width, sources - starts + width)
+      band_mask[:, width: width + seq_len] = sources >= starts - width
+    else:
+      sources = steps + offsets
+      ends = ends.unsqueeze(2)
+      indices[:, width: width + seq_len] = torch.where(sources < ends, sources + width,
+                                                       sources - ends + seq_len + width)
+      band_mask[:, width: width + seq_len] = sources < ends + width
+    return indices.clamp(0, length - 1), band_mask.unsqueeze(1)
+
+  def layer_forward(self, i, forward_inputs, backward_inputs, forward_mask, backward_mask,
+                    forward_indices=None, backward_indices=None, starts=None, ends=None, positions=None):
+    """
+    The i-th layer of both directions.
+
+    :param i: int
+    :param forward_inputs: [batch_size, seq_len, dim]
+    :param backward_inputs: [batch_size, seq_len, dim]
+    :param forward_mask: the band mask of the forward attention.
+    :param backward_mask: the band mask of the backward attention.
+    :param forward_indices: the key indices of the forward attention when the segments are packed.
+    :param backward_indices: the key indices of the backward attention when the segments are packed.
+    :param starts: [batch_size, seq_len], from ``segment_bounds`` when the segments are packed.
+    :param ends: [batch_size, seq_len], from ``segment_bounds`` when the segments are packed.
+    :param positions: [batch_size, seq_len], the position of every step in its segment.
+    :return: ([batch_size, seq_len, hidden_size], [batch_size, seq_len, hidden_size])
+    """
+    batch_size, sequence_len, _ = forward_inputs.size()
+    if self.use_position:
+      forward_inputs = self.position(forward_inputs, positions)
+      backward_inputs = self.position(backward_inputs, positions)
+
+    forward_inputs = torch.cat([self.forward_paddings[i].expand(batch_size, -1, -1),
+                                forward_inputs,
+                                self.backward_paddings[i].expand(batch_size, -1, -1)], dim=1)
+    backward_inputs = torch.cat([self.forward_paddings[i].expand(batch_size, -1, -1),
+                                 backward_inputs,
+                                 self.backward_paddings[i].expand(batch_size, -1, -1)], dim=1)
+
+    forward_inputs = self.forward_attns[i](forward_inputs, forward_inputs,
+                                           forward_inputs, forward_mask, width=self.width,
+                                           key_indices=forward_indices)
+    backward_inputs = self.backward_attns[i](backward_inputs, backward_inputs,
+                                             backward_inputs, backward_mask, width=self.width,
+                                             left_to_right=False, key_indices=backward_indices)
+
+    # step t sits at t + width of the padded sequence.
+    forward_output = forward_inputs.narrow(1, self.width, sequence_len)
+    backward_output = backward_inputs.narrow(1, self.width, sequence_len)
+
+    if self.use_relative_position_weights and starts is None:
+      forward_output = forward_output + weighted_window_sum(
+        forward_inputs.narrow(1, 0, sequence_len + self.width), self.forward_weights[i])
+      backward_output = backward_output + weighted_window_sum(
+        backward_inputs.narrow(1, self.width, sequence_len + self.width), self.backward_weights[i])
+    elif self.use_relative_position_weights:
+      # the attended padding rows pad every segment.
+      forward_output = forward_output + packed_weighted_window_sum(
+        forward_output, forward_inputs.narrow(1, 0, self.width), self.forward_weights[i], starts, ends)
+      backward_output = backward_output + packed_weighted_window_sum(
+        backward_output, backward_inputs.narrow(1, sequence_len + self.width, self.width),
+        self.backward_weights[i], starts, ends, left_to_right=False)
+
+    forward_output = self.forward_blocks[i](forward_output.contiguous().view(-1, self.hidden_size))
+    backward_output = self.backward_blocks[i](backward_output.contiguous().view(-1, self.hidden_size))
+
+    forward_inputs = forward_output.view(batch_size, sequence_len, self.hidden_size)
+    backward_inputs = backward_output.view(batch_size, sequence_len, self.hidden_size)
+    return forward_inputs, backward_inputs
+
+  def forward(self, inputs, segment_starts=None):
+    """
+
+    :param inputs: [batch_size, seq_len, dim]
+    :param segment_starts: [batch_size, seq_len], 1 at the first step of every segment when several
+      sentences are packed into a row, so that the attention doesn't cross the segments.
+    :return: [n_layers, batch_size, seq_len, 2 * hidden_size]
+    """
     batch_size, sequence_len, dim = inputs.size()
     all_layers_along_steps = []
 
     forward_inputs = inputs
     backward_inputs = inputs
 
-    forward_mask = local_mask(sequence_len + self.width * 2, self.width)
-    backward_mask = local_mask(sequence_len + self.width * 2, self.width, left_to_right=False)
-    if self.use_cuda:
-      forward_mask = forward_mask.cuda()
-      backward_mask = backward_mask.cuda()
+    starts, ends, positions = None, None, None
+    forward_indices, backward_indices = None, None
+    if segment_starts is None:
+      forward_mask = self.get_band_mask(sequence_len + self.width * 2, True, inputs.device)
+      backward_mask = self.get_band_mask(sequence_len + self.width * 2, False, inputs.device)
+    else:
+      starts, ends = segment_bounds(segment_starts)
+      positions = torch.arange(sequence_len, device=inputs.device).unsqueeze(0) - starts
+      forward_indices, forward_mask = self.get_packed_band(starts, ends, True)
+      backward_indices, backward_mask = self.get_packed_band(starts, ends, False)
 
     for i in range(self.n_layers):
-      if self.use_position:
-        forward_inputs = self.position(forward_inputs)
-        backward_inputs = self.position(backward_inputs)
-
-      forward_inputs = torch.cat([self.forward_paddings[i].expand(batch_size, -1, -1),
-                                  forward_inputs,
-                                  self.backward_paddings[i].expand(batch_size, -1, -1)], dim=1)
-      backward_inputs = torch.cat([self.forward_paddings[i].expand(batch_size, -1, -1),
-                                   backward_inputs,
-                                   self.backward_paddings[i].expand(batch_size, -1, -1)], dim=1)
-
-      forward_inputs = self.forward_attns[i](forward_inputs, forward_inputs,
-                                             forward_inputs, forward_mask)
-      backward_inputs = self.backward_attns[i](backward_inputs, backward_inputs,
-                                               backward_inputs, backward_mask)
-
-      forward_steps, backward_steps = [], []
-      for start in range(sequence_len):
-        end = start + self.width
-        forward_output = forward_inputs[:, end, :]
-        backward_output = backward_inputs[:, end, :]
-
-        if self.use_relative_position_weights:
-          forward_output = forward_output + forward_inputs.narrow(1, start, self.width + 1).\
-            transpose(-2, -1).matmul(self.forward_weights[i])
-          backward_output = backward_output + backward_inputs.narrow(1, end, self.width + 1).\
-            transpose(-2, -1).matmul(self.backward_weights[i])
-
-        forward_output = self.forward_blocks[i](forward_output)
-        backward_output = self.backward_blocks[i](backward_output)
-
-        forward_steps.append(forward_output)
-        backward_steps.append(backward_output)
-
-      forward_inputs = torch.stack(forward_steps, dim=1)
-      backward_inputs = torch.stack(backward_steps, dim=1)
+      forward_inputs, backward_inputs = checkpoint_layer(
+        self.layer_forward, i, forward_inputs, backward_inputs, forward_mask, backward_mask,
+        forward_indices, backward_indices, starts, ends, positions, enabled=self.checkpoint_layers)
+
       all_layers_along_steps.append(torch.cat([forward_inputs, backward_inputs], dim=-1))
 
     return torch.stack(all_layers_along_steps, dim=0)
@@ -23,6 +23,7 @@ class LstmTokenEmbedder(torch.nn.Module):
 
     self.projection = torch.nn.Linear(emb_dim, self.output_dim, bias=True)
 
+  @torch.profiler.record_function('LstmTokenEmbedder')
   def forward(self, word_inp, chars_inp, shape):
     embs = []
     batch_size, seq_len = shape
@@ -87,6 +88,7 @@ class ConvTokenEmbedder(torch.nn.Module):
 
     self.projection = torch.nn.Linear(self.emb_dim, self.output_dim, bias=True)
     
+  @torch.profiler.record_function('ConvTokenEmbedder')
   def forward(self, word_inp, chars_inp, shape):
     embs = []
     batch_size, seq_len = shape
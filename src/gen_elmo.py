@@ -5,6 +5,9 @@ import os
 import sys
 import codecs
 import argparse
+import time
+import copy
+import shutil
 import random
 import logging
 import json
@@ -15,7 +18,11 @@ from bilm.bengio03 import Bengio03HighwayBiLm, Bengio03ResNetBiLm
 from bilm.lbl import LBLHighwayBiLm, LBLResNetBiLm
 from bilm.self_attn import SelfAttentiveLBLBiLM
 from bilm.token_embedder import ConvTokenEmbedder, LstmTokenEmbedder
+from bilm.quantization import quantize_model, cosine_drift
 from modules.embedding_layer import EmbeddingLayer
+from modules.stage_timer import StageTimer, timed
+from modules.step_profiler import StepProfiler, parse_steps
+from modules.util import autocast
 import numpy as np
 import h5py
 import collections
@@ -258,6 +265,79 @@ def create_batches(x, batch_size, word2id, char2id, config, perm=None, shuffle=T
   return batches_w, batches_c, batches_lens, batches_masks
 
 
+def get_receptive_field(config):
+  """
+  The number of tokens on each side that an encoder output depends on. It is exact for the
+  window-based encoders and None for the recurrent ones, whose receptive field is unbounded.
+
+  :param config: dict, the model configurations.
+  :return: int or None
+  """
+  encoder_config = config['encoder']
+  encoder_name = encoder_config['name'].lower()
+  if encoder_name in ('bengio03highway', 'bengio03resnet', 'lblhighway', 'lblresnet'):
+    return encoder_config['n_layers'] * encoder_config['width']
+  elif encoder_name == 'selfattn':
+    # the attention sees width + 1 tokens, and the relative position weights mix the
+    # attention outputs of another width tokens.
+    width = encoder_config['width']
+    if encoder_config.get('relative_position_weights', False):
+      return encoder_config['n_layers'] * (2 * width + 1)
+    return encoder_config['n_layers'] * (width + 1)
+  elif encoder_name in ('elmo', 'lstm'):
+    return None
+  else:
+    raise ValueError('Unknown encoder name: {}'.format(encoder_name))
+
+
+def split_into_windows(dataset, window_size, context):
+  """
+  Split every sentence into overlapping pieces. Each piece keeps ``window_size`` tokens
+  in the middle and carries up to ``context`` tokens on each side, which are only used
+  as the context of the kept tokens.
+
+  :param dataset: list of sentences (with <bos> and <eos>).
+  :param window_size: int, the number of kept tokens in a piece.
+  :param context: int, the number of context tokens on each side.
+  :return: (pieces, info), info[k] is (sentence id, position of the first kept token in the sentence,
+    offset of the kept tokens in the piece, number of kept tokens, number of pieces of the sentence).
+  """
+  pieces, info = [], []
+  for sent_id, data in enumerate(dataset):
+    n_pieces = (len(data) - 1) // window_size + 1
+    for start in range(0, len(data), window_size):
+      end = min(start + window_size, len(data))
+      left, right = max(0, start - context), min(len(data), end + context)
+      pieces.append(data[left: right])
+      info.append((sent_id, start, start - left, end - start, n_pieces))
+  return pieces, info
+
+
+def write_embeddings(handlers, output_layers, sent, text, data):
+  """
+  Write the embeddings of one sentence to all the output handlers.
+
+  :param handlers: dict, output format -> file handler.
+  :param output_layers: list of int, -1 for the average of all the layers.
+  :param sent: str, the key of the sentence.
+  :param text: list of str, the tokens.
+  :param data: numpy array, [n_layers, seq_len, dim]
+  :return:
+  """
+  for output_format, fout in handlers.items():
+    if output_layers[0] == -1:
+      payload = np.average(data, axis=0)
+    else:
+      payload = data[output_layers, :, :]
+
+    if output_format == 'hdf5':
+      fout.create_dataset(sent, payload.shape, dtype='float32', data=payload)
+    else:
+      for word, row in zip(text, payload):
+        print('{0}\t{1}'.format(word, '\t'.join(['{0:.8f}'.format(elem) for elem in row])), file=fout)
+      print('', file=fout)
+
+
 class Model(torch.nn.Module):
   def __init__(self, config, word_emb_layer, char_emb_layer, use_cuda=False):
     super(Model, self).__init__()
@@ -318,31 +398,16 @@ class Model(torch.nn.Module):
                                             map_location=lambda storage, loc: storage))
 
 
-def test_main():
-  # Configurations
-  cmd = argparse.ArgumentParser('The testing components of')
-  cmd.add_argument('--gpu', default=-1, type=int, help='use id of gpu, -1 if cpu.')
-  cmd.add_argument('--input_format', default='plain', choices=('plain', 'conll', 'conll_char', 'conll_char_vi'),
-                   help='the input format.')
-  cmd.add_argument("--input", help="the path to the raw text file.")
-  cmd.add_argument("--output_format", default='hdf5', help='the output format. Supported format includes (hdf5, txt).'
-                                                           ' Use comma to separate the format identifiers,'
-                                                           ' like \'--output_format=hdf5,plain\'')
-  cmd.add_argument("--output_prefix", help='the prefix of the output file. The output file is in the format of '
-                                           '<output_prefix>.<output_layer>.<output_format>')
-  cmd.add_argument("--output_layer", required=True,
-                   help='the target layer to output. 0 for the word encoder, 1 for the first LSTM '
-                        'hidden layer, 2 for the second LSTM hidden layer, -1 for an average '
-                        'of 3 layers.')
-  cmd.add_argument("--model", required=True, help="path to save model")
-  cmd.add_argument("--batch_size", "--batch", type=int, default=1, help='the batch size.')
-  args = cmd.parse_args(sys.argv[2:])
+def load_model(model_path, use_cuda=False):
+  """
+  Load the configurations, the lexicons and the weights of a trained model.
 
-  if args.gpu >= 0:
-    torch.cuda.set_device(args.gpu)
-  use_cuda = args.gpu >= 0 and torch.cuda.is_available()
+  :param model_path: str, the path to the model directory.
+  :param use_cuda: bool
+  :return: (config, model, word_lexicon, char_lexicon)
+  """
   # load the model configurations
-  args2 = dict2namedtuple(json.load(codecs.open(os.path.join(args.model, 'config.json'), 'r', encoding='utf-8')))
+  args2 = dict2namedtuple(json.load(codecs.open(os.path.join(model_path, 'config.json'), 'r', encoding='utf-8')))
 
   with open(args2.config_path, 'r') as fin:
     config = json.load(fin)
@@ -350,7 +415,7 @@ def test_main():
   # For the model trained with character-based word encoder.
   if config['token_embedder']['char_dim'] > 0:
     char_lexicon = {}
-    with codecs.open(os.path.join(args.model, 'char.dic'), 'r', encoding='utf-8') as fpi:
+    with codecs.open(os.path.join(model_path, 'char.dic'), 'r', encoding='utf-8') as fpi:
       for line in fpi:
         tokens = line.strip().split('\t')
         if len(tokens) == 1:
@@ -366,7 +431,7 @@ def test_main():
   # For the model trained with word form word encoder.
   if config['token_embedder']['word_dim'] > 0:
     word_lexicon = {}
-    with codecs.open(os.path.join(args.model, 'word.dic'), 'r', encoding='utf-8') as fpi:
+    with codecs.open(os.path.join(model_path, 'word.dic'), 'r', encoding='utf-8') as fpi:
       for line in fpi:
         tokens = line.strip().split('\t')
         if len(tokens) == 1:
@@ -382,25 +447,125 @@ def test_main():
   # instantiate the model
   model = Model(config, word_emb_layer, char_emb_layer, use_cuda)
 
+  # For the model written by ``gen_elmo.py quantize``.
+  if getattr(args2, 'quantized', False):
+    if use_cuda:
+      raise ValueError('The quantized model only runs on CPU.')
+    quantize_model(model)
+
   if use_cuda:
     model.cuda()
 
   logging.info(str(model))
-  model.load_model(args.model)
+  model.load_model(model_path)
+  return config, model, word_lexicon, char_lexicon
 
-  # read test data according to input format
-  read_function = read_corpus if args.input_format == 'plain' else (
-    read_conll_corpus if args.input_format == 'conll' else (
-      read_conll_char_corpus if args.input_format == 'conll_char' else read_conll_char_vi_corpus))
+
+def read_test_data(input_format, path, config):
+  """
+  Read the test data according to the input format.
+
+  :param input_format: str, one of (plain, conll, conll_char, conll_char_vi)
+  :param path: str
+  :param config: dict, the model configurations.
+  :return: (dataset, textset)
+  """
+  read_function = read_corpus if input_format == 'plain' else (
+    read_conll_corpus if input_format == 'conll' else (
+      read_conll_char_corpus if input_format == 'conll_char' else read_conll_char_vi_corpus))
 
   if config['token_embedder']['name'].lower() == 'cnn':
-    test, text = read_function(args.input, config['token_embedder']['max_characters_per_token'])
+    return read_function(path, config['token_embedder']['max_characters_per_token'])
+  return read_function(path)
+
+
+def test_main():
+  # Configurations
+  cmd = argparse.ArgumentParser('The testing components of')
+  cmd.add_argument('--gpu', default=-1, type=int, help='use id of gpu, -1 if cpu.')
+  cmd.add_argument('--input_format', default='plain', choices=('plain', 'conll', 'conll_char', 'conll_char_vi'),
+                   help='the input format.')
+  cmd.add_argument("--input", help="the path to the raw text file.")
+  cmd.add_argument("--output_format", default='hdf5', help='the output format. Supported format includes (hdf5, txt).'
+                                                           ' Use comma to separate the format identifiers,'
+                                                           ' like \'--output_format=hdf5,plain\'')
+  cmd.add_argument("--output_prefix", help='the prefix of the output file. The output file is in the format of '
+                                           '<output_prefix>.<output_layer>.<output_format>')
+  cmd.add_argument("--output_layer", required=True,
+                   help='the target layer to output. 0 for the word encoder, 1 for the first LSTM '
+                        'hidden layer, 2 for the second LSTM hidden layer, -1 for an average '
+                        'of 3 layers.')
+  cmd.add_argument("--model", required=True, help="path to save model")
+  cmd.add_argument("--batch_size", "--batch", type=int, default=1, help='the batch size.')
+  cmd.add_argument("--native_lstm", default=False, action='store_true',
+                   help='run the elmo encoder with torch.nn.LSTM(proj_size=...), which skips cell_clip and '
+                        'proj_clip. Use the validate_native command to check the deviation first.')
+  cmd.add_argument("--window_size", type=int, default=0,
+                   help='split long sentences into overlapping windows that keep this many tokens each, '
+                        '0 to feed whole sentences.')
+  cmd.add_argument("--window_context", type=int, default=-1,
+                   help='the number of context tokens on each side of a window. It defaults to the receptive '
+                        'field of the window-based encoders and has to be set for elmo and lstm.')
+  cmd.add_argument('--precision', default='fp32', choices=('fp32', 'bf16'),
+                   help='bf16 to run the model under bfloat16 autocast, the embeddings are written in fp32.')
+  cmd.add_argument('--quantize', default=False, action='store_true',
+                   help='quantize the model to int8 after loading it, see `quantize`. CPU only.')
+  cmd.add_argument('--timing_steps', type=int, default=0,
+                   help='report the tokens/sec and the time of every stage every xx batches, 0 to disable.')
+  cmd.add_argument('--timing_output', help='append the timing reports to this file as JSON lines.')
+  cmd.add_argument('--profile_steps', type=parse_steps,
+                   help='run torch.profiler over the batches a:b (counted from 0) and write a Chrome trace and '
+                        'summary tables to --profile_dir.')
+  cmd.add_argument('--profile_dir', help='the directory of the profile, <output_prefix>.profile by default.')
+  args = cmd.parse_args(sys.argv[2:])
+
+  if args.gpu >= 0:
+    torch.cuda.set_device(args.gpu)
+  use_cuda = args.gpu >= 0 and torch.cuda.is_available()
+  config, model, word_lexicon, char_lexicon = load_model(args.model, use_cuda)
+
+  if args.quantize:
+    if use_cuda:
+      raise ValueError('--quantize only runs on CPU.')
+    quantize_model(model)
+
+  if args.native_lstm:
+    if config['encoder']['name'].lower() != 'elmo':
+      raise ValueError('--native_lstm only applies to the elmo encoder.')
+    model.encoder.build_native_lstm()
+
+  # read test data according to input format
+  test, text = read_test_data(args.input_format, args.input, config)
+
+  encoder_name = config['encoder']['name'].lower()
+  if args.window_size > 0:
+    context = args.window_context
+    if context < 0:
+      context = get_receptive_field(config)
+      if context is None:
+        raise ValueError('--window_context is required for the {} encoder.'.format(encoder_name))
+    if config['encoder'].get('position', False):
+      logging.warning('the positional encoding depends on the absolute position, '
+                      'the windowed outputs will differ from the whole-sentence outputs.')
+    logging.info('window size: {0}, context: {1}'.format(args.window_size, context))
+    # the pieces are batched instead of the sentences, and the info of each piece
+    # travels with it as its "text".
+    test, info = split_into_windows(test, args.window_size, context)
   else:
-    test, text = read_function(args.input)
+    info = [(sent_id, 0, 0, len(data), 1) for sent_id, data in enumerate(test)]
+
+  timer = None
+  if args.timing_steps > 0:
+    timer = StageTimer(use_cuda, args.timing_output)
+    timer.add_module('token_embedder', model.token_embedder)
+    timer.add_module('encoder', model.encoder)
 
   # create test batches from the input data.
-  test_w, test_c, test_lens, test_masks, test_text = create_batches(
-    test, args.batch_size, word_lexicon, char_lexicon, config, use_cuda=use_cuda, text=text)
+  start_time = time.time()
+  test_w, test_c, test_lens, test_masks, test_info = create_batches(
+    test, args.batch_size, word_lexicon, char_lexicon, config, use_cuda=use_cuda, text=info)
+  if timer is not None:
+    logging.info('Built {0} batches in {1:.2f}s.'.format(len(test_w), time.time() - start_time))
 
   # configure the model to evaluation mode.
   model.eval()
@@ -432,51 +597,178 @@ def test_main():
       print('#projection_dim: {}'.format(dim), file=fout)
       print('#n_layers: {}'.format(n_layers), file=fout)
 
-  for w, c, lens, masks, texts in zip(test_w, test_c, test_lens, test_masks, test_text):
-    output = model.forward(w, c, masks)
-    for i, text in enumerate(texts):
-      sent = '\t'.join(text)
-      sent = sent.replace('.', '$period$')
-      sent = sent.replace('/', '$backslash$')
-      if sent in sent_set:
-        continue
-      sent_set.add(sent)
-      encoder_name = config['encoder']['name'].lower()
-      if encoder_name == 'lstm':
-        data = output[i, 1:lens[i]-1, :].data
-        if use_cuda:
-          data = data.cpu()
-      elif encoder_name in ('elmo', 'bengio03highway', 'bengio03resnet', 'lblhighway', 'lblresnet', 'selfattn'):
-        data = output[:, i, 1:lens[i]-1, :].data
+  profiler = None
+  if args.profile_steps is not None:
+    profiler = StepProfiler(args.profile_steps, args.profile_dir or args.output_prefix + '.profile', use_cuda)
+
+  # the finished pieces of the sentences which are not complete yet.
+  pending = {}
+  for w, c, lens, masks, infos in zip(test_w, test_c, test_lens, test_masks, test_info):
+    with timed(timer, 'forward'):
+      with autocast(args.precision, use_cuda):
+        output = model.forward(w, c, masks)
+      output = output.float()
+    with timed(timer, 'write'):
+      for i, (sent_id, start, offset, length, n_pieces) in enumerate(infos):
+        if encoder_name == 'lstm':
+          data = output[i, offset: offset + length, :].data
+        elif encoder_name in ('elmo', 'bengio03highway', 'bengio03resnet', 'lblhighway', 'lblresnet', 'selfattn'):
+          data = output[:, i, offset: offset + length, :].data
+        else:
+          raise ValueError('unknown encoder name: {}'.format(encoder_name))
         if use_cuda:
           data = data.cpu()
-      else:
-        raise ValueError('unknown encoder name: {}'.format(encoder_name))
-      data = data.numpy()
-
-      for output_format in output_formats:
-        fout = handlers[output_format]
-        if output_layers[0] == -1:
-          payload = np.average(data, axis=0)
-        else:
-          payload = data[output_layers, :, :]
 
-        if output_format == 'hdf5':
-          fout.create_dataset(sent, payload.shape, dtype='float32', data=payload)
-        else:
-          for word, row in zip(text, payload):
-            print('{0}\t{1}'.format(word, '\t'.join(['{0:.8f}'.format(elem) for elem in row])), file=fout)
-          print('', file=fout)
+        pieces = pending.setdefault(sent_id, [])
+        pieces.append((start, data))
+        if len(pieces) < n_pieces:
+          continue
+        del pending[sent_id]
+
+        # stitch the kept tokens of the pieces and strip <bos> and <eos>.
+        time_dim = 0 if encoder_name == 'lstm' else 1
+        pieces.sort(key=lambda piece: piece[0])
+        data = torch.cat([piece for _, piece in pieces], dim=time_dim)
+        data = data.narrow(time_dim, 1, data.size(time_dim) - 2).numpy()
+
+        sent = '\t'.join(text[sent_id])
+        sent = sent.replace('.', '$period$')
+        sent = sent.replace('/', '$backslash$')
+        if sent in sent_set:
+          continue
+        sent_set.add(sent)
+        write_embeddings(handlers, output_layers, sent, text[sent_id], data)
+
+        cnt += 1
+        if cnt % 1000 == 0:
+          logging.info('Finished {0} sentences.'.format(cnt))
+
+    if timer is not None:
+      timer.step(sum(lens))
+      if timer.total_steps % args.timing_steps == 0:
+        timer.report(batch=timer.total_steps)
+    if profiler is not None:
+      profiler.step()
+  if profiler is not None:
+    profiler.stop()
+  if timer is not None:
+    if timer.n_steps > 0:
+      timer.report(batch=timer.total_steps)
+    timer.close()
 
-      cnt += 1
-      if cnt % 1000 == 0:
-        logging.info('Finished {0} sentences.'.format(cnt))
   for _, handler in handlers.items():
     handler.close()
 
 
+def validate_native_main():
+  """
+  Run the reference ``ElmobiLm`` and its native ``torch.nn.LSTM`` backend on the same
+  input and report the maximum absolute deviation of every output layer.
+  """
+  cmd = argparse.ArgumentParser('Compare the native LSTM backend against the reference implementation')
+  cmd.add_argument('--gpu', default=-1, type=int, help='use id of gpu, -1 if cpu.')
+  cmd.add_argument('--input_format', default='plain', choices=('plain', 'conll', 'conll_char', 'conll_char_vi'),
+                   help='the input format.')
+  cmd.add_argument("--input", required=True, help="the path to the raw text file.")
+  cmd.add_argument("--model", required=True, help="path to save model")
+  cmd.add_argument("--batch_size", "--batch", type=int, default=1, help='the batch size.')
+  args = cmd.parse_args(sys.argv[2:])
+
+  if args.gpu >= 0:
+    torch.cuda.set_device(args.gpu)
+  use_cuda = args.gpu >= 0 and torch.cuda.is_available()
+  config, model, word_lexicon, char_lexicon = load_model(args.model, use_cuda)
+  if config['encoder']['name'].lower() != 'elmo':
+    raise ValueError('validate_native only applies to the elmo encoder.')
+
+  test, text = read_test_data(args.input_format, args.input, config)
+  test_w, test_c, test_lens, test_masks = create_batches(
+    test, args.batch_size, word_lexicon, char_lexicon, config, use_cuda=use_cuda)
+
+  model.eval()
+  model.encoder.build_native_lstm()
+  native_layers = model.encoder.native_layers
+
+  max_deviation = None
+  with torch.no_grad():
+    for w, c, lens, masks in zip(test_w, test_c, test_lens, test_masks):
+      # Both runs have to start from the same (stateful) encoder states.
+      states = None if model.encoder._states is None else tuple(s.clone() for s in model.encoder._states)
+      model.encoder.native_layers = None
+      reference = model.forward(w, c, masks)
+      model.encoder._states = states
+      model.encoder.native_layers = native_layers
+      native = model.forward(w, c, masks)
+
+      deviation = (reference - native).abs().reshape(reference.size(0), -1).max(dim=1)[0]
+      max_deviation = deviation if max_deviation is None else torch.max(max_deviation, deviation)
+
+  for layer, value in enumerate(max_deviation.tolist()):
+    logging.info('layer {0}: max absolute deviation {1:.8f}'.format(layer, value))
+  logging.info('max absolute deviation: {0:.8f}'.format(max_deviation.max().item()))
+
+
+def quantize_main():
+  """
+  Quantize a trained model to int8 for CPU inference, write it as a model directory that
+  ``test`` loads as usual, and report the cosine similarity between the embeddings of the
+  original model and the quantized one on the input.
+  """
+  cmd = argparse.ArgumentParser('Quantize a model to int8 for CPU inference')
+  cmd.add_argument('--input_format', default='plain', choices=('plain', 'conll', 'conll_char', 'conll_char_vi'),
+                   help='the input format.')
+  cmd.add_argument("--input", help="the path to the raw text file to measure the drift of the embeddings on.")
+  cmd.add_argument("--model", required=True, help="path to the trained model")
+  cmd.add_argument("--output", required=True, help="path to save the quantized model")
+  cmd.add_argument("--batch_size", "--batch", type=int, default=1, help='the batch size.')
+  args = cmd.parse_args(sys.argv[2:])
+
+  config, model, word_lexicon, char_lexicon = load_model(args.model)
+  model.eval()
+  quantized = quantize_model(copy.deepcopy(model))
+
+  os.makedirs(args.output, exist_ok=True)
+  with codecs.open(os.path.join(args.model, 'config.json'), 'r', encoding='utf-8') as fin:
+    model_config = json.load(fin)
+  model_config['quantized'] = True
+  new_config_path = os.path.join(args.output, os.path.basename(model_config['config_path']))
+  with open(new_config_path, 'w') as fout:
+    json.dump(config, fout, indent=2)
+  model_config['config_path'] = new_config_path
+  with codecs.open(os.path.join(args.output, 'config.json'), 'w', encoding='utf-8') as fout:
+    json.dump(model_config, fout, indent=2)
+  for filename in ('word.dic', 'char.dic'):
+    if os.path.exists(os.path.join(args.model, filename)):
+      shutil.copy(os.path.join(args.model, filename), os.path.join(args.output, filename))
+  torch.save(quantized.token_embedder.state_dict(), os.path.join(args.output, 'token_embedder.pkl'))
+  torch.save(quantized.encoder.state_dict(), os.path.join(args.output, 'encoder.pkl'))
+
+  sizes = [sum(os.path.getsize(os.path.join(path, filename)) for filename in ('token_embedder.pkl', 'encoder.pkl'))
+           for path in (args.model, args.output)]
+  logging.info('weights: {0:.1f}MB -> {1:.1f}MB, written to {2}.'.format(
+    sizes[0] / 2 ** 20, sizes[1] / 2 ** 20, args.output))
+
+  if args.input is None:
+    return
+  test, text = read_test_data(args.input_format, args.input, config)
+  test_w, test_c, test_lens, test_masks = create_batches(test, args.batch_size, word_lexicon, char_lexicon, config)
+
+  similarities = []
+  with torch.no_grad():
+    for w, c, lens, masks in zip(test_w, test_c, test_lens, test_masks):
+      similarities.append(cosine_drift(model.forward(w, c, masks), quantized.forward(w, c, masks), masks[0]))
+  similarities = torch.cat(similarities, dim=1)
+  for layer in range(similarities.size(0)):
+    logging.info('layer {0}: cosine similarity mean {1:.6f}, min {2:.6f}'.format(
+      layer, similarities[layer].mean().item(), similarities[layer].min().item()))
+
+
 if __name__ == "__main__":
   if len(sys.argv) > 1 and sys.argv[1] == 'test':
     test_main()
+  elif len(sys.argv) > 1 and sys.argv[1] == 'validate_native':
+    validate_native_main()
+  elif len(sys.argv) > 1 and sys.argv[1] == 'quantize':
+    quantize_main()
   else:
-    print('Usage: {0} [test] [options]'.format(sys.argv[0]), file=sys.stderr)
+    print('Usage: {0} [test|validate_native|quantize] [options]'.format(sys.argv[0]), file=sys.stderr)
@@ -0,0 +1,42 @@
+import logging
+import torch
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)-15s %(levelname)s: %(message)s')
+
+
+class AdaptiveSoftmaxLayer(torch.nn.Module):
+  """
+  Adaptive softmax (Grave et al., 2017). The word ids are expected to be sorted by frequency:
+  the head covers the ids below the first cutoff, and every tail cluster has a projection
+  ``div_value`` times smaller than the previous one. Both training and evaluation are exact.
+  """
+  def __init__(self, input_dim: int, n_class: int, cutoffs, div_value: float = 4.0):
+    """
+
+    :param input_dim: int
+    :param n_class: int
+    :param cutoffs: list of int, the boundaries of the clusters. Those not below ``n_class`` are dropped.
+    :param div_value: float
+    """
+    super(AdaptiveSoftmaxLayer, self).__init__()
+    valid_cutoffs = [cutoff for cutoff in cutoffs if 0 < cutoff < n_class]
+    if len(valid_cutoffs) == 0:
+      raise ValueError('No adaptive softmax cutoff is within the vocabulary size {}.'.format(n_class))
+    if len(valid_cutoffs) < len(cutoffs):
+      logging.warning('adaptive softmax cutoffs {0} are truncated to {1}.'.format(cutoffs, valid_cutoffs))
+
+    self.adaptive = torch.nn.AdaptiveLogSoftmaxWithLoss(input_dim, n_class, valid_cutoffs, div_value=div_value)
+
+  @torch.profiler.record_function('AdaptiveSoftmaxLayer')
+  def forward(self, embeddings: torch.Tensor, targets: torch.Tensor, reduction: str = 'sum'):
+    """
+
+    :param embeddings: torch.Tensor
+    :param targets: torch.Tensor
+    :param reduction: str, 'sum' or 'none' for the loss of every target.
+    :return: the negative log likelihood.
+    """
+    if embeddings.size(0) == 0:
+      return embeddings.new_zeros(0) if reduction == 'none' else embeddings.new_zeros(())
+    nll = -self.adaptive(embeddings, targets.long()).output.float()
+    return nll if reduction == 'none' else nll.sum()
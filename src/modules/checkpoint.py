@@ -0,0 +1,57 @@
+import os
+import threading
+import torch
+
+
+def snapshot(obj):
+  """
+  Copy all the tensors in a (nested) state to the CPU, so that it can be written while
+  the training goes on.
+
+  :param obj: a tensor, or dict / list / tuple of them.
+  :return:
+  """
+  if isinstance(obj, torch.Tensor):
+    return obj.detach().cpu().clone()
+  elif isinstance(obj, dict):
+    return {key: snapshot(value) for key, value in obj.items()}
+  elif isinstance(obj, list):
+    return [snapshot(value) for value in obj]
+  elif isinstance(obj, tuple):
+    return tuple(snapshot(value) for value in obj)
+  return obj
+
+
+class AsyncCheckpointWriter(object):
+  """
+  Write the checkpoints in a background thread. The file is written to a temporary path
+  and renamed, so that a crash never leaves a partial checkpoint behind. A new checkpoint
+  waits for the previous one to finish.
+  """
+  def __init__(self, path: str):
+    """
+
+    :param path: str, the path to the checkpoint file.
+    """
+    self.path = path
+    self.thread = None
+
+  def save(self, checkpoint):
+    """
+
+    :param checkpoint: the CPU snapshot to write.
+    :return:
+    """
+    self.wait()
+    self.thread = threading.Thread(target=self._write, args=(checkpoint,))
+    self.thread.start()
+
+  def _write(self, checkpoint):
+    tmp_path = self.path + '.tmp'
+    torch.save(checkpoint, tmp_path)
+    os.replace(tmp_path, self.path)
+
+  def wait(self):
+    if self.thread is not None:
+      self.thread.join()
+      self.thread = None
@@ -8,7 +8,7 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)-15s %(levelname)s: %(
 
 
 class EmbeddingLayer(nn.Module):
-  def __init__(self, n_d, word2id, embs=None, fix_emb=True, oov='<oov>', pad='<pad>', normalize=True):
+  def __init__(self, n_d, word2id, embs=None, fix_emb=True, oov='<oov>', pad='<pad>', normalize=True, sparse=False):
     super(EmbeddingLayer, self).__init__()
     if embs is not None:
       embwords, embvecs = embs
@@ -27,7 +27,7 @@ class EmbeddingLayer(nn.Module):
     self.n_V, self.n_d = len(word2id), n_d
     self.oovid = word2id[oov]
     self.padid = word2id[pad]
-    self.embedding = nn.Embedding(self.n_V, n_d, padding_idx=self.padid)
+    self.embedding = nn.Embedding(self.n_V, n_d, padding_idx=self.padid, sparse=sparse)
     self.embedding.weight.data.uniform_(-0.25, 0.25)
 
     if embs is not None:
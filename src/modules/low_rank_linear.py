@@ -0,0 +1,73 @@
+import torch
+
+
+class LowRankLinear(torch.nn.Module):
+  """
+  A ``torch.nn.Linear`` whose weight is the product of two thin matrices, ``up.weight @ down.weight``
+  of rank ``rank``. It takes ``rank * (in_features + out_features)`` multiply-adds per input
+  instead of ``in_features * out_features``, so it is cheaper as long as the rank is well below
+  ``in_features * out_features / (in_features + out_features)``.
+
+  ``weight`` and ``bias`` give the equivalent ``torch.nn.Linear``, e.g. to build the native LSTM.
+  """
+  def __init__(self, in_features: int, out_features: int, rank: int, bias: bool = True):
+    """
+
+    :param in_features: int
+    :param out_features: int
+    :param rank: int
+    :param bias: bool
+    """
+    super(LowRankLinear, self).__init__()
+    if rank <= 0 or rank > min(in_features, out_features):
+      raise ValueError('The rank should be in [1, {0}], got {1}.'.format(min(in_features, out_features), rank))
+    self.in_features = in_features
+    self.out_features = out_features
+    self.rank = rank
+    self.down = torch.nn.Linear(in_features, rank, bias=False)
+    self.up = torch.nn.Linear(rank, out_features, bias=bias)
+
+  @property
+  def weight(self) -> torch.Tensor:
+    return self.up.weight.matmul(self.down.weight)
+
+  @property
+  def bias(self) -> torch.Tensor:
+    return self.up.bias
+
+  def factorize_(self, weight: torch.Tensor, bias: torch.Tensor = None):
+    """
+    Set the factors to the best rank-``rank`` approximation of ``weight`` (the truncated SVD),
+    splitting the singular values evenly between them.
+
+    :param weight: [out_features, in_features]
+    :param bias: [out_features], or None to keep the bias.
+    :return: self
+    """
+    with torch.no_grad():
+      u, s, vh = torch.linalg.svd(weight.detach().float(), full_matrices=False)
+      root = s[:self.rank].sqrt()
+      self.up.weight.copy_(u[:, :self.rank] * root.unsqueeze(0))
+      self.down.weight.copy_(root.unsqueeze(1) * vh[:self.rank])
+      if bias is not None and self.up.bias is not None:
+        self.up.bias.copy_(bias.detach())
+    return self
+
+  @classmethod
+  def from_linear(cls, linear, rank: int):
+    """
+    The rank-``rank`` approximation of ``linear``.
+
+    :param linear: torch.nn.Linear, or LowRankLinear.
+    :param rank: int
+    :return: LowRankLinear
+    """
+    module = cls(linear.in_features, linear.out_features, rank, linear.bias is not None)
+    module = module.to(linear.weight.device)
+    return module.factorize_(linear.weight, linear.bias)
+
+  def forward(self, inputs: torch.Tensor) -> torch.Tensor:
+    return self.up(self.down(inputs))
+
+  def extra_repr(self):
+    return 'in_features={0}, out_features={1}, rank={2}'.format(self.in_features, self.out_features, self.rank)
@@ -9,6 +9,7 @@ import torch
 from torch.autograd import Variable
 
 from .util import block_orthogonal, get_dropout_mask
+from .low_rank_linear import LowRankLinear
 
 
 class LstmCellWithProjection(torch.nn.Module):
@@ -38,6 +39,9 @@ class LstmCellWithProjection(torch.nn.Module):
         The magnitude with which to clip the hidden_state after projecting it.
     memory_cell_clip_value: ``float``, optional, (default = None)
         The magnitude with which to clip the memory cell.
+    factorized_rank: ``int``, optional, (default = 0)
+        Factorize the input and the state linearities into ``LowRankLinear`` of this rank,
+        0 for the full rank.
     Returns
     -------
     output_accumulator : ``torch.FloatTensor``
@@ -58,7 +62,8 @@ class LstmCellWithProjection(torch.nn.Module):
                  go_forward: bool = True,
                  recurrent_dropout_probability: float = 0.0,
                  memory_cell_clip_value: Optional[float] = None,
-                 state_projection_clip_value: Optional[float] = None) -> None:
+                 state_projection_clip_value: Optional[float] = None,
+                 factorized_rank: int = 0) -> None:
         super(LstmCellWithProjection, self).__init__()
         # Required to be wrapped with a :class:`PytorchSeq2SeqWrapper`.
         self.input_size = input_size
@@ -71,17 +76,28 @@ class LstmCellWithProjection(torch.nn.Module):
         self.recurrent_dropout_probability = recurrent_dropout_probability
 
         # We do the projections for all the gates all at once.
-        self.input_linearity = torch.nn.Linear(input_size, 4 * cell_size, bias=False)
-        self.state_linearity = torch.nn.Linear(hidden_size, 4 * cell_size, bias=True)
+        if factorized_rank > 0:
+            self.input_linearity = LowRankLinear(input_size, 4 * cell_size, factorized_rank, bias=False)
+            self.state_linearity = LowRankLinear(hidden_size, 4 * cell_size, factorized_rank, bias=True)
+        else:
+            self.input_linearity = torch.nn.Linear(input_size, 4 * cell_size, bias=False)
+            self.state_linearity = torch.nn.Linear(hidden_size, 4 * cell_size, bias=True)
 
         # Additional projection matrix for making the hidden state smaller.
         self.state_projection = torch.nn.Linear(cell_size, hidden_size, bias=False)
         self.reset_parameters()
 
     def reset_parameters(self):
-        # Use sensible default initializations for parameters.
-        block_orthogonal(self.input_linearity.weight.data, [self.cell_size, self.input_size])
-        block_orthogonal(self.state_linearity.weight.data, [self.cell_size, self.hidden_size])
+        # Use sensible default initializations for parameters. The factorized linearities
+        # start from the best low-rank approximation of the same initialization.
+        for linearity, input_size in ((self.input_linearity, self.input_size),
+                                      (self.state_linearity, self.hidden_size)):
+            if isinstance(linearity, LowRankLinear):
+                weight = linearity.weight.detach().clone()
+                block_orthogonal(weight, [self.cell_size, input_size])
+                linearity.factorize_(weight)
+            else:
+                block_orthogonal(linearity.weight.data, [self.cell_size, input_size])
 
         self.state_linearity.bias.data.fill_(0.0)
         # Initialize forget gate biases to 1.0 as per An Empirical
@@ -91,7 +107,8 @@ class LstmCellWithProjection(torch.nn.Module):
     def forward(self,  # pylint: disable=arguments-differ
                 inputs: torch.FloatTensor,
                 batch_lengths: List[int],
-                initial_state: Optional[Tuple[torch.Tensor, torch.Tensor]] = None):
+                initial_state: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+                reset_mask: Optional[torch.Tensor] = None):
         """
         Parameters
         ----------
@@ -104,6 +121,10 @@ class LstmCellWithProjection(torch.nn.Module):
             A tuple (state, memory) representing the initial hidden state and memory
             of the LSTM. The ``state`` has shape (1, batch_size, hidden_size) and the
             ``memory`` has shape (1, batch_size, cell_size).
+        reset_mask : ``torch.FloatTensor``, optional, (default = None)
+            A tensor of shape (batch_size, num_timesteps), 1 at the timesteps where the
+            state is reset to zero before the step is computed, for several segments
+            packed into one sequence.
         Returns
         -------
         output_accumulator : ``torch.FloatTensor``
@@ -118,6 +139,10 @@ class LstmCellWithProjection(torch.nn.Module):
         """
         batch_size = inputs.size()[0]
         total_timesteps = inputs.size()[1]
+        # Under autocast the projections run in lower precision, while the states, the gates
+        # and the clipping stay in at least float32 (the weights may also be quantized).
+        dtype = torch.promote_types(inputs.dtype, torch.float32)
+        inputs = inputs.to(dtype)
 
         # We have to use this '.data.new().fill_' pattern to create tensors with the correct
         # type - forward has no knowledge of whether these are torch.Tensors or torch.cuda.Tensors.
@@ -171,13 +196,18 @@ class LstmCellWithProjection(torch.nn.Module):
             previous_memory = full_batch_previous_memory[0: current_length_index + 1].clone()
             # Shape (batch_size, hidden_size)
             previous_state = full_batch_previous_state[0: current_length_index + 1].clone()
+            if reset_mask is not None:
+                # A new segment starts at this timestep, so forget the previous one.
+                keep = 1.0 - reset_mask[0: current_length_index + 1, index].unsqueeze(1)
+                previous_memory = previous_memory * keep
+                previous_state = previous_state * keep
             # Shape (batch_size, input_size)
             timestep_input = inputs[0: current_length_index + 1, index]
 
             # Do the projections for all the gates all at once.
             # Both have shape (batch_size, 4 * cell_size)
-            projected_input = self.input_linearity(timestep_input)
-            projected_state = self.state_linearity(previous_state)
+            projected_input = self.input_linearity(timestep_input).to(dtype)
+            projected_state = self.state_linearity(previous_state).to(dtype)
 
             # Main LSTM equations using relevant chunks of the big linear
             # projections of the hidden state and inputs.
@@ -203,7 +233,7 @@ class LstmCellWithProjection(torch.nn.Module):
             pre_projection_timestep_output = output_gate * torch.tanh(memory)
 
             # shape (current_length_index, hidden_size)
-            timestep_output = self.state_projection(pre_projection_timestep_output)
+            timestep_output = self.state_projection(pre_projection_timestep_output).to(dtype)
             if self.state_projection_clip_value:
                 # pylint: disable=invalid-unary-operand-type
                 timestep_output = torch.clamp(timestep_output,
@@ -0,0 +1,53 @@
+import torch
+
+
+class MultipleOptimizer(object):
+  """
+  Step several optimizers as one, e.g. ``SparseAdam`` for the parameters with sparse
+  gradients and ``Adam`` for the others.
+  """
+  def __init__(self, *optimizers):
+    self.optimizers = [optimizer for optimizer in optimizers if optimizer is not None]
+
+  @property
+  def param_groups(self):
+    return [group for optimizer in self.optimizers for group in optimizer.param_groups]
+
+  def zero_grad(self):
+    for optimizer in self.optimizers:
+      optimizer.zero_grad()
+
+  def step(self):
+    for optimizer in self.optimizers:
+      optimizer.step()
+
+  def state_dict(self):
+    return [optimizer.state_dict() for optimizer in self.optimizers]
+
+  def load_state_dict(self, state_dicts):
+    for optimizer, state_dict in zip(self.optimizers, state_dicts):
+      optimizer.load_state_dict(state_dict)
+
+
+def get_sparse_parameters(model: torch.nn.Module):
+  """
+  The parameters that receive sparse gradients: the weights of the sparse embeddings and
+  those gathered by the modules with ``sparse = True``.
+
+  :param model:
+  :return: list of parameters, without duplicates.
+  """
+  parameters = []
+  for module in model.modules():
+    if isinstance(module, torch.nn.Embedding) and module.sparse:
+      parameters.append(module.weight)
+    elif getattr(module, 'sparse', False) and hasattr(module, 'sparse_parameters'):
+      parameters.extend(module.sparse_parameters())
+
+  seen = set()
+  unique_parameters = []
+  for parameter in parameters:
+    if id(parameter) not in seen and parameter.requires_grad:
+      seen.add(id(parameter))
+      unique_parameters.append(parameter)
+  return unique_parameters
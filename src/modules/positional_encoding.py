@@ -23,6 +23,16 @@ class PositionalEncoding(torch.nn.Module):
     pe = pe.unsqueeze(0)
     self.register_buffer('pe', pe)
 
-  def forward(self, x):
-    x = x + torch.autograd.Variable(self.pe[:, :x.size(1)], requires_grad=False)
+  def forward(self, x, positions=None):
+    """
+
+    :param x: [batch_size, seq_len, d_model]
+    :param positions: [batch_size, seq_len], the position of every step when it doesn't count
+      from the start of the row, e.g. in packed segments.
+    :return:
+    """
+    if positions is None:
+      x = x + torch.autograd.Variable(self.pe[:, :x.size(1)], requires_grad=False)
+    else:
+      x = x + self.pe[0][positions]
     return self.dropout(x)
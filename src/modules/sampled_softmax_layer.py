@@ -1,43 +1,81 @@
-from typing import Set, Tuple
+from typing import Tuple
 import logging
+import queue
+import threading
 import torch
 import numpy as np
+from modules.util import chunked_nll_loss
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)-15s %(levelname)s: %(message)s')
 
 
-def _choice(num_words: int, num_samples: int) -> Tuple[np.ndarray, int]:
+def _vectorized_choice(num_words: int, num_samples: int,
+                       random_state: np.random.RandomState = np.random) -> Tuple[np.ndarray, int]:
   """
-  Chooses ``num_samples`` samples without replacement from [0, ..., num_words).
+  Chooses ``num_samples`` samples without replacement from [0, ..., num_words), following
+  the log-uniform distribution. The ids are drawn in bulk and deduplicated with ``np.unique``.
+  The stream of draws is topped up ``num_samples`` at a time until it holds ``num_samples``
+  unique ids. ``num_tries`` is the position of the
+  draw that yields the last chosen id, as if the stream were consumed one by one.
   Returns a tuple (samples, num_tries).
   """
-  num_tries = 0
-  num_chosen = 0
+  log_num_words_p1 = np.log(num_words + 1)
+  stream = np.empty(0, dtype='int64')
 
-  def get_buffer() -> np.ndarray:
-    log_samples = np.random.rand(num_samples) * np.log(num_words + 1)
+  while True:
+    log_samples = random_state.rand(num_samples) * log_num_words_p1
     samples = np.exp(log_samples).astype('int64') - 1
-    return np.clip(samples, a_min=0, a_max=num_words - 1)
+    stream = np.concatenate([stream, np.clip(samples, a_min=0, a_max=num_words - 1)])
 
-  sample_buffer = get_buffer()
-  buffer_index = 0
-  samples: Set[int] = set()
+    # the index of the first occurrence of every unique id.
+    _, first_index = np.unique(stream, return_index=True)
+    if len(first_index) >= num_samples:
+      first_index = np.sort(first_index)[:num_samples]
+      return stream[first_index], int(first_index[-1]) + 1
 
-  while num_chosen < num_samples:
-    num_tries += 1
-    # choose sample
-    sample_id = sample_buffer[buffer_index]
-    if sample_id not in samples:
-      samples.add(sample_id)
-      num_chosen += 1
 
-    buffer_index += 1
-    if buffer_index == num_samples:
-      # Reset the buffer
-      sample_buffer = get_buffer()
-      buffer_index = 0
+class SampleProducer(object):
+  """
+  Pre-generates the negative samples in a background thread, so that the training step
+  only has to take them from a queue. It is called like ``_vectorized_choice``, and the
+  thread runs until ``close``.
+  """
+  def __init__(self, num_words: int, num_samples: int, queue_size: int, seed: int = None):
+    """
 
-  return np.array(list(samples)), num_tries
+    :param num_words:
+    :param num_samples:
+    :param queue_size: int, the maximum number of sample sets generated in advance.
+    :param seed: int, the seed of the random state owned by the producer thread.
+    """
+    self.num_words = num_words
+    self.num_samples = num_samples
+    self.queue = queue.Queue(maxsize=queue_size)
+    self.random_state = np.random.RandomState(seed)
+    self.stopped = threading.Event()
+
+    self.thread = threading.Thread(target=self._produce)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _produce(self):
+    while not self.stopped.is_set():
+      samples = _vectorized_choice(self.num_words, self.num_samples, self.random_state)
+      # wait for room in the queue, checking now and then whether the producer is closed.
+      while not self.stopped.is_set():
+        try:
+          self.queue.put(samples, timeout=0.1)
+          break
+        except queue.Full:
+          pass
+
+  def close(self):
+    self.stopped.set()
+    self.thread.join()
+
+  def __call__(self, num_words: int, num_samples: int) -> Tuple[np.ndarray, int]:
+    assert num_words == self.num_words and num_samples == self.num_samples
+    return self.queue.get()
 
 
 class SampledSoftmaxLayer(torch.nn.Module):
@@ -47,13 +85,21 @@ class SampledSoftmaxLayer(torch.nn.Module):
   def __init__(self, embedding_dim: int, num_words: int, num_samples: int,
                use_cuda: bool,
                unk_id: int = None,
-               use_character_inputs: bool = True):
+               use_character_inputs: bool = True,
+               sample_queue_size: int = 0,
+               eval_chunk_size: int = 8192,
+               sparse: bool = False):
     """
 
     :param embedding_dim:
     :param num_words:
     :param num_samples:
     :param use_cuda:
+    :param sample_queue_size: int, if positive, the negative samples are drawn by a background
+      thread that keeps up to this many sample sets ready. The thread is started by the first
+      training batch and stopped by ``close``.
+    :param eval_chunk_size: int, the number of words scored at a time in evaluation.
+    :param sparse: bool, gather the output weights with sparse gradients.
     """
     super(SampledSoftmaxLayer, self).__init__()
     assert num_samples < num_words
@@ -61,9 +107,11 @@ class SampledSoftmaxLayer(torch.nn.Module):
     self.n_samples = num_samples
     self.n_class = num_words
     self.use_cuda = use_cuda
-    self.criterion = torch.nn.CrossEntropyLoss(size_average=False)
+    self.eval_chunk_size = eval_chunk_size
+    self.sparse = sparse
 
-    self.choice_func = _choice
+    self.sample_queue_size = sample_queue_size
+    self.producer = None
 
     self.softmax_w = torch.nn.Parameter(torch.randn(num_words, embedding_dim) / np.sqrt(embedding_dim))
     self.softmax_b = torch.nn.Parameter(torch.zeros(num_words))
@@ -86,21 +134,33 @@ class SampledSoftmaxLayer(torch.nn.Module):
     self._probs = (np.log(np.arange(num_words) + 2) -
                    np.log(np.arange(num_words) + 1)) / self._log_num_words_p1
 
+  @torch.profiler.record_function('SampledSoftmaxLayer')
   def forward(self,
               embeddings: torch.Tensor,
-              targets: torch.Tensor) -> torch.Tensor:
+              targets: torch.Tensor,
+              reduction: str = 'sum') -> torch.Tensor:
+    """
+
+    :param embeddings:
+    :param targets:
+    :param reduction: str, 'sum' or 'none' for the loss of every target.
+    :return:
+    """
     if embeddings.shape[0] == 0:
       # empty batch
+      if reduction == 'none':
+        return embeddings.new_zeros(0)
       return torch.tensor(0.0).to(embeddings.device)  # pylint: disable=not-callable
 
     if not self.training:
-      return self._forward_eval(embeddings, targets)
+      return self._forward_eval(embeddings, targets, reduction)
     else:
-      return self._forward_train(embeddings, targets)
+      return self._forward_train(embeddings, targets, reduction)
 
   def _forward_train(self,
                      embeddings: torch.Tensor,
-                     targets: torch.Tensor) -> torch.Tensor:
+                     targets: torch.Tensor,
+                     reduction: str = 'sum') -> torch.Tensor:
     # pylint: disable=unused-argument
     # (target_token_embedding is only used in the tie_embeddings case,
     #  which is not implemented)
@@ -113,7 +173,7 @@ class SampledSoftmaxLayer(torch.nn.Module):
     # NOTE: targets input has padding removed (so 0 == the first id, NOT the padding id)
 
     sampled_ids, target_expected_count, sampled_expected_count = \
-      self.log_uniform_candidate_sampler(targets, choice_func=self.choice_func)
+      self.log_uniform_candidate_sampler(targets, choice_func=self.get_choice_func())
 
     long_targets = targets.long()
     long_targets.requires_grad_(False)
@@ -121,7 +181,7 @@ class SampledSoftmaxLayer(torch.nn.Module):
     # Get the softmax weights (so we can compute logits)
     all_ids = torch.cat([long_targets, sampled_ids], dim=0)
 
-    all_w = torch.nn.functional.embedding(all_ids, self.softmax_w)
+    all_w = torch.nn.functional.embedding(all_ids, self.softmax_w, sparse=self.sparse)
     # the unsqueeze / squeeze works around an issue with 1 dim
     # embeddings
     all_b = torch.nn.functional.embedding(all_ids, self.softmax_b.unsqueeze(1)).squeeze(1)
@@ -150,27 +210,55 @@ class SampledSoftmaxLayer(torch.nn.Module):
     logits = torch.cat([true_logits.unsqueeze(1), masked_sampled_logits], dim=1)
 
     # finally take log_softmax
-    log_softmax = torch.nn.functional.log_softmax(logits, dim=1)
+    log_softmax = torch.nn.functional.log_softmax(logits.float(), dim=1)
     # true log likelihood is index 0, loss = -1.0 * sum over batch
     # the likelihood loss can become very large if the corresponding
     # true logit is very small, so we apply a per-target cap here
     # so that a single logit for a very rare word won't dominate the batch.
     #nll_loss = -1.0 * torch.clamp(log_softmax[:, 0], -1000, 1e6).sum()
+    if reduction == 'none':
+      return -1.0 * log_softmax[:, 0]
     nll_loss = -1.0 * log_softmax[:, 0].sum()
     return nll_loss
 
-  def _forward_eval(self, embeddings: torch.Tensor, targets: torch.Tensor) -> torch.Tensor:
+  def get_choice_func(self):
+    if self.sample_queue_size <= 0:
+      return _vectorized_choice
+    if self.producer is None:
+      # the producer has its own random state, seeded from the global one.
+      self.producer = SampleProducer(self._num_words, self._num_samples, self.sample_queue_size,
+                                     seed=np.random.randint(2 ** 31 - 1))
+    return self.producer
+
+  def close(self):
+    """
+    Stop the sample producer, the next training batch starts a new one.
+    """
+    if self.producer is not None:
+      self.producer.close()
+      self.producer = None
+
+  def __getstate__(self):
+    # the producer holds a thread and a queue, the copies start their own.
+    state = self.__dict__.copy()
+    state['producer'] = None
+    return state
+
+  def sparse_parameters(self):
+    # the biases are small and stay dense.
+    return [self.softmax_w]
+
+  def _forward_eval(self, embeddings: torch.Tensor, targets: torch.Tensor, reduction: str = 'sum') -> torch.Tensor:
     # pylint: disable=invalid-name
     # evaluation mode, use full softmax
 
     w = self.softmax_w
     b = self.softmax_b
 
-    log_softmax = torch.nn.functional.log_softmax(torch.matmul(embeddings, w.t()) + b, dim=-1)
-    targets_ = targets
-    return torch.nn.functional.nll_loss(log_softmax, targets_.long(), reduction="sum")
+    return chunked_nll_loss(embeddings, targets.long(), lambda start, end: (w[start: end].t(), b[start: end]),
+                            w.size(0), self.eval_chunk_size, reduction)
 
-  def log_uniform_candidate_sampler(self, targets, choice_func=_choice):
+  def log_uniform_candidate_sampler(self, targets, choice_func=_vectorized_choice):
     # returns sampled, true_expected_count, sampled_expected_count
     # targets = (batch_size, )
     #
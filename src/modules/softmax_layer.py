@@ -1,27 +1,36 @@
 import logging
 import torch
+from modules.util import chunked_nll_loss
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)-15s %(levelname)s: %(message)s')
 
 
 class SoftmaxLayer(torch.nn.Module):
   """ Naive softmax-layer """
-  def __init__(self, input_dim: int, n_class: int):
+  def __init__(self, input_dim: int, n_class: int, eval_chunk_size: int = 8192):
     """
 
     :param input_dim: int
     :param n_class: int
+    :param eval_chunk_size: int, the number of classes scored at a time in evaluation.
     """
     super(SoftmaxLayer, self).__init__()
+    self.eval_chunk_size = eval_chunk_size
     self.hidden2tag = torch.nn.Linear(input_dim, n_class)
-    self.criterion = torch.nn.CrossEntropyLoss(size_average=False)
 
-  def forward(self, embeddings: torch.Tensor, targets: torch.Tensor):
+  @torch.profiler.record_function('SoftmaxLayer')
+  def forward(self, embeddings: torch.Tensor, targets: torch.Tensor, reduction: str = 'sum'):
     """
 
     :param embeddings: torch.Tensor
     :param targets: torch.Tensor
+    :param reduction: str, 'sum' or 'none' for the loss of every target.
     :return:
     """
-    tag_scores = self.hidden2tag(embeddings)
-    return self.criterion(tag_scores, targets)
+    if not self.training:
+      weight, bias = self.hidden2tag.weight, self.hidden2tag.bias
+      return chunked_nll_loss(embeddings, targets, lambda start, end: (weight[start: end].t(), bias[start: end]),
+                              weight.size(0), self.eval_chunk_size, reduction)
+    # the loss is computed in float32, also under autocast.
+    tag_scores = self.hidden2tag(embeddings).float()
+    return torch.nn.functional.cross_entropy(tag_scores, targets, reduction=reduction)
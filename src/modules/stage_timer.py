@@ -0,0 +1,163 @@
+import json
+import time
+import logging
+import contextlib
+import collections
+import torch
+
+
+class StageTimer(object):
+  """
+  Accumulate the wall time of the stages of training and inference, and report the time per
+  step and the tokens per second every few steps.
+
+  The sub-modules are timed with forward hooks, so the models don't change, but calling their
+  ``forward`` method directly is not counted. The other stages are timed with ``stage()`` and
+  ``iterate()``. A module called inside another one is counted in both, unless the outer stage
+  suspends the hooks, e.g. the re-embedding of the cnn_softmax window is only part of the
+  classifier time.
+  On GPU, the device is synchronized at the boundaries of the stages, so that the kernels are
+  counted in the stage that launched them. This costs some throughput, so only use the timer
+  when measuring.
+  """
+  def __init__(self, use_cuda: bool = False, output_path: str = None):
+    """
+
+    :param use_cuda: bool, synchronize the device at the boundaries of the stages.
+    :param output_path: str, append a JSON line per report to this file.
+    """
+    self.use_cuda = use_cuda
+    self.output = open(output_path, 'a') if output_path is not None else None
+    self.handles = []
+    self.starts = {}
+    self.suspended = False
+    self.total_steps = 0
+    self.reset()
+
+  def reset(self):
+    self.totals = collections.OrderedDict()
+    self.n_steps = 0
+    self.n_tokens = 0
+    self.start_time = self.now()
+
+  def now(self):
+    if self.use_cuda:
+      torch.cuda.synchronize()
+    return time.time()
+
+  def add(self, name: str, elapsed: float):
+    self.totals[name] = self.totals.get(name, 0.0) + elapsed
+
+  def add_module(self, name: str, module: torch.nn.Module):
+    """
+    Time every call of the module as the stage ``name``.
+
+    :param name: str
+    :param module: torch.nn.Module
+    :return:
+    """
+    def pre_hook(_, inputs):
+      if not self.suspended:
+        self.starts[name] = self.now()
+
+    def post_hook(_, inputs, output):
+      if name in self.starts:
+        self.add(name, self.now() - self.starts.pop(name))
+
+    self.totals.setdefault(name, 0.0)
+    self.handles.append(module.register_forward_pre_hook(pre_hook))
+    self.handles.append(module.register_forward_hook(post_hook))
+
+  @contextlib.contextmanager
+  def stage(self, name: str, hooks: bool = True):
+    """
+    Time the code in the block as the stage ``name``.
+
+    :param name: str
+    :param hooks: bool, False to leave the time of the hooked modules in the block out of their stages,
+      e.g. for evaluation.
+    :return:
+    """
+    suspended = self.suspended
+    self.suspended = suspended or not hooks
+    start_time = self.now()
+    try:
+      yield
+    finally:
+      self.add(name, self.now() - start_time)
+      self.suspended = suspended
+
+  def iterate(self, name: str, iterable):
+    """
+    Time the fetching of every item, e.g. building the batches.
+
+    :param name: str
+    :param iterable:
+    :return:
+    """
+    iterator = iter(iterable)
+    while True:
+      start_time = self.now()
+      try:
+        item = next(iterator)
+      except StopIteration:
+        return
+      self.add(name, self.now() - start_time)
+      yield item
+
+  def step(self, n_tokens: int):
+    self.n_steps += 1
+    self.total_steps += 1
+    self.n_tokens += n_tokens
+
+  def report(self, **info):
+    """
+    Log the average time per step of every stage since the last report, then start over.
+
+    :param info: the fields to report along, e.g. the epoch.
+    :return: dict, the report.
+    """
+    elapsed = self.now() - self.start_time
+    n_steps = max(self.n_steps, 1)
+    record = collections.OrderedDict(info)
+    record['steps'] = self.n_steps
+    record['tokens'] = self.n_tokens
+    record['time'] = elapsed
+    record['tokens_per_sec'] = self.n_tokens / elapsed if elapsed > 0 else 0.0
+    record['stages'] = collections.OrderedDict((name, {'total': total, 'per_step': total / n_steps})
+                                               for name, total in self.totals.items())
+
+    logging.info('{0} tokens/sec={1:.1f} {2}'.format(
+      ' '.join('{0}={1}'.format(key, value) for key, value in info.items()), record['tokens_per_sec'],
+      ' '.join('{0}={1:.1f}ms'.format(name, stage['per_step'] * 1000) for name, stage in record['stages'].items())))
+    if self.output is not None:
+      print(json.dumps(record), file=self.output)
+      self.output.flush()
+
+    names = list(self.totals.keys())
+    self.reset()
+    for name in names:
+      self.totals[name] = 0.0
+    return record
+
+  def close(self):
+    for handle in self.handles:
+      handle.remove()
+    self.handles = []
+    if self.output is not None:
+      self.output.close()
+      self.output = None
+
+
+def timed(timer, name: str, hooks: bool = True):
+  """
+  The ``timer.stage()`` block, or a block that does nothing when there is no timer.
+
+  :param timer: StageTimer or None
+  :param name: str
+  :param hooks: bool
+  :return:
+  """
+  if timer is None:
+    return contextlib.suppress()
+  return timer.stage(name, hooks)
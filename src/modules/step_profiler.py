@@ -0,0 +1,97 @@
+import os
+import logging
+import argparse
+import torch
+import torch.profiler
+
+
+def parse_steps(value: str):
+  """
+  Parse the ``a:b`` range of steps, for argparse.
+
+  :param value: str
+  :return: (int, int)
+  """
+  try:
+    start, end = [int(field) for field in value.split(':')]
+  except ValueError:
+    raise argparse.ArgumentTypeError('expected a:b, got {}'.format(value))
+  if start < 0 or end <= start:
+    raise argparse.ArgumentTypeError('expected 0 <= a < b, got {}'.format(value))
+  return start, end
+
+
+class StepProfiler(object):
+  """
+  Run ``torch.profiler`` over the steps [a, b), counted from 0, recording the shapes, the memory
+  and the stacks. When the steps are done, it writes into the output directory:
+
+    - trace.json, the Chrome trace, to open in chrome://tracing or Perfetto.
+    - stacks.txt, the self time of the stacks, for flame graphs.
+    - summary.txt, the tables of the operators by time, by input shape and by memory.
+
+  The steps before a are not profiled, so that the warm-up doesn't show in the trace.
+  """
+  def __init__(self, steps, output_dir: str, use_cuda: bool = False):
+    """
+
+    :param steps: (int, int), the steps [a, b) to profile.
+    :param output_dir: str
+    :param use_cuda: bool, also record the CUDA kernels.
+    """
+    start, end = steps
+    self.end = end
+    self.output_dir = output_dir
+    self.use_cuda = use_cuda
+    self.n_steps = 0
+
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if use_cuda:
+      activities.append(torch.profiler.ProfilerActivity.CUDA)
+    warmup = 1 if start > 0 else 0
+    self.profiler = torch.profiler.profile(
+      activities=activities,
+      schedule=torch.profiler.schedule(wait=start - warmup, warmup=warmup, active=end - start, repeat=1),
+      on_trace_ready=self.write,
+      record_shapes=True,
+      profile_memory=True,
+      with_stack=True)
+    self.profiler.start()
+
+  def step(self):
+    """
+    Mark the end of a step.
+
+    :return:
+    """
+    if self.profiler is None:
+      return
+    self.n_steps += 1
+    self.profiler.step()
+    if self.n_steps >= self.end:
+      self.stop()
+
+  def stop(self):
+    """
+    Stop profiling. The steps recorded so far are written if it stops before b.
+
+    :return:
+    """
+    if self.profiler is not None:
+      self.profiler.stop()
+      self.profiler = None
+
+  def write(self, profiler):
+    os.makedirs(self.output_dir, exist_ok=True)
+    sort_by = 'self_cuda_time_total' if self.use_cuda else 'self_cpu_time_total'
+    profiler.export_chrome_trace(os.path.join(self.output_dir, 'trace.json'))
+    profiler.export_stacks(os.path.join(self.output_dir, 'stacks.txt'), sort_by)
+
+    by_time = profiler.key_averages().table(sort_by=sort_by, row_limit=50)
+    by_shape = profiler.key_averages(group_by_input_shape=True).table(sort_by=sort_by, row_limit=50)
+    by_memory = profiler.key_averages().table(sort_by='self_cpu_memory_usage', row_limit=50)
+    with open(os.path.join(self.output_dir, 'summary.txt'), 'w') as fout:
+      for title, table in (('time', by_time), ('input shape', by_shape), ('memory', by_memory)):
+        print('# operators by {}'.format(title), file=fout)
+        print(table, file=fout)
+    logging.info('Profile written to {0}.\n{1}'.format(self.output_dir, by_time))
@@ -7,6 +7,7 @@ import logging
 import itertools
 import math
 import torch
+import torch.utils.checkpoint
 from torch.autograd import Variable
 
 def get_lengths_from_binary_sequence_mask(mask: torch.Tensor):
@@ -169,3 +170,136 @@ def block_orthogonal(tensor: torch.Tensor,
                 block_slice = tuple([slice(start_index, start_index + step)
                                      for start_index, step in index_and_step_tuples])
                 tensor[block_slice] = torch.nn.init.orthogonal_(tensor[block_slice].contiguous(), gain=gain)
+
+
+def clip_grad_norm_(parameters, max_norm: float) -> float:
+    """
+    Same as ``torch.nn.utils.clip_grad_norm_`` with the 2-norm, but the sparse gradients
+    are coalesced first, so that duplicated indices are counted once.
+    Parameters
+    ----------
+    parameters : Iterable[torch.Tensor], required.
+        The parameters whose gradients are clipped in place.
+    max_norm : float, required.
+        The maximum norm of the gradients.
+    Returns
+    -------
+    The total norm of the gradients before clipping.
+    """
+    parameters = [p for p in parameters if p.grad is not None]
+    total_norm = 0.0
+    for p in parameters:
+        if p.grad.is_sparse:
+            p.grad = p.grad.coalesce()
+            param_norm = p.grad._values().norm(2)
+        else:
+            param_norm = p.grad.detach().norm(2)
+        total_norm += param_norm.item() ** 2
+    total_norm = total_norm ** 0.5
+
+    clip_coef = max_norm / (total_norm + 1e-6)
+    if clip_coef < 1:
+        for p in parameters:
+            p.grad.detach().mul_(clip_coef)
+    return total_norm
+
+
+def chunked_nll_loss(inputs: torch.Tensor,
+                     targets: torch.Tensor,
+                     get_columns: Callable[[int, int], Tuple[torch.Tensor, Optional[torch.Tensor]]],
+                     num_columns: int,
+                     chunk_size: int,
+                     reduction: str = 'sum') -> torch.Tensor:
+    """
+    Compute the summed negative log likelihood of a softmax over ``num_columns`` classes
+    without materializing the ``(batch_size, num_columns)`` logits. The classes are scored
+    ``chunk_size`` columns at a time, and a running max and sum of exponentials give an
+    exact log-sum-exp.
+    Parameters
+    ----------
+    inputs : torch.Tensor, required.
+        A tensor of shape (batch_size, dim).
+    targets : torch.LongTensor, required.
+        A tensor of shape (batch_size,) with the target columns.
+    get_columns : Callable, required.
+        ``get_columns(start, end)`` returns the weight of shape (dim, end - start) and
+        the bias of shape (end - start,), or None, of the columns in [start, end).
+    num_columns : int, required.
+        The number of classes.
+    chunk_size : int, required.
+        The number of columns scored at a time.
+    reduction : str, optional (default = 'sum')
+        'sum', or 'none' for the negative log likelihood of every input.
+    Returns
+    -------
+    The summed negative log likelihood, a scalar tensor, or a tensor of shape (batch_size,).
+    """
+    batch_size = inputs.size(0)
+    # the log-sum-exp is accumulated in float32, also when the scores come out of autocast.
+    max_score = inputs.new_full((batch_size,), -float('inf'), dtype=torch.float)
+    sum_exp = inputs.new_zeros(batch_size, dtype=torch.float)
+    target_score = inputs.new_zeros(batch_size, dtype=torch.float)
+
+    for start in range(0, num_columns, chunk_size):
+        end = min(start + chunk_size, num_columns)
+        weight, bias = get_columns(start, end)
+        scores = inputs.matmul(weight).float()
+        if bias is not None:
+            scores = scores + bias.float()
+
+        new_max = torch.max(max_score, scores.max(dim=1)[0])
+        sum_exp = sum_exp * torch.exp(max_score - new_max) + \
+            torch.exp(scores - new_max.unsqueeze(1)).sum(dim=1)
+        max_score = new_max
+
+        in_chunk = (targets >= start) & (targets < end)
+        local_targets = (targets - start).clamp(0, end - start - 1)
+        chunk_target_score = scores.gather(1, local_targets.unsqueeze(1)).squeeze(1)
+        target_score = torch.where(in_chunk, chunk_target_score, target_score)
+
+    nll = max_score + torch.log(sum_exp) - target_score
+    return nll.sum() if reduction == 'sum' else nll
+
+
+def checkpoint_layer(function: Callable, *args, enabled: bool = True):
+    """
+    Call ``function(*args)``. When ``enabled`` and the gradients are recorded, the activations
+    inside ``function`` are not kept for the backward pass but recomputed from ``args`` (see
+    ``torch.utils.checkpoint``), which trades a second forward pass for the memory of a layer.
+    The random state is restored for the recomputation, so the dropout masks are the same.
+    Parameters
+    ----------
+    function : Callable, required.
+        The layer, returning a tensor or a tuple of tensors.
+    args : required.
+        The arguments of ``function``, tensors or any other value.
+    enabled : bool, optional (default = True)
+        False to call ``function`` as is.
+    Returns
+    -------
+    The outputs of ``function``.
+    """
+    if enabled and torch.is_grad_enabled():
+        return torch.utils.checkpoint.checkpoint(function, *args, use_reentrant=False)
+    return function(*args)
+
+
+def autocast(precision: str, use_cuda: bool = False):
+    """
+    The mixed-precision block of ``precision``. With 'bf16', the matrix multiplications and
+    the convolutions inside the block run in bfloat16, while the weights and their gradients
+    stay in float32. With 'fp32', the block does nothing.
+    Parameters
+    ----------
+    precision : str, required.
+        'fp32' or 'bf16'.
+    use_cuda : bool, optional (default = False)
+        Cast on the GPU instead of the CPU.
+    Returns
+    -------
+    A context manager.
+    """
+    if precision not in ('fp32', 'bf16'):
+        raise ValueError('Unknown precision: {}'.format(precision))
+    return torch.autocast(device_type='cuda' if use_cuda else 'cpu', dtype=torch.bfloat16,
+                          enabled=precision == 'bf16')
@@ -1,110 +1,159 @@
 #!/usr/bin/env python
 import torch
 import math
+import numpy as np
+from modules.window_sampled_softmax_layer import SampleWindow
+from modules.util import chunked_nll_loss
 
 
 class WindowSampledCNNSoftmaxLayer(torch.nn.Module):
-  def __init__(self, token_embedder, output_dim, n_class, n_samples, corr_dim, use_cuda):
+  def __init__(self, token_embedder, output_dim, n_class, n_samples, corr_dim, use_cuda, refresh_steps=0,
+               eval_chunk_size=8192, sparse=False):
+    """
+
+    :param token_embedder:
+    :param output_dim:
+    :param n_class:
+    :param n_samples:
+    :param corr_dim:
+    :param use_cuda:
+    :param refresh_steps: int, re-embed the whole window every this many training batches,
+      0 to only re-embed the words in the batch.
+    :param eval_chunk_size: int, the number of words scored at a time in evaluation.
+    :param sparse: bool, use an embedding with sparse gradients for the correction term.
+    """
     super(WindowSampledCNNSoftmaxLayer, self).__init__()
     self.token_embedder = token_embedder
     self.n_samples = n_samples
     self.use_cuda = use_cuda
-    self.criterion = torch.nn.CrossEntropyLoss(size_average=False)
-    self.negative_samples = []
-    self.word_to_column = {0: 0}
+    self.refresh_steps = refresh_steps
+    self.eval_chunk_size = eval_chunk_size
 
-    self.all_word = []
-    self.all_word_to_column = {0: 0}
+    # indexing of negative samples and all the words to columns, and the characters of
+    # every seen word.
+    self.window = SampleWindow(n_class, n_samples)
+    self.chars = None
+    self.words_in_batch = None
 
     self.M = torch.nn.Parameter(torch.Tensor(output_dim, corr_dim))
     stdv = 1. / math.sqrt(self.M.size(1))
     self.M.data.uniform_(-stdv, stdv)
 
-    self.corr = torch.nn.Embedding(n_class, corr_dim)
+    self.corr = torch.nn.Embedding(n_class, corr_dim, sparse=sparse)
     self.corr.weight.data.uniform_(-0.25, 0.25)
 
     self.oov_column = torch.nn.Parameter(torch.Tensor(output_dim, 1))
     self.oov_column.data.uniform_(-0.25, 0.25)
 
-  def forward(self, x, y):
-    if self.training:
-      for i in range(y.size(0)):
-        y[i] = self.word_to_column.get(y[i].tolist())
-      samples = torch.LongTensor(len(self.word_to_column)).fill_(0)
-      for package in self.negative_samples:
-        samples[self.word_to_column[package[0]]] = package[0]
-    else:
-      for i in range(y.size(0)):
-        y[i] = self.all_word_to_column.get(y[i].tolist(), 0)
-      samples = torch.LongTensor(len(self.all_word_to_column)).fill_(0)
-      for package in self.all_word:
-        samples[self.all_word_to_column[package[0]]] = package[0]
+    # the detached embeddings of the window slots, slot k being column k + 1.
+    self.cached_matrix = None
+    self.n_updates = 0
+    self.current_columns = None
+    self.embedding_matrix = None
 
-    if self.use_cuda:
-      samples = samples.cuda()
+  @torch.profiler.record_function('WindowSampledCNNSoftmaxLayer')
+  def forward(self, x, y, reduction='sum'):
+    """
+
+    :param x:
+    :param y:
+    :param reduction: str, 'sum' or 'none' for the loss of every target.
+    :return:
+    """
+    y = self.window.lookup(y, self.training)
+
+    if not self.training:
+      # the correction term is already folded into the evaluation matrix.
+      return chunked_nll_loss(x, y, lambda start, end: (self.embedding_matrix[:, start: end], None),
+                              self.embedding_matrix.size(1), self.eval_chunk_size, reduction)
 
     tag_scores = (x.matmul(self.embedding_matrix)).view(y.size(0), -1) + \
-                 (x.matmul(self.M).matmul(self.corr.forward(samples).transpose(0, 1))).view(y.size(0), -1)
-    return self.criterion(tag_scores, y)
+                 (x.matmul(self.M).matmul(self.corr.forward(self.current_columns).transpose(0, 1))).view(y.size(0), -1)
+    return torch.nn.functional.cross_entropy(tag_scores.float(), y, reduction=reduction)
 
-  def update_embedding_matrix(self):
+  def embed_words(self, words):
+    """
+    Run the token embedder over the words in chunks.
+
+    :param words: LongTensor, [n_words]
+    :return: [output_dim, n_words]
+    """
     batch_size = 2048
-    word_inp, chars_inp = [], []
-    if self.training:
-      sub_matrices = [self.oov_column]
-      samples = self.negative_samples
-      id2pack = {}
-      for i, package in enumerate(samples):
-        id2pack[self.word_to_column[package[0]]] = i
-    else:
-      sub_matrices = [self.oov_column]
-      samples = self.all_word
-      id2pack = {}
-      for i, package in enumerate(samples):
-        id2pack[self.all_word_to_column[package[0]]] = i
-
-    for i in range(len(samples)):
-      # [n_samples, 1], [n_samples, 1, x], [n_samples, 1]
-      word_inp.append(samples[id2pack[i + 1]][0])
-      chars_inp.append(samples[id2pack[i + 1]][1])
-      if len(word_inp) == batch_size or i == len(samples) - 1:
-        sub_matrices.append(self.token_embedder.forward(torch.LongTensor(word_inp).view(len(word_inp), 1),
-                                                        None if chars_inp[0] is None else torch.LongTensor(chars_inp).view(len(word_inp), 1, len(package[1])),
-                                                        (len(word_inp), 1)).squeeze(1).transpose(0, 1))
-        if not self.training:
-          sub_matrices[-1] = sub_matrices[-1].detach()
-        word_inp, chars_inp = [], []
-
-    sum = 0
-    for mat in sub_matrices:
-      sum += mat.size(1)
-    # print(sum, len(self.word_to_column))
-    self.embedding_matrix = torch.cat(sub_matrices, dim=1)
+    sub_matrices = []
+    for start in range(0, words.size(0), batch_size):
+      word_inp = words[start: start + batch_size]
+      n_words = word_inp.size(0)
+      chars_inp = None if self.chars is None else self.chars[word_inp].long().view(n_words, 1, -1)
+      sub_matrices.append(self.token_embedder(word_inp.view(n_words, 1), chars_inp,
+                                              (n_words, 1)).squeeze(1).transpose(0, 1))
+    return torch.cat(sub_matrices, dim=1)
 
-  def update_negative_samples(self, word_inp, chars_inp, mask):
-    batch_size, seq_len = word_inp.size(0), word_inp.size(1)
-    in_batch = set()
-    for i in range(batch_size):
-      for j in range(seq_len):
-        if mask[i][j] == 0:
-          continue
-        word = word_inp[i][j].tolist()
-        in_batch.add(word)
-    for i in range(batch_size):
-      for j in range(seq_len):
-        if mask[i][j] == 0:
-          continue
-        package = (word_inp[i][j].tolist(), None if chars_inp is None else chars_inp[i][j].tolist())
-        if package[0] not in self.all_word_to_column:
-          self.all_word.append(package)
-          self.all_word_to_column[package[0]] = len(self.all_word_to_column)
-
-        if package[0] not in self.word_to_column:
-          if len(self.negative_samples) < self.n_samples:
-            self.negative_samples.append(package)
-            self.word_to_column[package[0]] = len(self.word_to_column)
+  def update_embedding_matrix(self):
+    columns = self.window.columns(self.training)
+    if self.use_cuda:
+      columns = columns.cuda()
+    self.current_columns = columns
+
+    if not self.training:
+      # computed once per evaluation, chunk by chunk and without keeping the graph. The
+      # correction term x M corr^T is folded in, so scoring is a single matmul.
+      words = self.window.all_words[: columns.size(0)]
+      sub_matrices = []
+      with torch.no_grad():
+        for start in range(0, columns.size(0), self.eval_chunk_size):
+          end = min(start + self.eval_chunk_size, columns.size(0))
+          if start == 0:
+            embeddings = torch.cat([self.oov_column, self.embed_words(words[1: end])], dim=1)
           else:
-            while self.negative_samples[0][0] in in_batch:
-              self.negative_samples = self.negative_samples[1:] + [self.negative_samples[0]]
-            self.word_to_column[package[0]] = self.word_to_column.pop(self.negative_samples[0][0])
-            self.negative_samples = self.negative_samples[1:] + [package]
+            embeddings = self.embed_words(words[start: end])
+          sub_matrices.append(embeddings + self.M.matmul(self.corr.forward(columns[start: end]).transpose(0, 1)))
+      self.embedding_matrix = torch.cat(sub_matrices, dim=1)
+      return
+
+    window = self.window
+    if self.cached_matrix is None or (self.refresh_steps > 0 and self.n_updates % self.refresh_steps == 0):
+      with torch.no_grad():
+        self.cached_matrix = self.oov_column.new_zeros(self.oov_column.size(0), self.n_samples)
+        self.cached_matrix[:, :window.size] = self.embed_words(window.slots[:window.size])
+    self.n_updates += 1
+
+    # only the words in the batch, including all the words that just entered the window,
+    # are re-embedded and receive gradients.
+    words = self.words_in_batch[window.word_to_column[self.words_in_batch] > 0]
+    slots = window.word_to_column[words] - 1
+    embeddings = self.embed_words(words)
+    if self.use_cuda:
+      slots = slots.cuda()
+    matrix = self.cached_matrix.index_copy(1, slots, embeddings)
+    self.cached_matrix.index_copy_(1, slots, embeddings.detach())
+
+    self.embedding_matrix = torch.cat([self.oov_column, matrix[:, :window.size]], dim=1)
+
+  def sampler_state_dict(self):
+    return {'window': self.window.state_dict(), 'chars': self.chars, 'n_updates': self.n_updates}
+
+  def load_sampler_state_dict(self, state):
+    self.window.load_state_dict(state['window'])
+    self.chars = None if state['chars'] is None else state['chars'].clone()
+    self.n_updates = state.get('n_updates', 0)
+    # re-embed the whole window with the restored weights.
+    self.cached_matrix = None
+
+  def update_negative_samples(self, word_inp, chars_inp, mask):
+    mask = mask.cpu().view(-1) != 0
+    flat_words = word_inp.cpu().view(-1).masked_select(mask)
+    words, first_index = np.unique(flat_words.numpy(), return_index=True)
+    words = torch.from_numpy(words)
+
+    if chars_inp is not None:
+      if self.chars is None:
+        self.chars = torch.IntTensor(self.window.n_class, chars_inp.size(2)).fill_(0)
+      elif self.chars.size(1) != chars_inp.size(2):
+        raise ValueError('cnn_softmax needs the same number of characters for every token.')
+      # keep the characters of the first occurrence of every new word.
+      unseen = self.window.all_word_to_column[words] < 0
+      flat_chars = chars_inp.cpu().view(-1, chars_inp.size(2))[mask]
+      self.chars[words[unseen]] = flat_chars[torch.from_numpy(first_index)[unseen]].int()
+
+    self.window.update(words)
+    self.words_in_batch = words
@@ -1,6 +1,120 @@
 #!/usr/bin/env python
 import torch
 import numpy as np
+from modules.util import chunked_nll_loss
+
+
+class SampleWindow(object):
+  """
+  The window of recently seen words that serves as negative samples, kept in tensors.
+
+  Column 0 is reserved for word 0. The window is a ring buffer of ``n_samples`` slots, where
+  slot k always holds the word of column k + 1. When a new word comes in and the window is
+  full, the oldest word which is not in the current batch is evicted and the new word takes
+  its column. This is the same as rotating a list of the words in the order they came in.
+  All the words seen so far are also indexed, for evaluation with every seen word.
+  """
+  def __init__(self, n_class: int, n_samples: int):
+    """
+
+    :param n_class: int, the vocabulary size.
+    :param n_samples: int, the size of the window.
+    """
+    self.n_class = n_class
+    self.n_samples = n_samples
+
+    # the words in the window, their columns and the position of the oldest one.
+    self.slots = torch.LongTensor(n_samples).fill_(0)
+    self.size = 0
+    self.head = 0
+    self.word_to_column = torch.LongTensor(n_class).fill_(-1)
+    self.word_to_column[0] = 0
+
+    # all the seen words and their columns.
+    self.all_words = torch.LongTensor(n_class).fill_(0)
+    self.n_all_columns = 1
+    self.all_word_to_column = torch.LongTensor(n_class).fill_(-1)
+    self.all_word_to_column[0] = 0
+
+  def update(self, words: torch.Tensor) -> torch.Tensor:
+    """
+    Put the words of a batch into the window.
+
+    :param words: LongTensor, the (unique) words in the batch.
+    :return: LongTensor, the words that were not in the window before.
+    """
+    # update word indexing
+    new_words = words[self.all_word_to_column[words] < 0]
+    n_new = new_words.size(0)
+    if n_new > 0:
+      self.all_words[self.n_all_columns: self.n_all_columns + n_new] = new_words
+      self.all_word_to_column[new_words] = torch.arange(self.n_all_columns, self.n_all_columns + n_new,
+                                                        dtype=torch.long)
+      self.n_all_columns += n_new
+
+    # update negative samples word indexing
+    new_words = words[self.word_to_column[words] < 0]
+    n_new = new_words.size(0)
+    # if the current negative samples don't reach the limit
+    n_free = min(n_new, self.n_samples - self.size)
+    if n_free > 0:
+      positions = torch.arange(self.size, self.size + n_free, dtype=torch.long)
+      self.slots[positions] = new_words[:n_free]
+      self.word_to_column[new_words[:n_free]] = positions + 1
+      self.size += n_free
+
+    n_evicted = n_new - n_free
+    if n_evicted > 0:
+      in_batch = torch.zeros(self.n_class, dtype=torch.bool)
+      in_batch[words] = True
+      # walk the slots from the oldest one, skipping the words in the batch.
+      order = (torch.arange(self.n_samples, dtype=torch.long) + self.head) % self.n_samples
+      positions = order[~in_batch[self.slots[order]]][:n_evicted]
+      if positions.size(0) < n_evicted:
+        raise ValueError('The batch has more words than n_samples ({}).'.format(self.n_samples))
+      self.word_to_column[self.slots[positions]] = -1
+      self.slots[positions] = new_words[n_free:]
+      self.word_to_column[new_words[n_free:]] = positions + 1
+      self.head = (positions[-1].item() + 1) % self.n_samples
+
+    return new_words
+
+  def state_dict(self):
+    return {'slots': self.slots, 'size': self.size, 'head': self.head, 'word_to_column': self.word_to_column,
+            'all_words': self.all_words, 'n_all_columns': self.n_all_columns,
+            'all_word_to_column': self.all_word_to_column}
+
+  def load_state_dict(self, state):
+    self.slots = state['slots'].clone()
+    self.size = state['size']
+    self.head = state['head']
+    self.word_to_column = state['word_to_column'].clone()
+    self.all_words = state['all_words'].clone()
+    self.n_all_columns = state['n_all_columns']
+    self.all_word_to_column = state['all_word_to_column'].clone()
+
+  def columns(self, training: bool) -> torch.Tensor:
+    """
+    The word of every column.
+
+    :param training: bool, use the window when training, otherwise all the seen words.
+    :return: LongTensor
+    """
+    if training:
+      return torch.cat([self.slots.new_zeros(1), self.slots[:self.size]])
+    return self.all_words[:self.n_all_columns].clone()
+
+  def lookup(self, targets: torch.Tensor, training: bool) -> torch.Tensor:
+    """
+    Map the words to their columns. The unseen words are mapped to column 0 in evaluation.
+
+    :param targets: LongTensor
+    :param training: bool
+    :return: LongTensor, on the device of ``targets``.
+    """
+    word_to_column = self.word_to_column if training else self.all_word_to_column
+    columns = word_to_column[targets.cpu()].clamp(min=0)
+    return columns.to(targets.device)
 
 
 class WindowSampledSoftmaxLayer(torch.nn.Module):
@@ -11,110 +125,86 @@ class WindowSampledSoftmaxLayer(torch.nn.Module):
                embedding_dim: int,
                n_class: int,
                n_samples: int,
-               use_cuda: bool):
+               use_cuda: bool,
+               eval_chunk_size: int = 8192,
+               sparse: bool = False):
     """
 
     :param embedding_dim:
     :param n_class:
     :param n_samples:
     :param use_cuda:
+    :param eval_chunk_size: int, the number of words scored at a time in evaluation.
+    :param sparse: bool, use embeddings with sparse gradients for the output weights.
     """
     super(WindowSampledSoftmaxLayer, self).__init__()
     self.n_samples = n_samples
     self.n_class = n_class
     self.use_cuda = use_cuda
-    self.criterion = torch.nn.CrossEntropyLoss(size_average=False)
+    self.eval_chunk_size = eval_chunk_size
 
-    # indexing of negative samples word to id
-    self.negative_samples = []
-    self.word_to_column = {0: 0}
+    # indexing of negative samples and all the words to columns
+    self.window = SampleWindow(n_class, n_samples)
 
-    # indexing of word to id
-    self.all_word = []
-    self.all_word_to_column = {0: 0}
-
-    self.softmax_w = torch.nn.Embedding(n_class, embedding_dim)
+    self.softmax_w = torch.nn.Embedding(n_class, embedding_dim, sparse=sparse)
     self.softmax_w.weight.data.normal_(mean=0.0, std=1.0 / np.sqrt(embedding_dim))
 
-    self.softmax_b = torch.nn.Embedding(n_class, 1)
+    self.softmax_b = torch.nn.Embedding(n_class, 1, sparse=sparse)
     self.softmax_b.weight.data.fill_(0.0)
 
+    self.current_columns = None
     self.current_embed_matrix = None
 
+  @torch.profiler.record_function('WindowSampledSoftmaxLayer')
   def forward(self,
               embeddings: torch.Tensor,
-              targets: torch.Tensor) -> torch.Tensor:
+              targets: torch.Tensor,
+              reduction: str = 'sum') -> torch.Tensor:
+    """
+
+    :param embeddings:
+    :param targets:
+    :param reduction: str, 'sum' or 'none' for the loss of every target.
+    :return:
+    """
     batch_size = targets.size(0)
+    targets = self.window.lookup(targets, self.training)
 
-    if self.training:
-      for i in range(batch_size):
-        targets[i] = self.word_to_column.get(targets[i].tolist())
-      word_to_column = self.word_to_column
-      words = self.negative_samples
-    else:
-      for i in range(batch_size):
-        targets[i] = self.all_word_to_column.get(targets[i].tolist(), 0)
-      word_to_column = self.all_word_to_column
-      words = self.all_word
+    if not self.training:
+      # score all the seen words chunk by chunk, so the memory doesn't grow with them.
+      columns = self.current_columns
 
-    samples = torch.LongTensor(len(word_to_column)).fill_(0)
-    for word in words:
-      samples[word_to_column[word]] = word
+      def get_columns(start, end):
+        return self.softmax_w.forward(columns[start: end]).t(), self.softmax_b.forward(columns[start: end]).view(-1)
 
-    if self.use_cuda:
-      samples = samples.cuda()
+      return chunked_nll_loss(embeddings, targets, get_columns, columns.size(0), self.eval_chunk_size, reduction)
 
     tag_scores = (embeddings.matmul(self.current_embed_matrix)).view(batch_size, -1) + \
-                 (self.softmax_b.forward(samples)).view(1, -1)
-    return self.criterion(tag_scores, targets)
+                 (self.softmax_b.forward(self.current_columns)).view(1, -1)
+    return torch.nn.functional.cross_entropy(tag_scores.float(), targets, reduction=reduction)
 
   def update_embedding_matrix(self):
+    columns = self.window.columns(self.training)
+    if self.use_cuda:
+      columns = columns.cuda()
+
+    self.current_columns = columns
     if self.training:
-      words = self.negative_samples
-      word_to_column = self.word_to_column
+      self.current_embed_matrix = self.softmax_w.forward(columns).transpose(0, 1)
     else:
-      words = self.all_word
-      word_to_column = self.all_word_to_column
-
-    columns = torch.LongTensor(len(words) + 1)
-    for i, word in enumerate(words):
-      columns[word_to_column[word]] = word
-    columns[0] = 0
+      # the weights are gathered chunk by chunk in forward.
+      self.current_embed_matrix = None
 
-    if self.use_cuda:
-      columns = columns.cuda()
+  def sampler_state_dict(self):
+    return {'window': self.window.state_dict()}
 
-    self.current_embed_matrix = self.softmax_w.forward(columns).transpose(0, 1)
+  def load_sampler_state_dict(self, state):
+    self.window.load_state_dict(state['window'])
 
   def update_negative_samples(self,
                               word_inp: torch.Tensor,
                               chars_inp: torch.Tensor,
                               mask: torch.Tensor):
-    batch_size, seq_len = mask.size()
-    words_in_batch = set()
     # put all the words in the batch as `words_in_batch`
-    for i in range(batch_size):
-      for j in range(seq_len):
-        if mask[i][j] == 0:
-          continue
-        word = word_inp[i][j].tolist()
-        words_in_batch.add(word)
-
-    for word in words_in_batch:
-      # update word indexing
-      if word not in self.all_word_to_column:
-        self.all_word.append(word)
-        self.all_word_to_column[word] = len(self.all_word_to_column)
-
-      # update negative samples word indexing
-      if word not in self.word_to_column:
-        # if the current negative samples don't reach the limit
-        if len(self.negative_samples) < self.n_samples:
-          self.negative_samples.append(word)
-          self.word_to_column[word] = len(self.word_to_column)
-        # shift all the samples in the words_in_batch to the last one
-        else:
-          while self.negative_samples[0] in words_in_batch:
-            self.negative_samples = self.negative_samples[1:] + [self.negative_samples[0]]
-          self.word_to_column[word] = self.word_to_column.pop(self.negative_samples[0])
-          self.negative_samples = self.negative_samples[1:] + [word]
+    words_in_batch = torch.unique(word_inp.cpu().masked_select(mask.cpu() != 0))
+    self.window.update(words_in_batch)
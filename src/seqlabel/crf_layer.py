@@ -14,6 +14,7 @@ class CRFLayer(torch.nn.Module):
     self.transitions = torch.nn.Parameter(torch.FloatTensor(num_tags, num_tags))
     torch.nn.init.uniform_(self.transitions, -0.1, 0.1)
 
+  @torch.profiler.record_function('CRFLayer')
   def forward(self, x, y):
     emissions = self.hidden2tag(x)
     new_emissions = emissions.permute(1, 0, 2).contiguous()
@@ -9,6 +9,7 @@ class PartialCRFLayer(CRFLayer):
   def __init__(self, n_in, num_tags, use_cuda=False):
     super(PartialCRFLayer, self).__init__(n_in, num_tags, use_cuda)
 
+  @torch.profiler.record_function('PartialCRFLayer')
   def forward(self, x, y):
     emissions = self.hidden2tag(x)
     new_emissions = emissions.permute(1, 0, 2).contiguous()
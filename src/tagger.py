@@ -19,6 +19,8 @@ from modules.gal_lstm import GalLSTM
 from modules.embedding_layer import EmbeddingLayer
 from seqlabel.crf_layer import CRFLayer
 from seqlabel.partial_crf_layer import PartialCRFLayer
+from modules.stage_timer import StageTimer, timed
+from modules.step_profiler import StepProfiler, parse_steps
 logging.basicConfig(level=logging.INFO, format='%(asctime)-15s %(levelname)s: %(message)s')
 
 
@@ -159,11 +161,6 @@ class Model(torch.nn.Module):
     else:
       self.classify_layer = PartialCRFLayer(opt.hidden_dim * 2, n_class, self.use_cuda)
 
-    self.train_time = 0
-    self.eval_time = 0
-    self.emb_time = 0
-    self.classify_time = 0
-
   def forward(self, x, p, y):
     p = torch.autograd.Variable(p, requires_grad=False)
     p = p.transpose(-2, -1).matmul(self.weights)
@@ -174,12 +171,8 @@ class Model(torch.nn.Module):
     x = self.dropout(x)
 
     output, hidden = self.encoder(x)
-    start_time = time.time()
-
-    output, loss = self.classify_layer.forward(output, y)
+    output, loss = self.classify_layer(output, y)
 
-    if not self.training:
-      self.classify_time += time.time() - start_time
     if self.training:
       loss += self.opt.l2 * self.classify_layer.hidden2tag.weight.data.norm(2)
       # loss += self.opt.l2 * self.merge_inputs.weight.data.norm(2)
@@ -226,7 +219,7 @@ def eval_model(model, valid_payload, ix2label, args, gold_path):
 
 def train_model(epoch, model, optimizer,
                 train_payload, valid_payload, test_payload,
-                ix2label, best_valid, test_result):
+                ix2label, best_valid, test_result, timer=None, profiler=None):
   model.train()
   opt = model.opt
 
@@ -246,13 +239,23 @@ def train_model(epoch, model, optimizer,
   for x, p, y, lens in zip(train_x, train_p, train_y, train_lens):
     cnt += 1
     model.zero_grad()
-    _, loss = model.forward(x, p, y)
+    with timed(timer, 'forward'):
+      _, loss = model.forward(x, p, y)
     total_loss += loss.item()
     n_tags = sum(lens)
     total_tag += n_tags
-    loss.backward()
-    torch.nn.utils.clip_grad_norm_(model.parameters(), opt.clip_grad)
-    optimizer.step()
+    with timed(timer, 'backward'):
+      loss.backward()
+    with timed(timer, 'optimizer'):
+      torch.nn.utils.clip_grad_norm_(model.parameters(), opt.clip_grad)
+      optimizer.step()
+
+    if timer is not None:
+      timer.step(n_tags)
+      if timer.total_steps % opt.timing_steps == 0:
+        timer.report(epoch=epoch, iter=cnt)
+    if profiler is not None:
+      profiler.step()
 
     if cnt * opt.batch_size % 1024 == 0:
       logging.info("Epoch={} iter={} lr={:.6f} train_ave_loss={:.6f} time={:.2f}s".format(
@@ -262,7 +265,8 @@ def train_model(epoch, model, optimizer,
       start_time = time.time()
 
     if cnt % opt.eval_steps == 0:
-      valid_result = eval_model(model, valid_payload, ix2label, opt, opt.gold_valid_path)
+      with timed(timer, 'eval', hooks=False):
+        valid_result = eval_model(model, valid_payload, ix2label, opt, opt.gold_valid_path)
       logging.info("Epoch={} iter={} lr={:.6f} train_loss={:.6f} valid_acc={:.6f}".format(
         epoch, cnt, optimizer.param_groups[0]['lr'], total_loss, valid_result))
 
@@ -271,7 +275,8 @@ def train_model(epoch, model, optimizer,
         logging.info("New record achieved!")
         best_valid = valid_result
         if test is not None:
-          test_result = eval_model(model, test_payload, ix2label, opt, opt.gold_test_path)
+          with timed(timer, 'eval', hooks=False):
+            test_result = eval_model(model, test_payload, ix2label, opt, opt.gold_test_path)
           logging.info("Epoch={} iter={} lr={:.6f} test_acc={:.6f}".format(
             epoch, cnt, optimizer.param_groups[0]['lr'], test_result))
 
@@ -318,6 +323,14 @@ def train():
   cmd.add_argument("--consider_word_piece", default=False, action='store_true', help='use word piece.')
   cmd.add_argument('--output', help='The path to the output file.')
   cmd.add_argument("--script", required=True, help="The path to the evaluation script")
+  cmd.add_argument('--timing_steps', type=int, default=0,
+                   help='report the tokens/sec and the time of every training stage every xx batches, '
+                        '0 to disable.')
+  cmd.add_argument('--timing_output', help='append the timing reports to this file as JSON lines.')
+  cmd.add_argument('--profile_steps', type=parse_steps,
+                   help='run torch.profiler over the batches a:b (counted from 0) and write a Chrome trace and '
+                        'summary tables to --profile_dir.')
+  cmd.add_argument('--profile_dir', help='the directory of the profile, <model>/profile by default.')
 
   opt = cmd.parse_args(sys.argv[2:])
 
@@ -389,8 +402,10 @@ def train():
 
   word2id = word_emb_layer.word2id
 
+  start_time = time.time()
   training_payload = create_batches(dim, n_layers, raw_training_data, raw_training_labels,
                                     lexicon, word2id, opt.batch_size, use_cuda=use_cuda)
+  logging.info('built {0} training batches in {1:.2f}s.'.format(len(training_payload[0]), time.time() - start_time))
 
   if opt.eval_steps is None or opt.eval_steps > len(raw_training_data):
     opt.eval_steps = len(training_payload[0])
@@ -433,16 +448,28 @@ def train():
       print('{0}\t{1}'.format(label, i), file=fpo)
 
   json.dump(vars(opt), codecs.open(os.path.join(opt.model, 'config.json'), 'w', encoding='utf-8'))
+  timer = None
+  if opt.timing_steps > 0:
+    timer = StageTimer(use_cuda, opt.timing_output)
+    timer.add_module('word_embedder', model.word_emb_layer)
+    timer.add_module('encoder', model.encoder)
+    timer.add_module('crf', model.classify_layer)
+
+  profiler = None
+  if opt.profile_steps is not None:
+    profiler = StepProfiler(opt.profile_steps, opt.profile_dir or os.path.join(opt.model, 'profile'), use_cuda)
+
   best_valid, test_result = -1e8, -1e8
   for epoch in range(opt.max_epoch):
     best_valid, test_result = train_model(epoch, model, optimizer,
                                           training_payload, valid_payload, test_payload,
-                                          ix2label, best_valid, test_result)
+                                          ix2label, best_valid, test_result, timer, profiler)
     if opt.lr_decay > 0:
       optimizer.param_groups[0]['lr'] *= opt.lr_decay
-    logging.info('Total encoder time: {:.2f}s'.format(model.eval_time / (epoch + 1)))
-    logging.info('Total embedding time: {:.2f}s'.format(model.emb_time / (epoch + 1)))
-    logging.info('Total classify time: {:.2f}s'.format(model.classify_time / (epoch + 1)))
+  if timer is not None:
+    timer.close()
+  if profiler is not None:
+    profiler.stop()
 
   weights = model.weights
   if use_cuda: